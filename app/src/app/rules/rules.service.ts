@@ -1,8 +1,8 @@
 import { Injectable } from '@angular/core';
 import { HttpClient } from '@angular/common/http';
 import { HttpErrorResponse, HttpHeaders } from '@angular/common/http';
-import { Observable, throwError } from 'rxjs';
-import { catchError, retry } from 'rxjs/operators';
+import { Observable, forkJoin, of, throwError } from 'rxjs';
+import { catchError, map, retry, switchMap } from 'rxjs/operators';
 
 
 export interface AppliedRuleResult {
@@ -17,6 +17,19 @@ export interface Response {
   report: string;
 }
 
+// the /transform response: the stored run's id and totals
+interface Run {
+  run_id: string;
+  total: number;
+}
+
+interface ResultsPage {
+  results: AppliedRuleResult[];
+}
+
+// largest page /transform/runs/<id>/results returns
+const PAGE_SIZE = 1000;
+
 @Injectable({
   providedIn: 'root'
 })
@@ -30,12 +43,32 @@ export class RulesService {
     formData.append('rulesJson', rulesJson);
     formData.append('modelID', modelID.toString());
 
-    return this.http.post('http://localhost:5000/transform', formData)
+    // the run is stored on the server; fetch its results page by page and its report
+    return this.http.post<Run>('http://localhost:5000/transform', formData)
       .pipe(
+        switchMap(run => forkJoin({
+          results: this.runResults(run),
+          report: this.http.get(`http://localhost:5000/transform/runs/${run.run_id}/report`, { responseType: 'text' }),
+        })),
         catchError(this.handleError) // then handle the error
       );
   }
 
+  private runResults(run: Run): Observable<AppliedRuleResult[]> {
+    const pages: Observable<ResultsPage>[] = [];
+    for (let offset = 0; offset < run.total; offset += PAGE_SIZE) {
+      pages.push(this.http.get<ResultsPage>(`http://localhost:5000/transform/runs/${run.run_id}/results`, {
+        params: { offset: offset.toString(), limit: PAGE_SIZE.toString() }
+      }));
+    }
+    if (!pages.length) {
+      return of([]);
+    }
+    return forkJoin(pages).pipe(
+      map(results => ([] as AppliedRuleResult[]).concat(...results.map(page => page.results)))
+    );
+  }
+
   exportAFXML(modelID: number, rulesJson: File, piServer: string, piDatabase: string, piExportPath?: string, piImportPath?: string): Observable<Blob | any> {
     const formData: FormData = new FormData();
     formData.append('rulesJson', rulesJson);
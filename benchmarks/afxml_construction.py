@@ -0,0 +1,53 @@
+"""
+Time per call of building PIAFElements, appending children to them and reading
+their properties, the hot paths of createAFTree.
+
+    python benchmarks/afxml_construction.py --baseline 437e60a
+
+compares the working tree with afxml.py before construction and appends were
+dispatched through class-level tables.
+"""
+import argparse
+import timeit
+
+from common import modules
+
+
+def cases(af):
+    element = af.AFElement(af.Name("e"))
+    attribute = af.AFAttribute(af.Name("a"))
+    analysis = af.AFAnalysis(af.Name("x"))
+    return {
+        "Name('x')": lambda: af.Name("x"),
+        "IsHidden(True)": lambda: af.IsHidden(True),
+        "Status('Enabled')": lambda: af.Status("Enabled"),
+        "AFAttribute(5 children)": lambda: af.AFAttribute(
+            af.Name("a"), af.Description("d"), af.DefaultUOM("%"), af.Type("Int32"), af.Value("", type="Int32")
+        ),
+        "AFElement += AFAnalysis": lambda: element.__add__(analysis),
+        "AFElement += AFAttribute": lambda: element.__add__(attribute),
+        "el.Name": lambda: element.Name,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", action="append", default=[], help="git revision to compare with (repeatable)")
+    parser.add_argument("--number", type=int, default=100000, help="calls per repeat")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for label, af in modules(args.baseline):
+        for name, call in cases(af).items():
+            seconds = min(timeit.repeat(call, number=args.number, repeat=args.repeat)) / args.number
+            results.setdefault(name, {})[label] = seconds * 1e9
+
+    labels = args.baseline + ["worktree"]
+    print(f"{'ns per call':26s}" + "".join(f"{label:>12s}" for label in labels))
+    for name, timings in results.items():
+        print(f"{name:26s}" + "".join(f"{timings[label]:12.0f}" for label in labels))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Memory of PIAFElement trees: bytes per element of a database of AFElements with
+AFAttributes, and bytes per leaf element, measured with tracemalloc.
+
+    python benchmarks/afxml_memory.py --baseline 437e60a~1
+
+compares the working tree with afxml.py before elements got __slots__.
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from common import modules
+
+
+def build(af, elements, attributes):
+    root = af.AF()
+    database = af.AFDatabase(af.Name("db"))
+    root += database
+    for e in range(elements):
+        element = af.AFElement(af.Name(f"el{e}"), af.id(f"{e:032x}"), af.Description("AHU"))
+        element["ReferenceType"] = "Parent-Child"
+        for a in range(attributes):
+            element += af.AFAttribute(
+                af.Name(f"a{a}"), af.Description("Supply_Air_Temperature_Sensor"),
+                af.DefaultUOM("°F"), af.Type("Int32"), af.Value("", type="Int32"),
+            )
+        database += element
+    return root
+
+
+def measure(af, elements, attributes, leaves):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    root = build(af, elements, attributes)
+    seconds = time.perf_counter() - start
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    # AF, AFDatabase and its Name; each element has 3 leaves and each attribute 5
+    count = 3 + elements * (4 + attributes * 6)
+
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [af.Name("x") for _ in range(leaves)]
+    leaf_bytes = (tracemalloc.get_traced_memory()[0] - before) / leaves
+    tracemalloc.stop()
+    del root, kept
+    return count, tree_bytes, seconds, leaf_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--baseline", action="append", default=[], help="git revision to compare with (repeatable)")
+    parser.add_argument("--elements", type=int, default=2000)
+    parser.add_argument("--attributes", type=int, default=20)
+    parser.add_argument("--leaves", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'':12s} {'elements':>9s} {'tree MB':>8s} {'B/element':>9s} {'B/leaf':>7s} {'build s':>8s}")
+    for label, af in modules(args.baseline):
+        count, tree_bytes, seconds, leaf_bytes = measure(af, args.elements, args.attributes, args.leaves)
+        print(f"{label:12s} {count:9d} {tree_bytes / 1e6:8.1f} {tree_bytes / count:9.0f} {leaf_bytes:7.0f} {seconds:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
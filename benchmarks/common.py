@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AFXML = "interop_metadata_applications/afxml.py"
+
+
+def load_afxml(revision=None):
+    """The afxml module of the working tree, or of a git revision of it"""
+    name = f"afxml_{revision or 'worktree'}".replace("~", "_").replace("^", "_")
+    if revision is None:
+        return _load(name, os.path.join(REPO, AFXML))
+    source = subprocess.run(
+        ["git", "show", f"{revision}:{AFXML}"], cwd=REPO, check=True, capture_output=True
+    ).stdout
+    # the copy is only needed while the module is executed
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "afxml.py")
+        with open(path, "wb") as f:
+            f.write(source)
+        return _load(name, path)
+
+
+def _load(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def modules(baselines):
+    """(label, afxml module) for every baseline revision, then the working tree"""
+    return [(revision, load_afxml(revision)) for revision in baselines] + [("worktree", load_afxml())]
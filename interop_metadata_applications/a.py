@@ -1,171 +1,165 @@
-from collections import defaultdict
+from collections import defaultdict, Counter
 from tqdm import tqdm
 import logging
 import json
 from buildingmotif.namespaces import SH, BRICK, bind_prefixes
 from buildingmotif.dataclasses import Library
-from copy import deepcopy
 import sys, os, json, re, uuid, random, string
 from rdflib import RDFS, RDF, SH, BRICK, Namespace, Graph, Literal, BNode, URIRef
 from interop_metadata_applications.bmotif_o27 import generate_markdown_report
+from interop_metadata_applications.transform import (
+    rule_bindings,
+    with_closures,
+    CLOSURE_RELATIONSHIPS,
+    shape_parent_index,
+    resolve_original_shape,
+)
+from interop_metadata_applications.sparse_rules import SparseModel
+from interop_metadata_applications.validation_cache import cached_validate
+from interop_metadata_applications.progress import Progress
 
 logger = logging.getLogger(__name__)
 
 BRICK = Namespace('https://brickschema.org/schema/Brick#')
 
-# build relationship
-RELATIONSHIPS = ["hasPoint", "hasPart", "isPointOf", "isPartOf", "feeds"]
-RELATIONSHIPS += [f"{r}+" for r in RELATIONSHIPS]
-RELATIONSHIPS += [f"{r}?" for r in RELATIONSHIPS]
-RELATIONSHIPS += [f"{r}*" for r in RELATIONSHIPS]
-
-
-original_shape_cache = {}
-
 def find_original_shape(model, shape_uri: URIRef) -> URIRef:
     """
     From the given property or node shape URI, find *users* of the URI
     until we find the original shape. Users of the URI can be related to this
-    URI through sh:property or sh:node.
+    URI through sh:property, sh:node or an sh:or/sh:and/sh:xone list.
     """
-    if shape_uri in original_shape_cache:
-        return original_shape_cache[shape_uri]
-    graph = model.get_manifest().graph
-    original_shape = shape_uri
-    while True:
-        query = f"""
-            SELECT ?shape WHERE {{
-                ?shape (sh:or|sh:and|sh:xone)?/sh:property|sh:node {original_shape.n3()} .
-            }}
-        """
-        res = graph.query(query)
-        if len(res) == 0:
-            break
-        original_shape = list(res)[0][0]
-    original_shape_cache[shape_uri] = original_shape
-    return original_shape
-
-
-def _gensym():
-    """generates random sparql variable name"""
-    return 'var' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
-
-def _sparql_recurse(defn, varname, hook=None):
-    query = ""
-
-    if isinstance(defn, str):
-        if hook is not None and hook != varname:
-            # then varname is hasPoint from hook
-            query += f"?{hook} brick:hasPoint ?{varname} .\n"
-        query += f"?{varname} rdf:type {BRICK[defn].n3()} .\n"
-        return query
-    
-    for key, value in defn.items():
-        if key == "choice":
-            # UNION of the list of descriptions in 'value'
-            query += "{\n"
-            query += " UNION ".join([f"{{ {_sparql_recurse(v, varname, hook=hook)} }}\n" for v in value])
-            query += "}\n"
-
-        elif key in RELATIONSHIPS:
-            # start with a random var
-            subject_var = hook or _gensym()
-            
-            # get the relationship name
-            suffix = key[-1] if key[-1] in ["+", "?", "*"] else ""
-            relname = key.replace("+", "").replace("?", "").replace("*", "")
-            # get the relationship type
-            reltype = BRICK[relname]
-            
-            # the object of the relationship is one of two things:
-            # - varname, if 'value' is a type
-            # - a new variable, if 'value' is a dict
-            if isinstance(value, str):
-                object_var = varname
-            else:
-                object_var = _gensym()
-
-            # add the relationship to the query
-            query += f"?{subject_var} {reltype.n3()}{suffix} ?{object_var} .\n"
-            # add the object to the query
-            query += _sparql_recurse(value, varname, hook=object_var)
-
-        else: # key represents a type
-            subject_var = hook or _gensym()
-            query += f"?{subject_var} rdf:type {BRICK[key].n3()} .\n"
-            # value should be a dictionary
-            query += _sparql_recurse(value, varname, hook=subject_var)
+    index = shape_parent_index(model.get_manifest().graph)
+    return resolve_original_shape(index, shape_uri)
 
-    return query
 
-def _definition_to_sparql(classname, defn, variable):
+def class_histogram(graph) -> Counter:
     """
-    defn is a JSON structure like this:
-        "Chilled_Water_Valve_Command": {
-            "choice": [
-                {"hasPoint": "Chilled_Water_Valve_Command"},
-                {"hasPart": {"Chilled_Water_Valve": {"hasPoint": "Valve_Command"}}}
-            ]
-        },
-    This method turns this into a SPARQL query which retrieves values into a variable
-    named whatever the top-level key is
+    Counts the instances of every class in one pass over the graph. If the graph
+    carries rdfs:subClassOf triples, instances are also counted for every superclass
     """
-    query = f"""SELECT ?root ?{variable} WHERE {{ 
-        ?root rdf:type {classname.n3()} .
-        {_sparql_recurse(defn, variable, hook="root")} 
-    }}"""
-    return query
-
-def apply_rules_to_model(model, rules):
+    histogram = Counter()
+    parents = defaultdict(set)
+    for s, p, o in graph.triples((None, None, None)):
+        if p == RDF.type:
+            histogram[o] += 1
+        elif p == RDFS.subClassOf:
+            parents[s].add(o)
+    if not parents:
+        return histogram
+
+    ancestors = {}
+    def _ancestors(class_, seen):
+        if class_ in ancestors:
+            return ancestors[class_]
+        result = set()
+        for parent in parents.get(class_, ()):
+            if parent in seen:
+                continue
+            result.add(parent)
+            result |= _ancestors(parent, seen | {parent})
+        ancestors[class_] = result
+        return result
+
+    subclass_aware = Counter(histogram)
+    for class_, count in histogram.items():
+        for ancestor in _ancestors(class_, {class_}):
+            subclass_aware[ancestor] += count
+    return subclass_aware
+
+
+def apply_rules_to_model(model, rules, engine="sparql", closures=False, stats=None, progress=None, fingerprint=None):
+    """
+    Finds the bindings of every rule on the model. engine is "sparql" (one query per
+    rule) or "sparse" (sparse matrix evaluation over the whole model, see sparse_rules).
+    With closures=True the sparql engine first materializes the transitive closures of
+    hasPart, feeds and isPartOf (cached per model graph) and uses them for '+'/'*' keys.
+    Rules with no instance of any of their 'applicability' classes are skipped; pass a
+    dict as stats to get the number of evaluated and skipped rules back. Each rule
+    advances the 'rule binding' stage of progress. fingerprint is
+    graph_fingerprint(model.graph), if the caller has it already.
+    """
+    progress = progress or Progress()
     logger.info(f"Applying rules to model {model.graph}")
     successful_rules = defaultdict(lambda: defaultdict(dict))
-    #graph = Graph(store="Oxigraph")
-    #graph.parse(data=model.graph.serialize(format="ttl"), format="ttl")
-    for rule, defn in tqdm(rules.items()):
-        logger.info(f"WORKING ON RULE {rule}")
-        rule = f"urn:rules_manifest/{rule}"
-        for classname in defn["applicability"]:
-            class_ = BRICK[classname]
-            for variable, vardef in defn["definitions"].items():
-                logger.info(f"variable {variable} has definition {vardef}")
-                query = _definition_to_sparql(class_, defn["definitions"][variable], variable)
-                logger.info(f"querying {query} for rule {rule} var {variable}")
-
-                results = model.graph.query(query)
-                for row in results.bindings:
-                    logger.info(f"row {row}")
-                    row = {str(k): v for k, v in row.items()}
-                    inst = row['root']
-                    successful_rules[rule][inst].update(row)
-
-        # loop through all 'inst' for this rule. If the length of its dictionary == len(defn["definitions"]), then it's successful
-        for inst in deepcopy(successful_rules[rule]):
-            if len(successful_rules[rule][inst]) != len(defn["definitions"]) + 1: # +1 for the 'root' variable
-                del successful_rules[rule][inst]
-
+    if engine == "sparse":
+        evaluate = SparseModel(model.graph).rule_bindings
+    elif engine == "sparql" and closures:
+        graph = with_closures(model.graph, CLOSURE_RELATIONSHIPS, fingerprint=fingerprint)
+        evaluate = lambda defn: rule_bindings(graph, defn, closures=CLOSURE_RELATIONSHIPS)
+    elif engine == "sparql":
+        evaluate = lambda defn: rule_bindings(model.graph, defn)
+    else:
+        raise ValueError(f"Unknown rule engine: {engine}. Please use one of [sparql, sparse]")
+    histogram = class_histogram(model.graph)
+    evaluated, skipped = 0, 0
+    with progress.stage("rule binding", total=len(rules)) as stage:
+        for rule, defn in tqdm(rules.items()):
+            logger.info(f"WORKING ON RULE {rule}")
+            rule = f"urn:rules_manifest/{rule}"
+            instances = successful_rules[rule]
+            stage.advance()
+            if not any(histogram[BRICK[classname]] for classname in defn["applicability"]):
+                logger.info(f"skipping rule {rule}: no instances of {defn['applicability']}")
+                skipped += 1
+                continue
+            evaluated += 1
+            # one evaluation per rule; only complete bindings come back
+            logger.info(f"rule {rule} has definitions {defn['definitions']}")
+            for inst, row in evaluate(defn).items():
+                logger.info(f"row {row}")
+                instances[inst].update(row)
+
+    logger.info(f"Evaluated {evaluated} rules, skipped {skipped} with no applicable instances")
+    if stats is not None:
+        stats["evaluated"] = evaluated
+        stats["skipped"] = skipped
     return successful_rules
 
 
-def get_model_diffs(model):
-    validation_context = model.validate(error_on_missing_imports=False)
-    model.graph.serialize('/tmp/model2.ttl', format='turtle')
-    validation_context.report.serialize('/tmp/report.ttl', format='turtle')
-
-    grouped_diffs = defaultdict(lambda: defaultdict(set))
-    for focus_node, diffs in tqdm(validation_context.diffset.items()):
-        logger.info(f"focus_node {focus_node} diffs {len(diffs)}")
-        for diff in tqdm(diffs):
-            original_shape = find_original_shape(model, diff.failed_shape)
-            ## remove focus_node from the successful rules
-            #if original_shape in successful_rules:
-            #    if focus_node in successful_rules[original_shape]:
-            #        del successful_rules[original_shape][focus_node]
-            grouped_diffs[original_shape][focus_node].add(diff.reason())
-        # set all the diffs to be a list
-        for original_shape in grouped_diffs:
-            for focus_node in grouped_diffs[original_shape]:
-                grouped_diffs[original_shape][focus_node] = list(grouped_diffs[original_shape][focus_node])
-    return grouped_diffs
+def get_model_diffs(model, debug_dir=None, use_cache=True, progress=None, fingerprint=None):
+    """
+    Validates the model and groups the failure reasons as
+    {original_shape: {focus_node: [reason, ...]}} in a single pass over the diffset.
+    Returns (grouped_diffs, validation_context). The model and the validation report
+    are only written out (as model.ttl and report.ttl) when debug_dir, or the
+    VALIDATION_DEBUG_DIR environment variable, is set. With use_cache the validation
+    is reused while the model graph and the manifest (with its imports) are unchanged;
+    see validation_cache (fingerprint is graph_fingerprint(model.graph), if the caller
+    has it already). Reports the 'validation' and 'diff grouping' stages to progress.
+    """
+    progress = progress or Progress()
+    with progress.stage("validation"):
+        if use_cache:
+            validation_context = cached_validate(model, fingerprint=fingerprint)
+        else:
+            validation_context = model.validate(error_on_missing_imports=False)
+    debug_dir = debug_dir or os.getenv("VALIDATION_DEBUG_DIR")
+    if debug_dir:
+        model.graph.serialize(os.path.join(debug_dir, 'model.ttl'), format='turtle')
+        validation_context.report.serialize(os.path.join(debug_dir, 'report.ttl'), format='turtle')
+
+    grouped_diffs = defaultdict(dict)
+    # the same reason text shows up for many focus nodes; keep one copy of each
+    reasons = {}
+    seen = set()
+    with progress.stage("diff grouping", total=len(validation_context.diffset)) as stage:
+        shape_index = shape_parent_index(model.get_manifest().graph)
+        for focus_node, diffs in tqdm(validation_context.diffset.items()):
+            logger.debug(f"focus_node {focus_node} diffs {len(diffs)}")
+            stage.advance()
+            for diff in diffs:
+                original_shape = resolve_original_shape(shape_index, diff.failed_shape)
+                ## remove focus_node from the successful rules
+                #if original_shape in successful_rules:
+                #    if focus_node in successful_rules[original_shape]:
+                #        del successful_rules[original_shape][focus_node]
+                reason = diff.reason()
+                reason = reasons.setdefault(reason, reason)
+                if (original_shape, focus_node, reason) in seen:
+                    continue
+                seen.add((original_shape, focus_node, reason))
+                grouped_diffs[original_shape].setdefault(focus_node, []).append(reason)
+    return grouped_diffs, validation_context
 
 def get_report(grouped_diffs: defaultdict, successful_rules: defaultdict):
     return generate_markdown_report(grouped_diffs, successful_rules, '')
@@ -0,0 +1,402 @@
+import hashlib
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from lxml import etree
+
+import interop_metadata_applications.afxml as af
+
+logger = logging.getLogger(__name__)
+
+# the objects an AFXML delta adds, replaces or deletes as a whole; each has an id
+UNIT_TAGS = ("AFElement", "AFElementTemplate")
+
+# id -> [tag, name, digest of the object without its nested units, id of its parent unit or None]
+ExportState = Dict[str, List[Optional[str]]]
+
+
+def _hash_tokens(tokens) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for token in tokens:
+        h.update(token.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _piaf_tokens(element, name, parent_id=None):
+    # the parent is part of a unit's digest, so a unit that moved counts as changed
+    if parent_id is not None:
+        yield f"parent={parent_id}"
+    attributes = sorted((element._attributes or {}).items())
+    yield f"<{name} {attributes}>{element._text or ''}"
+    children_values = element._children_values or {}
+    for child_name, _ in element.element_children:
+        if child_name in UNIT_TAGS:
+            continue
+        for child_value in children_values.get(child_name, []):
+            yield from _piaf_tokens(child_value, child_name)
+    yield f"</{name}>"
+
+
+def _lxml_tokens(element, parent_id=None):
+    if parent_id is not None:
+        yield f"parent={parent_id}"
+    # pretty-printing whitespace between child elements is not part of the content
+    text = element.text or ""
+    if len(element) and not text.strip():
+        text = ""
+    yield f"<{element.tag} {sorted(element.attrib.items())}>{text}"
+    for child in element:
+        if child.tag in UNIT_TAGS:
+            continue
+        yield from _lxml_tokens(child)
+    yield f"</{element.tag}>"
+
+
+def _text_of(element, child: str) -> Optional[str]:
+    try:
+        return getattr(element, child)._text
+    except (AttributeError, ValueError):
+        return None
+
+
+def tree_state(root) -> ExportState:
+    """Digests of the elements and element templates of a PIAF tree, by id"""
+    state = {}
+
+    def walk(element, name, parent_id):
+        if name in UNIT_TAGS:
+            element_id = _text_of(element, "id")
+            if element_id is not None:
+                element_id = str(element_id)
+                digest = _hash_tokens(_piaf_tokens(element, name, parent_id))
+                state[element_id] = [name, str(_text_of(element, "Name") or ""), digest, parent_id]
+            parent_id = element_id
+        for child_name, _ in element.element_children:
+            for child_value in (element._children_values or {}).get(child_name, []):
+                walk(child_value, child_name, parent_id)
+
+    walk(root, root.__class__.__name__, None)
+    return state
+
+
+def export_state(path) -> ExportState:
+    """
+    Digests of the elements and element templates of an AFXML file, by id. The file
+    is read with iterparse and every element is cleared once digested, so only an
+    empty skeleton of the document is kept in memory.
+    """
+    state = {}
+    for _, element in etree.iterparse(path, events=("end",), tag=UNIT_TAGS):
+        element_id = element.findtext("id")
+        if element_id is not None:
+            # the parent's id comes before its nested units, so it has been parsed already
+            parent = element.getparent()
+            parent_id = parent.findtext("id") if parent is not None and parent.tag in UNIT_TAGS else None
+            digest = _hash_tokens(_lxml_tokens(element, parent_id))
+            state[element_id] = [element.tag, element.findtext("Name") or "", digest, parent_id]
+        # nested units are not part of their parent's digest, so the parent can be
+        # digested after its children are gone
+        element.clear(keep_tail=True)
+    return state
+
+
+def load_state(path) -> Tuple[Optional[str], ExportState]:
+    """(fingerprint, state) of a previous export, from its state file or from the AFXML itself"""
+    if str(path).endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        # state files written before parents were recorded have no parent ids
+        return saved.get("fingerprint"), {
+            element_id: (entry + [None])[:4] for element_id, entry in saved["elements"].items()
+        }
+    return None, export_state(path)
+
+
+def save_state(path, fingerprint: str, state: ExportState) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"fingerprint": fingerprint, "elements": state}, f)
+
+
+def state_path(outpath: str) -> str:
+    """Where the state of the export written to outpath is kept"""
+    base = outpath[:-4] if outpath.endswith(".xml") else outpath
+    return f"{base}.state.json"
+
+
+def _copy(element, children):
+    """Copy of a PIAF element with its own text and XML attributes and the given children"""
+    copy = element.__class__()
+    copy._text = element._text
+    copy._attributes = dict(element._attributes) if element._attributes else None
+    for child in children:
+        copy += child
+    return copy
+
+
+def delta_tree(root, previous: ExportState, current: ExportState = None):
+    """
+    The part of an AF tree that differs from a previous export: added and changed
+    (or moved) elements and element templates with their own content, the ids and
+    names of the unchanged elements above them so they land in the right place, and
+    a 'delete' operation for every element of the previous export that is gone. A
+    delete goes under the stub of its parent, the same way, unless its parent is
+    gone too and deleted with it.
+    Returns (delta root, {"added": n, "changed": n, "removed": n}).
+    """
+    current = current if current is not None else tree_state(root)
+    counts = {"added": 0, "changed": 0, "removed": 0}
+    # parent id (None for the database) -> delete operations of the units removed from it
+    deletes = {}
+    for element_id, (tag, element_name, _, parent_id) in previous.items():
+        if element_id in current:
+            continue
+        counts["removed"] += 1
+        if parent_id is None or parent_id in current:
+            deletes.setdefault(parent_id, []).append(getattr(af, tag)(af.id(element_id), af.Name(element_name), operation="delete"))
+
+    def prune(element, name):
+        """Pruned copy of a unit, or None if neither it nor a unit below it changed"""
+        element_id = _text_of(element, "id")
+        before = previous.get(element_id)
+        changed = before is None or element_id is None or before[2] != current[element_id][2]
+        children, nested = [], False
+        for child_name, _ in element.element_children:
+            for child_value in (element._children_values or {}).get(child_name, []):
+                if child_name in UNIT_TAGS:
+                    pruned = prune(child_value, child_name)
+                    if pruned is not None:
+                        children.append(pruned)
+                        nested = True
+                elif changed or child_name in ("id", "Name"):
+                    children.append(child_value)
+        if element_id in deletes:
+            children.extend(deletes[element_id])
+            nested = True
+        if changed:
+            counts["added" if before is None else "changed"] += 1
+        elif not nested:
+            return None
+        return _copy(element, children)
+
+    def walk(element, name):
+        """Copy of the containers above the units (AF, AFDatabase) with the pruned units"""
+        children = []
+        for child_name, _ in element.element_children:
+            for child_value in (element._children_values or {}).get(child_name, []):
+                if child_name in UNIT_TAGS:
+                    pruned = prune(child_value, child_name)
+                    if pruned is not None:
+                        children.append(pruned)
+                elif child_name == "AFDatabase":
+                    children.append(walk(child_value, child_name))
+                else:
+                    children.append(child_value)
+        if name == "AFDatabase":
+            children.extend(deletes.get(None, []))
+        return _copy(element, children)
+
+    delta = walk(root, root.__class__.__name__)
+    logger.info(f"AFXML delta: {counts['added']} added, {counts['changed']} changed, {counts['removed']} removed")
+    return delta, counts
+
+
+class _Entry:
+    """What compare_exports keeps of one element of an export"""
+
+    __slots__ = ("tag", "path", "parent", "props", "attributes", "subtree", "children")
+
+    def __init__(self, tag, path, parent, props, attributes, subtree, children):
+        self.tag = tag
+        self.path = path
+        self.parent = parent
+        self.props = props
+        self.attributes = attributes
+        self.subtree = subtree
+        self.children = children
+
+
+def index_export(path) -> Tuple[Dict[str, _Entry], List[str]]:
+    """
+    One iterparse pass over an AFXML file. Every element and element template is
+    keyed by its id, or by its Name path when it has none, and is kept as: the
+    digest of its own content except its attributes, the digest of every
+    attribute by name, and the digest of its whole subtree, which is hashed
+    bottom-up from the subtree digests of its children. Returns (index, the keys
+    of the top-level elements).
+    """
+    index, roots = {}, []
+    # [lxml element, keys of its nested units] of the units being parsed
+    stack = []
+    for event, element in etree.iterparse(path, events=("start", "end"), tag=UNIT_TAGS):
+        if event == "start":
+            stack.append((element, []))
+            continue
+        _, children = stack.pop()
+        names = [frame[0].findtext("Name") or "" for frame in stack] + [element.findtext("Name") or ""]
+        element_path = "\\".join(names)
+        key = element.findtext("id") or element_path
+
+        props, attributes = [], {}
+        own = _lxml_tokens(element)
+        props.append(next(own))
+        for child in element:
+            if child.tag in UNIT_TAGS:
+                continue
+            tokens = _lxml_tokens(child)
+            if child.tag in ("AFAttribute", "AFAttributeTemplate"):
+                attributes[child.findtext("Name") or ""] = _hash_tokens(tokens)
+            else:
+                props.extend(tokens)
+        props = _hash_tokens(props)
+        subtree = _hash_tokens(
+            [props] + sorted(f"{name}={digest}" for name, digest in attributes.items())
+            + sorted(index[child].subtree for child in children)
+        )
+        parent = None
+        if stack:
+            parent_element = stack[-1][0]
+            parent = parent_element.findtext("id") or "\\".join(names[:-1])
+            stack[-1][1].append(key)
+        else:
+            roots.append(key)
+        index[key] = _Entry(element.tag, element_path, parent, props, attributes, subtree, children)
+        element.clear(keep_tail=True)
+    return index, roots
+
+
+def _count(index, key) -> int:
+    return 1 + sum(_count(index, child) for child in index[key].children)
+
+
+def compare_exports(left, right) -> Dict[str, list]:
+    """
+    Compares two AFXML exports element by element (matched by id, or by Name path
+    for elements without one) instead of as trees of XML nodes. Subtrees with the
+    same digest on both sides are skipped without looking inside. Returns a report
+    with the elements that were added and removed (topmost only, with the size of
+    their subtree) and modified (changed content, added/removed/changed attributes
+    or a new parent). The report is plain JSON data; format_comparison renders it
+    for review and comparison_delta turns it into an AFXML import.
+    """
+    old, old_roots = index_export(left)
+    new, new_roots = index_export(right)
+    report = {"added": [], "removed": [], "modified": []}
+
+    def visit(key):
+        entry = new[key]
+        before = old.get(key)
+        if before is None:
+            if entry.parent is None or entry.parent in old:
+                report["added"].append({"key": key, "tag": entry.tag, "path": entry.path, "elements": _count(new, key)})
+            return
+        if before.subtree == entry.subtree and before.parent == entry.parent:
+            return
+        attributes = {
+            "added": sorted(set(entry.attributes) - set(before.attributes)),
+            "removed": sorted(set(before.attributes) - set(entry.attributes)),
+            "changed": sorted(
+                name for name in set(entry.attributes) & set(before.attributes)
+                if entry.attributes[name] != before.attributes[name]
+            ),
+        }
+        content = before.props != entry.props
+        moved = before.parent != entry.parent
+        if content or moved or any(attributes.values()):
+            change = {"key": key, "tag": entry.tag, "path": entry.path, "content": content, "attributes": attributes}
+            if moved:
+                change["moved_from"] = before.path
+            report["modified"].append(change)
+        for child in entry.children:
+            visit(child)
+
+    for key in new_roots:
+        visit(key)
+    for key, entry in old.items():
+        if key not in new and (entry.parent is None or entry.parent in new):
+            report["removed"].append({
+                "key": key, "tag": entry.tag, "path": entry.path, "parent": entry.parent, "elements": _count(old, key),
+            })
+    report["summary"] = {
+        "added": sum(change["elements"] for change in report["added"]),
+        "removed": sum(change["elements"] for change in report["removed"]),
+        "modified": len(report["modified"]),
+    }
+    return report
+
+
+def format_comparison(report) -> str:
+    """Review form of a compare_exports report, one line per added, removed or modified element"""
+    lines = []
+    for change in report["added"]:
+        lines.append(f"+ {change['tag']} {change['path']} ({change['elements']} elements)")
+    for change in report["removed"]:
+        lines.append(f"- {change['tag']} {change['path']} ({change['elements']} elements)")
+    for change in report["modified"]:
+        details = []
+        if change["content"]:
+            details.append("content")
+        if "moved_from" in change:
+            details.append(f"moved from {change['moved_from']}")
+        for kind, sign in (("added", "+"), ("removed", "-"), ("changed", "~")):
+            details.extend(f"{sign}{name}" for name in change["attributes"][kind])
+        lines.append(f"~ {change['tag']} {change['path']}: {', '.join(details)}")
+    summary = report["summary"]
+    lines.append(f"{summary['added']} added, {summary['removed']} removed, {summary['modified']} modified")
+    return "\n".join(lines)
+
+
+def comparison_delta(right, report, outpath) -> None:
+    """
+    Writes the AFXML import that turns the left export of a comparison into the
+    right one: the added and modified elements of the right export with id/Name
+    stubs of their unchanged ancestors, and a 'delete' entry for every removed
+    element, under the stubs of its ancestors as well, so that an element without
+    an id is deleted by its name within its parent.
+    """
+    tree = etree.parse(right)
+    database = tree.getroot().find("AFDatabase")
+    added = {change["key"] for change in report["added"]}
+    keep = added | {change["key"] for change in report["modified"]}
+    # parent key (None for the database) -> removed elements
+    deletes = {}
+    for change in report["removed"]:
+        deletes.setdefault(change["parent"], []).append(change)
+
+    def key_of(element, names):
+        return element.findtext("id") or "\\".join(names)
+
+    def add_deletes(parent, key):
+        for change in deletes.get(key, []):
+            removed = etree.SubElement(parent, change["tag"], operation="delete")
+            if change["key"] != change["path"]:
+                etree.SubElement(removed, "id").text = change["key"]
+            etree.SubElement(removed, "Name").text = change["path"].split("\\")[-1]
+        return key in deletes
+
+    def prune(element, names):
+        """Removes what did not change below element; True if anything is left"""
+        names = names + [element.findtext("Name") or ""]
+        key = key_of(element, names)
+        if key in added:
+            return True
+        left = False
+        for child in list(element):
+            if child.tag in UNIT_TAGS:
+                if prune(child, names):
+                    left = True
+                else:
+                    element.remove(child)
+            elif key not in keep and child.tag not in ("id", "Name"):
+                element.remove(child)
+        if add_deletes(element, key):
+            left = True
+        return left or key in keep
+
+    for child in list(database):
+        if child.tag in UNIT_TAGS and not prune(child, []):
+            database.remove(child)
+    add_deletes(database, None)
+    etree.indent(tree, space="  ")
+    tree.write(outpath, xml_declaration=True, encoding="UTF-8", pretty_print=True)
@@ -0,0 +1,289 @@
+import logging
+import re
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import quote
+
+import pandas as pd
+from lxml import etree
+from rdflib import RDF, RDFS, BNode, Graph, Literal, Namespace
+
+logger = logging.getLogger(__name__)
+
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+REF = Namespace("https://brickschema.org/schema/Brick/ref#")
+UNIT = Namespace("http://qudt.org/vocab/unit/")
+EX = Namespace("http://example.org/building#")
+
+# the objects an AF database is made of; elements are lifted, templates fill in their attributes
+UNIT_TAGS = ("AFElement", "AFElementTemplate")
+# the properties of an element or template that are kept, the rest (analyses, categories, ...) is dropped
+ELEMENT_PROPERTIES = ("id", "Name", "Description", "Template", "BaseTemplate")
+ATTRIBUTE_TAGS = ("AFAttribute", "AFAttributeTemplate")
+# AFXML child -> key of an attribute's properties
+ATTRIBUTE_PROPERTIES = {
+    "Description": "description",
+    "Type": "type",
+    "DefaultUOM": "uom",
+    "Value": "value",
+    "DataReference": "data_reference",
+    "ConfigString": "config_string",
+}
+# the parents whose finished children are read and dropped while parsing
+CONTAINER_TAGS = ("AF", "AFDatabase") + UNIT_TAGS
+
+BRICK_CLASS = re.compile(r"[A-Z][A-Za-z0-9]*(_[A-Za-z0-9]+)*")
+
+TABLE_COLUMNS = [
+    "path", "element", "id", "element_type", "template",
+    "attribute", "type", "aftype", "uom", "value", "data_reference", "tag",
+]
+
+
+class ElementRecord:
+    """One AF element of an export, with its attributes merged with those of its template"""
+
+    __slots__ = ("path", "name", "id", "description", "template", "parent", "attributes", "children")
+
+    def __init__(self, path, name, id, description, template, parent, attributes, children):
+        self.path = path
+        self.name = name
+        self.id = id
+        self.description = description
+        self.template = template
+        self.parent = parent
+        # attribute name -> {"description", "type", "uom", "value", "data_reference", "config_string"}
+        self.attributes = attributes
+        # (name, path, id, description) of the child elements
+        self.children = children
+
+
+class _Frame:
+    """An element or element template whose end has not been parsed yet"""
+
+    __slots__ = ("tag", "properties", "attributes", "children")
+
+    def __init__(self, tag):
+        self.tag = tag
+        self.properties = {}
+        self.attributes = {}
+        self.children = []
+
+
+def _read_attribute(attribute, prefix, attributes) -> None:
+    """Properties of an AFAttribute(Template) and its nested attributes ('Parent|Child'), by name"""
+    name = f"{prefix}{attribute.findtext('Name') or ''}"
+    properties = {}
+    for child in attribute:
+        key = ATTRIBUTE_PROPERTIES.get(child.tag)
+        if key is not None:
+            properties[key] = child.text
+        elif child.tag in ATTRIBUTE_TAGS:
+            _read_attribute(child, f"{name}|", attributes)
+    attributes[name] = properties
+
+
+def _merge(template: Dict[str, dict], own: Dict[str, dict]) -> Dict[str, dict]:
+    # the element only overrides what differs from its template (e.g. the ConfigString)
+    merged = {name: dict(properties) for name, properties in template.items()}
+    for name, properties in own.items():
+        merged.setdefault(name, {}).update((key, value) for key, value in properties.items() if value is not None)
+    return merged
+
+
+def iter_elements(path) -> Iterator[ElementRecord]:
+    """
+    Streams the elements of an AFXML export (as written by AFExport.exe or xml_dump).
+    The file is read with iterparse and every child of an element, template or of
+    the database is read and removed once it has been parsed, so memory holds the
+    open elements and the element templates only, however large the export.
+    Elements are yielded when they end, so children come before their parent.
+    """
+    templates: Dict[str, Dict[str, dict]] = {}
+    stack: List[_Frame] = []
+    for event, node in etree.iterparse(path, events=("start", "end"), remove_blank_text=True):
+        tag = node.tag
+        if event == "start":
+            if tag in UNIT_TAGS:
+                stack.append(_Frame(tag))
+            continue
+
+        parent = node.getparent()
+        if tag in UNIT_TAGS:
+            frame = stack.pop()
+            properties = frame.properties
+            name = properties.get("Name") or ""
+            if tag == "AFElementTemplate":
+                base = templates.get(properties.get("BaseTemplate"), {})
+                templates[name] = _merge(base, frame.attributes)
+            else:
+                names = [f.properties.get("Name") or "" for f in stack if f.tag == "AFElement"]
+                element_path = "\\".join(names + [name])
+                template = properties.get("Template")
+                if template is not None and template not in templates:
+                    logger.warning(f"Element {element_path} is based on template {template}, which is not in the export")
+                attributes = _merge(templates.get(template, {}), frame.attributes) if template else frame.attributes
+                if stack and stack[-1].tag == "AFElement":
+                    stack[-1].children.append((name, element_path, properties.get("id"), properties.get("Description")))
+                yield ElementRecord(
+                    element_path, name, properties.get("id"), properties.get("Description"), template,
+                    "\\".join(names) if names else None, attributes, frame.children,
+                )
+        elif parent is None or parent.tag not in CONTAINER_TAGS:
+            # read as part of its parent
+            continue
+        elif parent.tag in UNIT_TAGS:
+            if tag in ATTRIBUTE_TAGS:
+                _read_attribute(node, "", stack[-1].attributes)
+            elif tag in ELEMENT_PROPERTIES:
+                stack[-1].properties[tag] = node.text
+
+        node.clear(keep_tail=True)
+        if parent is not None:
+            parent.remove(node)
+
+
+def brick_class(description: Optional[str]):
+    """The Brick class an element or attribute Description names, as this repo's exports write them"""
+    if description and BRICK_CLASS.fullmatch(description):
+        return BRICK[description]
+    return None
+
+
+def tag_of(config_string: Optional[str]) -> Optional[str]:
+    """The PI Point of a 'PI Point' ConfigString, without its options (';RelativeTime=...')"""
+    if not config_string:
+        return None
+    return config_string.split(";")[0]
+
+
+def _ordinal(name: str, base: Optional[str]) -> int:
+    # element templates name the attributes of one point class base, base_2, base_3, ...
+    suffix = name[len(base or "") + 1:] if base and name.startswith(f"{base}_") else ""
+    return int(suffix) if suffix.isdigit() else 1
+
+
+def point_children(record: ElementRecord) -> Dict[str, Tuple[str, str, Optional[str]]]:
+    """
+    The child element that is the point of each attribute, as (name, path, id), for
+    the attributes that have one: the child with the attribute's name or, for an
+    element based on a template, the n-th child (by name) of the attribute's point
+    class for the n-th attribute of that class (see Translator.element_templates).
+    """
+    by_name = {child[0]: child for child in record.children}
+    points = {name: by_name[name][:3] for name in record.attributes if name in by_name}
+    if record.template is None:
+        return points
+    candidates = {}
+    for child in sorted(record.children):
+        if child[0] not in record.attributes:
+            candidates.setdefault(child[3], []).append(child[:3])
+    unmatched = [
+        (properties.get("description"), _ordinal(name, properties.get("description")), name)
+        for name, properties in record.attributes.items() if name not in points
+    ]
+    for description, ordinal, name in sorted(unmatched, key=lambda a: (a[0] or "", a[1], a[2])):
+        children = candidates.get(description)
+        if children:
+            points[name] = children.pop(0)
+    return points
+
+
+def iter_triples(path, namespace: Namespace = EX, units: Dict[str, object] = None,
+                 unit_namespace: Namespace = UNIT, ids: Dict[str, object] = None) -> Iterator[Tuple]:
+    """
+    Lifts an AFXML export into Brick-shaped triples, the reverse of
+    Translator.createAFTree:
+    - every element is a node named after it, typed by the Brick class its
+      Description names and labelled with its name; a child element is a part of it
+      (brick:hasPart);
+    - every attribute is a point of its element (brick:hasPoint). A child element
+      that is the point of an attribute (point_children) is that point, as
+      createAFTree writes points; other attributes are named '<element>.<attribute>'. The point
+      is typed by its Description (brick:Point otherwise), has the Brick unit whose
+      AF unit of measure in units (Brick unit -> uom, as Translator.units) is its
+      DefaultUOM, and its PI Point is a ref:TimeseriesReference.
+    Elements whose id is in ids (AF id -> node) are that node; the others are named
+    by their name, or by their full path when another element has the same name.
+    """
+    ids = ids or {}
+    uoms = {}
+    for unit, entry in (units or {}).items():
+        uom = entry if isinstance(entry, str) else entry.get("uom", "")
+        if uom:
+            uoms.setdefault(uom, unit_namespace[unit])
+    # name -> path of the first element with it
+    names: Dict[str, str] = {}
+
+    def node_for(name, element_path, element_id=None):
+        if element_id in ids:
+            return ids[element_id]
+        first = names.setdefault(name, element_path)
+        return namespace[quote(name if first == element_path else element_path, safe="")]
+
+    for record in iter_elements(path):
+        node = node_for(record.name, record.path, record.id)
+        element_class = brick_class(record.description)
+        if element_class is not None:
+            yield node, RDF.type, element_class
+        yield node, RDFS.label, Literal(record.name)
+
+        points = point_children(record)
+        point_paths = {child[1] for child in points.values()}
+        for name, child_path, child_id, _ in record.children:
+            if child_path not in point_paths:
+                yield node, BRICK.hasPart, node_for(name, child_path, child_id)
+        for name, properties in record.attributes.items():
+            if name in points:
+                point = node_for(*points[name])
+            else:
+                point = node_for(f"{record.name}.{name}", f"{record.path}|{name}")
+                yield point, RDFS.label, Literal(name)
+            yield node, BRICK.hasPoint, point
+            yield point, RDF.type, brick_class(properties.get("description")) or BRICK.Point
+            unit = uoms.get(properties.get("uom"))
+            if unit is not None:
+                yield point, BRICK.hasUnit, unit
+            tag = tag_of(properties.get("config_string"))
+            if tag is not None and properties.get("data_reference") == "PI Point":
+                reference = BNode()
+                yield point, REF.hasExternalReference, reference
+                yield reference, RDF.type, REF.TimeseriesReference
+                yield reference, REF.hasTimeseriesId, Literal(tag)
+
+
+def read_graph(path, namespace: Namespace = EX, units: Dict[str, object] = None, graph: Graph = None,
+               ids: Dict[str, object] = None) -> Graph:
+    """The triples of iter_triples in a graph (a new one unless one is given)"""
+    graph = graph if graph is not None else Graph()
+    graph.bind("brick", BRICK)
+    graph.bind("ref", REF)
+    for triple in iter_triples(path, namespace, units, ids=ids):
+        graph.add(triple)
+    return graph
+
+
+def read_table(path) -> pd.DataFrame:
+    """
+    An AFXML export as a table with one row per attribute (with the properties it
+    gets from its template), and one row without an attribute for every element
+    that has none, so every element is in it. The columns are TABLE_COLUMNS; tag
+    is the PI Point of a 'PI Point' data reference.
+    """
+    columns = {column: [] for column in TABLE_COLUMNS}
+    for record in iter_elements(path):
+        for name, properties in (record.attributes or {None: {}}).items():
+            columns["path"].append(record.path)
+            columns["element"].append(record.name)
+            columns["id"].append(record.id)
+            columns["element_type"].append(record.description)
+            columns["template"].append(record.template)
+            columns["attribute"].append(name)
+            columns["type"].append(properties.get("description"))
+            columns["aftype"].append(properties.get("type"))
+            columns["uom"].append(properties.get("uom"))
+            columns["value"].append(properties.get("value"))
+            columns["data_reference"].append(properties.get("data_reference"))
+            columns["tag"].append(
+                tag_of(properties.get("config_string")) if properties.get("data_reference") == "PI Point" else None
+            )
+    return pd.DataFrame(columns, dtype=object)
@@ -4,149 +4,149 @@ from typing import Any, List, Tuple
 import os, glob
 
 ## This code comes from BSyncPy
-class PIAFElement:
+
+def _text_parser(expected, message, to_text):
+    """Parser for a simple-typed element: type check of the value, then its text"""
+    def parse(value):
+        if not isinstance(value, expected):
+            raise TypeError(message)
+        return to_text(value)
+    return parse
+
+
+def _parse_non_negative_integer(value):
+    if not isinstance(value, int):
+        raise TypeError("integer expected")
+    if value < 0:
+        raise ValueError("non-negative integer expected")
+    return f"{value:d}"
+
+
+# element_type -> parser of the constructor argument; other types take child elements
+TEXT_PARSERS = {
+    "xs:boolean": _text_parser(bool, "boolean expected", lambda value: "true" if value else "false"),
+    "xs:integer": _text_parser(int, "integer expected", lambda value: f"{value:d}"),
+    "xs:int": _text_parser(int, "integer expected", lambda value: f"{value:d}"),
+    "xs:nonNegativeInteger": _parse_non_negative_integer,
+    "xs:decimal": _text_parser(float, "decimal (float) expected", lambda value: f"{value:f}"),
+    "xs:float": _text_parser(float, "float expected", lambda value: f"{value:G}"),
+    "xs:string": _text_parser(str, "string expected", lambda value: value),
+    "xs:date": _text_parser(datetime.date, "datetime.date expected", lambda value: value.isoformat()),
+    "xs:time": _text_parser(datetime.time, "datetime.time expected", lambda value: value.isoformat()),
+    "xs:dateTime": _text_parser(datetime.datetime, "datetime.datetime expected", lambda value: value.isoformat()),
+    "xs:gMonthDay": _text_parser(datetime.date, "datetime.date expected", lambda value: value.strftime("--%m-%d")),
+    "xs:gYear": _text_parser(int, "integer expected", lambda value: f"{value:d}"),
+    "xs:any": lambda value: f"{value}",
+}
+
+
+_set_slot = object.__setattr__
+
+
+class PIAFElementType(type):
+    """
+    Metaclass of the AF elements. Every element class gets empty __slots__, so
+    instances only carry the slots declared by PIAFElement and no __dict__, and
+    the parser of its constructor argument (enumeration, union or element_type)
+    is picked once when the class is created.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault("__slots__", ())
+        cls = super().__new__(mcs, name, bases, namespace)
+        parser = mcs._text_parser_for(cls)
+        cls._parse_text = staticmethod(parser) if parser is not None else None
+        return cls
+
+    @staticmethod
+    def _text_parser_for(cls):
+        if cls.element_enumerations:
+            def parse(value):
+                if value not in cls.element_enumerations:
+                    raise ValueError("invalid enumeration")
+                return value
+            return parse
+        if cls.element_union:
+            def parse(value):
+                for subtype in cls.element_union:
+                    try:
+                        return subtype(value)._text
+                    except (ValueError, TypeError):
+                        pass
+                raise ValueError("invalid argument")
+            return parse
+        return TEXT_PARSERS.get(cls.element_type)
+
+
+class PIAFElement(metaclass=PIAFElementType):
     element_type: str = ""
     element_attributes: List[str] = []
     element_enumerations: List[str] = []
     element_children: List[Tuple[str, type]] = []
     element_union: List[type] = []
 
-    def __init__(self, *args, **kwargs):
-        """Create an instance of a Asset Framework element."""
-        self._children_by_name = dict(self.element_children)
-        self._children_values = {}
-        self._text = None
-
-        if args:
-            arg_value = args[0]
-            if self.element_enumerations:
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if args[0] not in self.element_enumerations:
-                    raise ValueError("invalid enumeration")
-                self._text = args[0]
-
-            elif self.element_union:
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                for subtype in self.element_union:
-                    try:
-                        value = subtype(args[0])
-                        self._text = value._text
-                        break
-                    except (ValueError, TypeError):
-                        pass
-                else:
-                    raise ValueError("invalid argument")
-
-            elif self.element_type == "xs:boolean":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, bool):
-                    raise TypeError("boolean expected")
-                self._text = "true" if args[0] else "false"
-
-            elif self.element_type == "xs:integer" or self.element_type == "xs:int":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, int):
-                    raise TypeError("integer expected")
-                self._text = f"{arg_value:d}"
-
-            elif self.element_type == "xs:nonNegativeInteger":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, int):
-                    raise TypeError("integer expected")
-                if arg_value < 0:
-                    raise ValueError("non-negative integer expected")
-                self._text = f"{arg_value:d}"
-
-            elif self.element_type == "xs:decimal":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, float):
-                    raise TypeError("decimal (float) expected")
-                self._text = f"{arg_value:f}"
-
-            elif self.element_type == "xs:float":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, float):
-                    raise TypeError("float expected")
-                self._text = f"{arg_value:G}"
-
-            elif self.element_type == "xs:string":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, str):
-                    raise TypeError("string expected")
-                self._text = arg_value
-
-            elif self.element_type == "xs:date":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, datetime.date):
-                    raise TypeError("datetime.date expected")
-                self._text = arg_value.isoformat()
-
-            elif self.element_type == "xs:time":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, datetime.time):
-                    raise TypeError("datetime.time expected")
-                self._text = arg_value.isoformat()
-
-            elif self.element_type == "xs:dateTime":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, datetime.datetime):
-                    raise TypeError("datetime.datetime expected")
-                self._text = arg_value.isoformat()
-
-            elif self.element_type == "xs:gMonthDay":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, datetime.date):
-                    raise TypeError("datetime.date expected")
-                self._text = arg_value.strftime("--%m-%d")
-
-            elif self.element_type == "xs:gYear":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                if not isinstance(arg_value, int):
-                    raise TypeError("integer expected")
-                self._text = f"{arg_value:d}"
-            
-            elif self.element_type == "xs:any":
-                if len(args) > 1:
-                    raise RuntimeError("too many arguments")
-                self._text = f"{arg_value}"
+    # children and XML attributes are allocated when the first one is set
+    __slots__ = ("_children_values", "_text", "_attributes")
 
-            else:
-                # add the args as child elements
-                for arg_value in args:
-                    self += arg_value
+    @classmethod
+    def _child_tables(cls):
+        """
+        (child element name -> type, value type -> child element name), shared by all
+        instances of the class. Built on first use since element_children is filled
+        in after the class is created. A value type maps to the first child whose
+        type it is an instance of, as isinstance would find scanning element_children.
+        """
+        table = cls.__dict__.get("_child_table")
+        if table is None or table[0] != len(cls.element_children):
+            by_type = {}
+            for _, child_type in cls.element_children:
+                child_name = cls._scan_children(child_type)
+                if child_name is not None:
+                    by_type[child_type] = child_name
+            table = (len(cls.element_children), dict(cls.element_children), by_type)
+            cls._child_table = table
+        return table[1], table[2]
+
+    @classmethod
+    def _scan_children(cls, value_type):
+        for child_name, child_type in cls.element_children:
+            if issubclass(value_type, child_type):
+                return child_name
+        return None
 
-        self._attributes = kwargs
+    def __init__(self, *args, **kwargs):
+        """Create an instance of a Asset Framework element."""
+        # the slots are set directly, __setattr__ is only needed for child elements
+        _set_slot(self, "_children_values", None)
+        _set_slot(self, "_attributes", kwargs or None)
+
+        if args and self._parse_text is not None:
+            if len(args) > 1:
+                raise RuntimeError("too many arguments")
+            _set_slot(self, "_text", self._parse_text(args[0]))
+        else:
+            _set_slot(self, "_text", None)
+            # add the args as child elements
+            for arg_value in args:
+                self + arg_value
 
     def __getattr__(self, attr):
         """Get the value of a child element."""
         if attr.startswith("_"):
             return object.__getattribute__(self, attr)
 
-        # make sure the attribute exists and it has been given a value
-        if attr not in self._children_by_name:
-            raise AttributeError(
-                f"{repr(self.__class__.__name__)} object has no child {repr(attr)}"
-            )
-        if attr not in self._children_values:
+        values = self._children_values.get(attr) if self._children_values else None
+        if values is None:
+            # make sure the attribute exists and it has been given a value
+            if attr not in self._child_tables()[0]:
+                raise AttributeError(
+                    f"{repr(self.__class__.__name__)} object has no child {repr(attr)}"
+                )
             raise ValueError(f"{repr(attr)} not set")
 
         # most of the time the elements are provided once, so returning the
         # one that was provided is easier, but if there is more than one
         # this returns the entire list
-        values = self._children_values[attr]
         if len(values) == 1:
             return values[0]
         else:
@@ -158,18 +158,21 @@ class PIAFElement:
             return super().__setattr__(attr, value)
 
         # make sure the attribute exists and the value is the correct type
-        if attr not in self._children_by_name:
+        child_types = self._child_tables()[0]
+        if attr not in child_types:
             raise AttributeError(
                 f"{repr(self.__class__.__name__)} object has no child {repr(attr)}"
             )
-        if not isinstance(value, self._children_by_name[attr]):
+        if not isinstance(value, child_types[attr]):
             raise ValueError(
-                f"{repr(attr)} invalid type, expecting {self._children_by_name[attr]}"
+                f"{repr(attr)} invalid type, expecting {child_types[attr]}"
             )
 
         # setting an attribute value is an error if there is already a value
         # that has been set
-        if attr in self._children_values:
+        if self._children_values is None:
+            self._children_values = {}
+        elif attr in self._children_values:
             raise ValueError(f"{repr(attr)} already set")
 
         # save the value
@@ -180,17 +183,23 @@ class PIAFElement:
         correct class.  Return this element so other child element values can
         be added like 'thing + Child1() + Child2()'.
         """
-        for child_name, child_type in self.element_children:
-            if isinstance(value, child_type):
-                break
-        else:
+        by_type = self._child_tables()[1]
+        child_name = by_type.get(value.__class__)
+        if child_name is None:
+            # a subclass of a child type, or not a child at all
+            child_name = self._scan_children(value.__class__)
+            if child_name is not None:
+                by_type[value.__class__] = child_name
+        if child_name is None:
             child_type_names = list(
                 child_type.__name__ for child_name, child_type in self.element_children
             )
             raise ValueError(f"expecting one of: {', '.join(child_type_names)}")
 
         # if this child already has a value, add this to the end
-        if child_name in self._children_values:
+        if self._children_values is None:
+            _set_slot(self, "_children_values", {child_name: [value]})
+        elif child_name in self._children_values:
             self._children_values[child_name].append(value)
         else:
             self._children_values[child_name] = [value]
@@ -204,20 +213,23 @@ class PIAFElement:
     def set(self, attr: str, value: str) -> None:
         """Set an XML attribute value for the element."""
         assert isinstance(value, str)
+        if self._attributes is None:
+            self._attributes = {}
         self._attributes[attr] = value
 
     def __setitem__(self, item: str, value: str) -> None:
         """Array form 'element[attr] = value' of 'element.set(attr, value)."""
-        assert isinstance(value, str)
-        self._attributes[item] = value
+        self.set(item, value)
 
     def get(self, attr: str) -> Any:
         """Return an XML attribute value for the element."""
+        if self._attributes is None:
+            raise KeyError(attr)
         return self._attributes[attr]
 
     def __getitem__(self, item: str) -> str:
         """Array form of 'element.get(attr)'."""
-        return self._attributes[item]
+        return self.get(item)
 
     def toxml(self, root=None, child_name=None) -> Any:
         """Return an ElementTree element.  If the root is provided the element
@@ -256,13 +268,15 @@ class PIAFElement:
             myroot.text = str(self._text)
 
         # maybe I have attributes
-        for k, v in self._attributes.items():
-            myroot.set(k, v)
+        if self._attributes:
+            for k, v in self._attributes.items():
+                myroot.set(k, v)
 
         # maybe I have children
-        for child_name, child_type in self.element_children:
-            for child_value in self._children_values.get(child_name, []):
-                child_value.toxml(myroot, child_name)
+        if self._children_values:
+            for child_name, child_type in self.element_children:
+                for child_value in self._children_values.get(child_name, []):
+                    child_value.toxml(myroot, child_name)
 
         # return this "root" element
         return myroot
@@ -634,7 +648,7 @@ AFElement.element_attributes = [
 ]
 
 class AFAnalysisTemplate(PIAFElement):
-    element_type = 'xs:string'
+    pass
 
 AFAnalysisTemplate.element_children = [
     ('id', id),
@@ -714,7 +728,7 @@ AF.element_attributes = [
 
 
 class AFAttributeTemplate(PIAFElement):
-    element_type = 'xs:string'
+    pass
 
 AFAttributeTemplate.element_children = [
     ('id', id),
@@ -740,7 +754,7 @@ AFAttributeTemplate.element_attributes = [
     'operation'
 ]
 class AFElementTemplate(PIAFElement):
-    element_type = 'xs:string'
+    pass
 AFElementTemplate.element_children = [
     ('id', id),
     ('Name', Name),
@@ -768,3 +782,118 @@ AFElementTemplate.element_children = [
 AFElementTemplate.element_attributes = [
     'operation'
 ]
+# element templates come before the analysis templates and elements of a database
+AFDatabase.element_children.insert(
+    AFDatabase.element_children.index(('AFAnalysisTemplate', AFAnalysisTemplate)),
+    ('AFElementTemplate', AFElementTemplate),
+)
+
+
+## Streaming serialization: the document is written element by element with
+## lxml's incremental writer instead of building the whole lxml tree first
+
+XML_DECLARATION = b'<?xml version="1.0" encoding="UTF-8"?>'
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+# size of the chunks yielded by iter_xml
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """File-like sink for etree.xmlfile that hands out what has been written so far"""
+
+    def __init__(self):
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        self.parts = []
+        self.size = 0
+        return data
+
+
+def _with_nested(element, children_values, extra):
+    """The children of element followed, for each child name, by the extra ones of that name"""
+    for child_name, _ in element.element_children:
+        for child_value in children_values.get(child_name, []):
+            yield child_name, child_value
+        for child_value in extra.get(child_name, ()):
+            yield child_name, child_value
+
+
+def _write_element(xf, element, name, depth, pretty_print, attrib=None, nsmap=None, nested=None):
+    """
+    Writes element and its children to xf, yielding after every complex element so
+    the caller can pass the output on. Elements without children are written as a
+    single small lxml element, as are the (rare) ones with both text and children.
+    """
+    children_values = element._children_values or {}
+    extra = nested(element) if nested is not None else None
+    if extra:
+        children = _with_nested(element, children_values, extra)
+    else:
+        children = [
+            (child_name, child_value)
+            for child_name, _ in element.element_children
+            for child_value in children_values.get(child_name, [])
+        ]
+        if attrib is None and element._text and children:
+            xf.write(element.toxml(child_name=name))
+            return
+        if attrib is None and not children:
+            leaf = etree.Element(name, element._attributes)
+            if element._text:
+                leaf.text = str(element._text)
+            xf.write(leaf)
+            return
+
+    attrib = {**(attrib or {}), **(element._attributes or {})}
+    with xf.element(name, attrib, nsmap=nsmap):
+        for child_name, child_value in children:
+            if pretty_print:
+                xf.write("\n" + "  " * (depth + 1))
+            yield from _write_element(xf, child_value, child_name, depth + 1, pretty_print, nested=nested)
+        if pretty_print:
+            xf.write("\n" + "  " * depth)
+    yield
+
+
+def iter_xml(root, pretty_print=True, declaration=True, chunk_size=CHUNK_SIZE, nested=None):
+    """
+    Serializes a PIAF element (usually AF) in chunks of about chunk_size bytes,
+    without building an lxml tree or a byte string of the whole document. The
+    output is the same document as str(root), encoded as UTF-8.
+
+    nested, if given, is called with every element before it is written and may
+    return {child name: iterable of further children}, which are written after the
+    element's own children of that name. The tree can then be built while it is
+    written, one element at a time (see Translator.iter_af_xml).
+    """
+    buf = _ChunkBuffer()
+    if declaration:
+        buf.write(XML_DECLARATION + b"\n")
+    name = root.__class__.__name__
+    attrib, nsmap = None, None
+    if name == "AF":
+        attrib = {etree.QName(XSI_NAMESPACE, "noNamespaceSchemaLocation"): os.path.join(os.path.dirname(__file__), 'OSIsoft.AF.xsd')}
+        nsmap = {'xsi': XSI_NAMESPACE}
+    with etree.xmlfile(buf, encoding="UTF-8") as xf:
+        for _ in _write_element(xf, root, name, 0, pretty_print, attrib, nsmap, nested):
+            if buf.size >= chunk_size:
+                yield buf.take()
+    if pretty_print:
+        buf.write(b"\n")
+    yield buf.take()
+
+
+def write_xml(root, file, pretty_print=True, nested=None):
+    """Streams the document of a PIAF element (see iter_xml) to a path or a binary file object"""
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            return write_xml(root, f, pretty_print, nested)
+    for chunk in iter_xml(root, pretty_print=pretty_print, nested=nested):
+        file.write(chunk)
@@ -26,8 +26,13 @@ from interop_metadata_applications.api.views.pointlist_to_template import bluepr
 from interop_metadata_applications.api.views.model_generation import blueprint as model_generation_blueprint
 from interop_metadata_applications.api.views.manifest_generation import blueprint as manifest_generation_blueprint
 from interop_metadata_applications.api.views.mappings import blueprint as mappings_blueprint
+from interop_metadata_applications.api.views.jobs import blueprint as jobs_blueprint
+from interop_metadata_applications.jobs import start_workers, JOB_WORKERS
 from buildingmotif.building_motif.building_motif import BuildingMOTIF
 
+# database of the API's BuildingMOTIF instance; the job workers open the same one
+DB_URI = "sqlite:///db.db"
+
 
 def _after_request(response):
     """Commit or rollback the session.
@@ -77,7 +82,7 @@ def create_app():
 
     # we need to do this setup inside the app_context or it will set up 2 different building_motif instances
     with app.app_context():
-        app.building_motif = BuildingMOTIF("sqlite:///db.db", shacl_engine="topquadrant", log_level=logging.INFO)
+        app.building_motif = BuildingMOTIF(DB_URI, shacl_engine="topquadrant", log_level=logging.INFO)
         app.building_motif.setup_tables()
         # set up libraries
         brick = Library.load(ontology_graph="https://github.com/BrickSchema/Brick/releases/download/nightly/Brick.ttl", run_shacl_inference=False, overwrite=False)
@@ -109,6 +114,7 @@ def create_app():
     app.register_blueprint(pointlist_to_template_blueprint, url_prefix="/pointlist-to-template")
     app.register_blueprint(model_generation_blueprint, url_prefix="/model-generation")
     app.register_blueprint(manifest_generation_blueprint, url_prefix="/manifest-generation")
+    app.register_blueprint(jobs_blueprint, url_prefix="/jobs")
 
     # buildingmotif endpoints
     app.register_blueprint(library_blueprint, url_prefix="/libraries")
@@ -118,6 +124,10 @@ def create_app():
     app.register_blueprint(mappings_blueprint, url_prefix="/mappings")
     app.register_blueprint(graph_blueprint, url_prefix="/graph")
 
+    # long-running jobs (see /jobs) run in separate worker processes
+    if JOB_WORKERS > 0:
+        app.job_workers = start_workers(DB_URI, JOB_WORKERS)
+
     return app
 
 
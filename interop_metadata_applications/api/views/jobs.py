@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+
+import flask
+from flask import Blueprint, jsonify, request
+from flask_api import status
+
+from interop_metadata_applications.jobs import JobQueue, register_job, FINISHED, SUCCEEDED, JOB_HANDLERS
+from interop_metadata_applications.api.views.transform import (
+    run_transform,
+    run_afxml_export,
+    pi_af_config,
+)
+from interop_metadata_applications.api.views.model_generation import run_model_generation
+from interop_metadata_applications.api.views.manifest_generation import run_manifest_generation
+
+logger = logging.getLogger(__name__)
+blueprint = Blueprint("jobs", __name__)
+
+# kind -> (required files, required form fields), checked when the job is submitted
+REQUIRED_INPUTS = {
+    "transform": (["rulesJson"], ["modelID"]),
+    "afxml": (["rulesJson"], ["modelID"]),
+    "model-generation": (["file"], []),
+    "manifest-generation": (["file"], ["modelId", "namespace"]),
+}
+
+# an event stream never waits for new events, so it does not hold up the server: it ends after the
+# events so far and EventSource clients reconnect after this many milliseconds with Last-Event-ID
+EVENT_STREAM_RETRY = int(os.getenv("EVENT_STREAM_RETRY", "1000"))
+
+_queue = None
+
+
+def get_queue() -> JobQueue:
+    global _queue
+    if _queue is None:
+        _queue = JobQueue()
+    return _queue
+
+
+def _json_result(result) -> tuple:
+    return json.dumps(result, default=str).encode("utf-8"), "application/json", None
+
+
+@register_job("transform")
+def transform_job(job, params, files):
+    results, _ = run_transform(
+        int(params["modelID"]),
+        json.loads(files["rulesJson"]),
+        engine=params.get("engine") or "sparql",
+        closures=params.get("closures") == "true",
+        use_cache=params.get("cache") != "false",
+        checkpoint=job.check_cancelled,
+        progress=job.progress,
+        full=params.get("results") == "full",
+    )
+    return _json_result(results)
+
+
+@register_job("afxml")
+def afxml_job(job, params, files):
+    pi_server = params.get("piServer") or params.get("server")
+    pi_database = params.get("piDatabase") or params.get("database")
+    if not pi_server or not pi_database:
+        raise ValueError("piServer and piDatabase are required")
+    pi_config = pi_af_config(pi_server, pi_database, params.get("piExportPath"), params.get("piImportPath"))
+    chunks, _ = run_afxml_export(
+        int(params["modelID"]),
+        json.loads(files["rulesJson"]),
+        pi_config,
+        engine=params.get("engine") or "sparql",
+        closures=params.get("closures") == "true",
+        use_cache=params.get("cache") != "false",
+        checkpoint=job.check_cancelled,
+        progress=job.progress,
+        templates=params.get("templates") == "true",
+    )
+    with job.progress.stage("serialization"):
+        xml_bytes = b"".join(chunks)
+    return xml_bytes, "application/xml; charset=utf-8", "rules.afxml"
+
+
+@register_job("model-generation")
+def model_generation_job(job, params, files):
+    parser_source = files.get("parser")
+    with job.progress.stage("model generation"):
+        result = run_model_generation(
+            files["file"].decode("utf-8"),
+            parser_source.decode("utf-8") if parser_source else None,
+            params.get("name"),
+            params.get("description"),
+        )
+    return _json_result(result)
+
+
+@register_job("manifest-generation")
+def manifest_generation_job(job, params, files):
+    with job.progress.stage("manifest generation"):
+        result = run_manifest_generation(files["file"].decode("utf-8"), params["modelId"], params["namespace"])
+    return _json_result(result)
+
+
+@blueprint.route("/<kind>", methods=(["POST"]))
+def submit_job(kind: str) -> flask.Response:
+    """
+    Queues a job. Takes the same multipart form as the synchronous endpoint
+    (/transform, /transform/afxml, /model-generation or /manifest-generation).
+    """
+    if kind not in JOB_HANDLERS:
+        return jsonify({"error": f"Unknown job kind {kind}", "kinds": sorted(JOB_HANDLERS)}), status.HTTP_404_NOT_FOUND
+    required_files, required_fields = REQUIRED_INPUTS.get(kind, ([], []))
+    missing = [f for f in required_files if f not in request.files] + [
+        f for f in required_fields if not request.form.get(f)
+    ]
+    if missing:
+        return jsonify({"error": f"Missing required inputs: {', '.join(missing)}"}), status.HTTP_400_BAD_REQUEST
+
+    params = request.form.to_dict()
+    files = {field: f.read() for field, f in request.files.items()}
+    job_id = get_queue().submit(kind, params, files)
+    logger.info(f"Queued {kind} job {job_id}")
+    return jsonify({"job_id": job_id, "status": "queued"}), status.HTTP_202_ACCEPTED
+
+
+@blueprint.route("/<job_id>", methods=(["GET"]))
+def job_status(job_id: str) -> flask.Response:
+    job = get_queue().status(job_id)
+    if job is None:
+        return jsonify({"error": f"No job {job_id}"}), status.HTTP_404_NOT_FOUND
+    return jsonify(job), status.HTTP_200_OK
+
+
+@blueprint.route("/<job_id>/result", methods=(["GET"]))
+def job_result(job_id: str) -> flask.Response:
+    row = get_queue().result(job_id)
+    if row is None:
+        return jsonify({"error": f"No job {job_id}"}), status.HTTP_404_NOT_FOUND
+    if row["status"] not in FINISHED:
+        return jsonify({"job_id": job_id, "status": row["status"]}), status.HTTP_409_CONFLICT
+    if row["status"] != SUCCEEDED:
+        return jsonify({"job_id": job_id, "status": row["status"], "error": row["error"]}), status.HTTP_409_CONFLICT
+
+    resp = flask.Response(response=row["result"], content_type=row["content_type"])
+    if row["filename"]:
+        resp.headers["Content-Disposition"] = f'attachment; filename="{row["filename"]}"'
+        resp.headers["Access-Control-Expose-Headers"] = "Content-Disposition"
+    return resp, status.HTTP_200_OK
+
+
+@blueprint.route("/<job_id>/events", methods=(["GET"]))
+def job_events(job_id: str) -> flask.Response:
+    """
+    Progress events of a job (stage start/progress/end with item counts and elapsed
+    times) after the 'after' sequence number, as NDJSON; clients poll with the last
+    seq they got. With 'Accept: text/event-stream' the same events are sent as
+    server-sent events, followed by a 'finished' event once the job is done; the
+    stream ends right away and EventSource reconnects with Last-Event-ID.
+    """
+    queue = get_queue()
+    if queue.status(job_id) is None:
+        return jsonify({"error": f"No job {job_id}"}), status.HTTP_404_NOT_FOUND
+    after = int(request.headers.get("Last-Event-ID") or request.args.get("after") or 0)
+
+    if request.accept_mimetypes.best == "text/event-stream":
+        def stream():
+            # the status is read first, so a finished job's events are all in the list below
+            job_status = queue.status(job_id)["status"]
+            yield f"retry: {EVENT_STREAM_RETRY}\n\n"
+            for seq, event in queue.events(job_id, after):
+                yield f"id: {seq}\ndata: {json.dumps(event)}\n\n"
+            if job_status in FINISHED:
+                yield f"event: finished\ndata: {json.dumps({'job_id': job_id, 'status': job_status})}\n\n"
+        return flask.Response(stream(), content_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    def lines():
+        for seq, event in queue.events(job_id, after):
+            yield json.dumps({"seq": seq, **event}) + "\n"
+    return flask.Response(lines(), content_type="application/x-ndjson")
+
+
+@blueprint.route("/<job_id>/cancel", methods=(["POST"]))
+def cancel_job(job_id: str) -> flask.Response:
+    job_status = get_queue().cancel(job_id)
+    if job_status is None:
+        return jsonify({"error": f"No job {job_id}"}), status.HTTP_404_NOT_FOUND
+    return jsonify({"job_id": job_id, "status": job_status}), status.HTTP_200_OK
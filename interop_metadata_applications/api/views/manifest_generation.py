@@ -10,18 +10,14 @@ from buildingmotif import get_building_motif
 
 blueprint = Blueprint("manifest-generation", __name__)
 
-@blueprint.route("", methods=(["POST"]))
-def generate_manifest() -> flask.Response:
-    equipment_schedule_file = request.files.get("file")
-    model_id = request.form.get("modelId")
-    namespace = request.form.get("namespace")
-
-    if not equipment_schedule_file or not model_id or not namespace:
-        return "Missing equipment schedule file or model ID or namespace", status.HTTP_400_BAD_REQUEST
-
+def run_manifest_generation(equipment_schedule: str, model_id, namespace: str) -> dict:
+    """
+    Builds a manifest from an equipment schedule CSV, stores it as a ShapeCollection
+    and makes it the manifest of the model. Returns the /manifest-generation response body.
+    """
     ontology_location = "https://brickschema.org/schema/1.4/Brick.ttl"
     brick = Ontology(ontology_location)
-    equipment_schedule = csv.DictReader(StringIO(equipment_schedule_file.read().decode("utf-8")))
+    equipment_schedule = csv.DictReader(StringIO(equipment_schedule))
 
     # get the class for each equipment in the schedule
     manifest_builder = ManifestBuilder(brick, equipment_schedule)
@@ -39,4 +35,19 @@ def generate_manifest() -> flask.Response:
     model.update_manifest(sc)
     get_building_motif().session.commit()
 
-    return jsonify({"modelID": model_id, "manifest": manifest.serialize(format="ttl")}), status.HTTP_200_OK
+    return {"modelID": model_id, "manifest": manifest.serialize(format="ttl")}
+
+
+@blueprint.route("", methods=(["POST"]))
+def generate_manifest() -> flask.Response:
+    equipment_schedule_file = request.files.get("file")
+    model_id = request.form.get("modelId")
+    namespace = request.form.get("namespace")
+
+    if not equipment_schedule_file or not model_id or not namespace:
+        return "Missing equipment schedule file or model ID or namespace", status.HTTP_400_BAD_REQUEST
+
+    result = run_manifest_generation(
+        equipment_schedule_file.read().decode("utf-8"), model_id, namespace
+    )
+    return jsonify(result), status.HTTP_200_OK
@@ -20,19 +20,22 @@ blueprint = Blueprint("model-generation", __name__)
 
 # TODO: do we create a new endpoint which retrieves a list of all templates? can we use the existing bmotif stuff?
 
-@blueprint.route("", methods=(["POST"]))
-def generate_model() -> flask.Response:
-    pointlist = request.files.get("file")
-    if not pointlist:
-        return "No file provided", status.HTTP_400_BAD_REQUEST
-    source = CSVIngress(data=pointlist.read().decode("utf-8"))
+class ModelGenerationError(Exception):
+    """The point list could not be turned into a model (e.g. template synthesis failed)"""
+
+
+def run_model_generation(pointlist: str, parser_source=None, model_name=None, model_desc=None) -> dict:
+    """
+    Builds a model graph from a point list CSV using the label parser defined by
+    parser_source (JSON-encoded Python source defining 'my_parser'). Returns the
+    /model-generation response body.
+    """
+    source = CSVIngress(data=pointlist)
     logger.info(f"source: {source}")
-    logger.info(f"parser: {request.files}")
     #label_parser = O27_label_parser # arbitrary default
-    parser_source = request.files.get("parser")
     print(f"parser_source: {parser_source}")
     if parser_source:
-        parser_source = json.loads(parser_source.read().decode("utf-8"))
+        parser_source = json.loads(parser_source)
         logging.info(f"{parser_source}")
         # exec the parser source code and get the 'my_parser' variable
         loc = {}
@@ -73,7 +76,7 @@ def generate_model() -> flask.Response:
     except Exception as e:
         logger.error(f"Error: {e}")
         logger.error(traceback.format_exc())
-        return str(e), status.HTTP_500_INTERNAL_SERVER_ERROR
+        raise ModelGenerationError(str(e)) from e
     BLDG = Namespace("http://example.org/building#")
     logger.info(f"sgs: {sgs.graph(BLDG).serialize()}")
     #model.add_graph(sgs.graph(BLDG))
@@ -96,13 +99,6 @@ def generate_model() -> flask.Response:
             graph.remove((s, p, o))
 
     # Ensure the graph declares an owl:Ontology with optional label/description
-    try:
-        model_name = request.form.get("name")
-        model_desc = request.form.get("description")
-    except Exception:
-        model_name = None
-        model_desc = None
-
     if not any(graph.triples((None, RDF.type, OWL.Ontology))):
         ontology_subject = BLDG["ontology"]
         graph.add((ontology_subject, RDF.type, OWL.Ontology))
@@ -132,5 +128,24 @@ def generate_model() -> flask.Response:
         unmatched_suffixes[suffix].append(failure)
 
 
-    return jsonify({'model': graph.serialize(), 'errors': errors, 'unmatched_suffixes': unmatched_suffixes}), status.HTTP_200_OK
+    return {'model': graph.serialize(), 'errors': errors, 'unmatched_suffixes': unmatched_suffixes}
+
+
+@blueprint.route("", methods=(["POST"]))
+def generate_model() -> flask.Response:
+    pointlist = request.files.get("file")
+    if not pointlist:
+        return "No file provided", status.HTTP_400_BAD_REQUEST
+    logger.info(f"parser: {request.files}")
+    parser_source = request.files.get("parser")
+    try:
+        result = run_model_generation(
+            pointlist.read().decode("utf-8"),
+            parser_source.read().decode("utf-8") if parser_source else None,
+            request.form.get("name"),
+            request.form.get("description"),
+        )
+    except ModelGenerationError as e:
+        return str(e), status.HTTP_500_INTERNAL_SERVER_ERROR
+    return jsonify(result), status.HTTP_200_OK
 
@@ -9,18 +9,33 @@ from flask_api import status
 
 from buildingmotif import get_building_motif
 from buildingmotif.dataclasses import Model, Library, ShapeCollection
-from buildingmotif.exports.brick2af.validation import (
-    apply_rules_to_model,
+from interop_metadata_applications.a import (
     get_model_diffs,
     get_report,
 )
+from interop_metadata_applications.model_cache import compiled_model
+from interop_metadata_applications.rule_cache import cached_apply_rules, cache_header
+from interop_metadata_applications.utils import graph_fingerprint
+from interop_metadata_applications.validation_cache import library_fingerprint_scope
+from interop_metadata_applications.progress import Progress
+from interop_metadata_applications.results_store import ResultStore
+from interop_metadata_applications.outcomes_store import write_outcomes, query_outcomes, OUTCOME_COLUMNS
 from buildingmotif.exports.brick2af.utils import generate_manifest
-from buildingmotif.exports.brick2af.ttl_to_af import Translator
+from interop_metadata_applications.ttl_to_af import Translator
 import importlib.resources as importlib_resources
 
 logger = logging.getLogger(__name__)
 blueprint = Blueprint("transform", __name__)
 
+_result_store = None
+
+
+def get_result_store() -> ResultStore:
+    global _result_store
+    if _result_store is None:
+        _result_store = ResultStore()
+    return _result_store
+
 
 @blueprint.route("/manifest/rules", methods=(["POST"]))
 def create_manifest() -> flask.Response:
@@ -52,33 +67,68 @@ def create_manifest() -> flask.Response:
         ), status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
-@blueprint.route("", methods=(["POST"]))
-def apply_rules() -> flask.Response:
-    # get files
-    # TODO: create manifest from rules file. Use the code from my original transform.py
-    rules_json = request.files.get("rulesJson")
-    modelID = int(request.form.get("modelID"))
-
-    pre_compiled_model = Model.load(id=modelID)
-    model = pre_compiled_model.compile()
-
-    # parse rules JSON
-    rules = json.load(rules_json)
-    logger.info("Loaded rules JSON for apply_rules")
+# the manifest's libraries are hashed once for the compiled-model and validation caches
+@library_fingerprint_scope()
+def run_transform(model_id: int, rules: dict, engine="sparql", closures=False, use_cache=True, checkpoint=None, progress=None, full=False):
+    """
+    Compiles the model, applies the rules and validates it. Returns (results, rule_cache_hit)
+    where results is the /transform response body. checkpoint, if given, is called
+    between stages (background jobs use it to stop cancelled runs); each stage is
+    reported to progress. The results are stored as a run (see results_store) and the
+    body only carries the run id and totals; with full=True it also carries the report
+    and every result, as before paging.
+    """
+    checkpoint = checkpoint or (lambda: None)
+    progress = progress or Progress()
+    with progress.stage("compile"):
+        model = compiled_model(Model.load(id=model_id))
+        # the rule, closure and validation caches are all keyed by the compiled graph
+        fingerprint = graph_fingerprint(model.graph)
+    checkpoint()
 
     # Apply rules and get diffset
     logger.info(f"Applying rules {rules} to model {model}")
-    successful_rules = apply_rules_to_model(model, rules)
+    rule_stats = {}
+    successful_rules, rule_cache_hit = cached_apply_rules(
+        model,
+        rules,
+        engine=engine,
+        closures=closures,
+        stats=rule_stats,
+        use_cache=use_cache,
+        progress=progress,
+        fingerprint=fingerprint,
+    )
     logger.info("Successfully configured rules (bindings): %s", successful_rules)
+    checkpoint()
     logger.info(f"Applied rules to model {model}. Grouping diffs")
-    grouped_diffs, context = get_model_diffs(model)
-    logger.info(f"REPORT {context.report.serialize()}")
-    logger.info(f"Grouped diffs {grouped_diffs}")
-    report = get_report(grouped_diffs, successful_rules)
+    grouped_diffs, context = get_model_diffs(model, use_cache=use_cache, progress=progress, fingerprint=fingerprint)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"REPORT {context.report.serialize()}")
+    logger.debug("Grouped diffs %s", grouped_diffs)
+    checkpoint()
+    with progress.stage("report", total=len(grouped_diffs)):
+        report = get_report(grouped_diffs, successful_rules)
+
+    run_id = get_result_store().save_run(
+        model_id,
+        successful_rules,
+        grouped_diffs,
+        report=report,
+        rules_evaluated=rule_stats["evaluated"],
+        rules_skipped=rule_stats["skipped"],
+    )
+    # the same outcomes, appended to the Parquet dataset that /transform/outcomes aggregates
+    write_outcomes(run_id, model_id, successful_rules, grouped_diffs)
+    if not full:
+        return get_result_store().run(run_id), rule_cache_hit
 
     # Format results
     results = {
+        "run_id": run_id,
         "report": report,
+        "rules_evaluated": rule_stats["evaluated"],
+        "rules_skipped": rule_stats["skipped"],
         "results": [
             {
                 "rule": rule,
@@ -100,15 +150,186 @@ def apply_rules() -> flask.Response:
             for focus_node, details in i.items()
         ],
     }
+    return results, rule_cache_hit
+
+
+@blueprint.route("", methods=(["POST"]))
+def apply_rules() -> flask.Response:
+    # get files
+    # TODO: create manifest from rules file. Use the code from my original transform.py
+    rules_json = request.files.get("rulesJson")
+    modelID = int(request.form.get("modelID"))
+
+    # parse rules JSON
+    rules = json.load(rules_json)
+    logger.info("Loaded rules JSON for apply_rules")
+
+    results, rule_cache_hit = run_transform(
+        modelID,
+        rules,
+        engine=request.form.get("engine") or "sparql",
+        closures=request.form.get("closures") == "true",
+        use_cache=request.form.get("cache") != "false",
+        full=request.form.get("results") == "full",
+    )
+
+    resp = jsonify(results)
+    resp.headers["X-Rule-Cache"] = cache_header(rule_cache_hit)
+    resp.headers["Access-Control-Expose-Headers"] = "X-Rule-Cache"
+    return resp, status.HTTP_200_OK
 
-    return jsonify(results), status.HTTP_200_OK
+
+@blueprint.route("/runs/<run_id>", methods=(["GET"]))
+def get_run(run_id: str) -> flask.Response:
+    """Totals of a stored /transform run, with succeeded/failed counts per rule"""
+    run = get_result_store().run(run_id)
+    if run is None:
+        return jsonify({"error": f"No run {run_id}"}), status.HTTP_404_NOT_FOUND
+    return jsonify(run), status.HTTP_200_OK
+
+
+@blueprint.route("/runs/<run_id>/results", methods=(["GET"]))
+def get_run_results(run_id: str) -> flask.Response:
+    """
+    One page of a run's results. Query parameters: rule (or shape), focus_node,
+    success (true/false), offset and limit.
+    """
+    store = get_result_store()
+    if store.run(run_id) is None:
+        return jsonify({"error": f"No run {run_id}"}), status.HTTP_404_NOT_FOUND
+    success = request.args.get("success")
+    try:
+        page = store.results(
+            run_id,
+            rule=request.args.get("rule") or request.args.get("shape"),
+            focus_node=request.args.get("focus_node"),
+            success=None if success is None else success == "true",
+            offset=int(request.args.get("offset", 0)),
+            limit=int(request.args.get("limit", 100)),
+        )
+    except ValueError as e:
+        return jsonify({"error": "offset and limit must be integers", "details": str(e)}), status.HTTP_400_BAD_REQUEST
+    return jsonify(page), status.HTTP_200_OK
+
+
+@blueprint.route("/outcomes", methods=(["GET"]))
+def get_outcomes() -> flask.Response:
+    """
+    Aggregates rule and validation outcomes across all stored runs. Query parameters:
+    group_by (comma-separated outcome columns, default 'rule,status'), one filter per
+    outcome column (run, model, rule, focus_node, status, reason), latest=true to only
+    count the most recent run of each model, and limit.
+    """
+    group_by = [c for c in request.args.get("group_by", "rule,status").split(",") if c]
+    filters = {c: request.args[c] for c in OUTCOME_COLUMNS if c in request.args}
+    try:
+        if "model" in filters:
+            filters["model"] = int(filters["model"])
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+        groups = query_outcomes(group_by, filters, latest=request.args.get("latest") == "true", limit=limit)
+    except ValueError as e:
+        return jsonify({"error": "Invalid outcomes query", "details": str(e)}), status.HTTP_400_BAD_REQUEST
+    return jsonify({"group_by": group_by, "groups": groups}), status.HTTP_200_OK
+
+
+@blueprint.route("/runs/<run_id>/report", methods=(["GET"]))
+def get_run_report(run_id: str) -> flask.Response:
+    """The markdown report of a run"""
+    report = get_result_store().report(run_id)
+    if report is None:
+        return jsonify({"error": f"No run {run_id}"}), status.HTTP_404_NOT_FOUND
+    return flask.Response(report, content_type="text/markdown; charset=utf-8"), status.HTTP_200_OK
+
+
+class _TranslatorWithConfig(Translator):
+    """Translator that takes its PI AF config from a dict instead of pi_config.json"""
+
+    def __init__(self, config: dict):
+        self._dynamic_config = config
+        super().__init__()
+
+    def read_config_file(self, path=None):
+        # Inject dynamic config and set expected attributes used by base Translator
+        cfg = self._dynamic_config or {}
+        self.config = cfg
+        # Core PI AF connection attributes expected by ttl_to_af.Translator
+        self.defaultserver = cfg.get("server", getattr(self, "defaultserver", None))
+        self.defaultdatabase = cfg.get(
+            "database", getattr(self, "defaultdatabase", None)
+        )
+        if self.defaultserver and self.defaultdatabase:
+            # UNC-style default URI: \\SERVER\DATABASE
+            self.defaulturi = f"\\\\{self.defaultserver}\\{self.defaultdatabase}"
+        # Optional paths and units mapping
+        self.piimportpath = cfg.get("piimportpath", getattr(self, "piimportpath", None))
+        self.piexportpath = cfg.get("piexportpath", getattr(self, "piexportpath", None))
+        self.units = {**self.DEFAULT_UNITS, **cfg.get("units", {})}
+
+
+def pi_af_config(pi_server, pi_database, pi_export_path=None, pi_import_path=None) -> dict:
+    """PI AF config for the export, with the units mapping from the package's sample config"""
+    try:
+        with (
+            importlib_resources.files("buildingmotif.exports.brick2af")
+            .joinpath("pi_config.json")
+            .open("r", encoding="utf-8") as f
+        ):
+            default_config = json.load(f)
+    except Exception:
+        default_config = {"units": {}}
+
+    pi_config = {
+        "server": pi_server,
+        "database": pi_database,
+        "units": default_config.get("units", {}),
+    }
+    if pi_export_path:
+        pi_config["piexportpath"] = pi_export_path
+    if pi_import_path:
+        pi_config["piimportpath"] = pi_import_path
+    return pi_config
+
+
+def run_afxml_export(model_id: int, rules: dict, pi_config: dict, engine="sparql", closures=False, use_cache=True, checkpoint=None, progress=None, templates=False):
+    """
+    Builds the AF tree for the rules on the model, with element templates if templates
+    (see Translator.build_af_tree). Returns (chunks, rule_cache_hit) where chunks is an
+    iterator over the serialized AFXML document.
+    """
+    checkpoint = checkpoint or (lambda: None)
+    progress = progress or Progress()
+    # Load and compile model (shared with /transform through the compiled model cache)
+    with progress.stage("compile"):
+        model = compiled_model(Model.load(id=model_id))
+    checkpoint()
+
+    # Determine valid rules (success cases) for the model; usually cached by /transform
+    successful_rules, rule_cache_hit = cached_apply_rules(
+        model,
+        rules,
+        engine=engine,
+        closures=closures,
+        use_cache=use_cache,
+        progress=progress,
+    )
+    logger.info("Successfully configured rules (bindings): %s", successful_rules)
+    checkpoint()
+
+    # Plan the AF tree with this package's Translator and the dynamic PI config (no
+    # subprocess, no chdir); its elements are built as the document is written
+    with progress.stage("afxml"):
+        translator = _TranslatorWithConfig(pi_config)
+        translator.add_rules_from_dict(rules, successful_rules)
+        translator.graph = model.graph
+        chunks = translator.iter_af_xml(templates)
+    return chunks, rule_cache_hit
 
 
 @blueprint.route("/afxml", methods=(["POST"]))
 def export_afx_xml() -> flask.Response:
     """
     Generate an AFXML export for the uploaded rules JSON and selected model.
-    Returns the AFXML as an application/xml attachment without writing persistent files.
+    Streams the AFXML as an application/xml attachment without writing persistent files.
     """
     try:
         rules_file = request.files.get("rulesJson")
@@ -121,10 +342,6 @@ def export_afx_xml() -> flask.Response:
 
         model_id = int(model_id_raw)
 
-        # Load and compile model
-        pre_compiled_model = Model.load(id=model_id)
-        model = pre_compiled_model.compile()
-
         # Parse rules JSON
         try:
             rules = json.load(rules_file)
@@ -137,81 +354,34 @@ def export_afx_xml() -> flask.Response:
         # Gather PI AF config inputs from form
         pi_server = request.form.get("piServer") or request.form.get("server")
         pi_database = request.form.get("piDatabase") or request.form.get("database")
-        pi_export_path = request.form.get("piExportPath")
-        pi_import_path = request.form.get("piImportPath")
 
         if not pi_server or not pi_database:
             return jsonify(
                 {"error": "piServer and piDatabase are required"}
             ), status.HTTP_400_BAD_REQUEST
 
-        # Load default units mapping from the package's sample config
-        try:
-            with (
-                importlib_resources.files("buildingmotif.exports.brick2af")
-                .joinpath("pi_config.json")
-                .open("r", encoding="utf-8") as f
-            ):
-                default_config = json.load(f)
-        except Exception:
-            default_config = {"units": {}}
-
-        pi_config = {
-            "server": pi_server,
-            "database": pi_database,
-            "units": default_config.get("units", {}),
-        }
-        if pi_export_path:
-            pi_config["piexportpath"] = pi_export_path
-        if pi_import_path:
-            pi_config["piimportpath"] = pi_import_path
-
-        # Determine valid rules (success cases) for the model
-        successful_rules = apply_rules_to_model(model, rules)
-        logger.info("Successfully configured rules (bindings): %s", successful_rules)
-        valid_rules = successful_rules
-
-        # Build AF XML using object-based API and dynamic PI config (no subprocess, no chdir)
-        class _TranslatorWithConfig(Translator):
-            def __init__(self, config: dict):
-                self._dynamic_config = config
-                super().__init__()
-
-            def read_config_file(self):
-                # Inject dynamic config and set expected attributes used by base Translator
-                cfg = self._dynamic_config or {}
-                self.config = cfg
-                # Core PI AF connection attributes expected by ttl_to_af.Translator
-                self.defaultserver = cfg.get(
-                    "server", getattr(self, "defaultserver", None)
-                )
-                self.defaultdatabase = cfg.get(
-                    "database", getattr(self, "defaultdatabase", None)
-                )
-                if self.defaultserver and self.defaultdatabase:
-                    # UNC-style default URI: \\SERVER\DATABASE
-                    self.defaulturi = (
-                        f"\\\\{self.defaultserver}\\{self.defaultdatabase}"
-                    )
-                # Optional paths and units mapping
-                self.piimportpath = cfg.get(
-                    "piimportpath", getattr(self, "piimportpath", None)
-                )
-                self.piexportpath = cfg.get(
-                    "piexportpath", getattr(self, "piexportpath", None)
-                )
-                self.units = cfg.get("units", getattr(self, "units", {}))
-
-        translator = _TranslatorWithConfig(pi_config)
-        translator.add_rules_from_dict(rules, valid_rules)
-        af_obj = translator.create_af_tree_from_model(model)
-        xml_bytes = str(af_obj).encode("utf-8")
+        pi_config = pi_af_config(
+            pi_server,
+            pi_database,
+            request.form.get("piExportPath"),
+            request.form.get("piImportPath"),
+        )
+        chunks, rule_cache_hit = run_afxml_export(
+            model_id,
+            rules,
+            pi_config,
+            engine=request.form.get("engine") or "sparql",
+            closures=request.form.get("closures") == "true",
+            use_cache=request.form.get("cache") != "false",
+            templates=request.form.get("templates") == "true",
+        )
 
         resp = flask.Response(
-            response=xml_bytes, content_type="application/xml; charset=utf-8"
+            response=chunks, content_type="application/xml; charset=utf-8"
         )
         resp.headers["Content-Disposition"] = 'attachment; filename="rules.afxml"'
-        resp.headers["Access-Control-Expose-Headers"] = "Content-Disposition"
+        resp.headers["X-Rule-Cache"] = cache_header(rule_cache_hit)
+        resp.headers["Access-Control-Expose-Headers"] = "Content-Disposition, X-Rule-Cache"
         return resp, status.HTTP_200_OK
 
     except Exception as e:
@@ -1,6 +1,5 @@
 import argparse
 import logging
-from copy import deepcopy
 import json
 import re
 from collections import defaultdict
@@ -9,7 +8,7 @@ from buildingmotif import BuildingMOTIF
 from buildingmotif.dataclasses import Model, Library, ShapeCollection
 from buildingmotif.namespaces import SH, BRICK
 from rdflib import Namespace, URIRef
-from interop_metadata_applications.transform import definition_to_sparql
+from interop_metadata_applications.transform import rule_bindings, shape_parent_index, resolve_original_shape
 
 logger = logging.getLogger(__name__)
 
@@ -17,88 +16,16 @@ def find_original_shape(model, shape_uri: URIRef) -> URIRef:
     """
     From the given property or node shape URI, find *users* of the URI
     until we find the original shape. Users of the URI can be related to this
-    URI through sh:property or sh:node.
+    URI through sh:property, sh:node or an sh:or/sh:and/sh:xone list.
     """
-    original_shape = shape_uri
-    while True:
-        query = f"""
-            SELECT ?shape WHERE {{
-                ?shape (sh:or|sh:and|sh:xone)?/sh:property|sh:node {original_shape.n3()} .
-            }}
-        """
-        res = model.get_manifest().graph.query(query)
-        if len(res) == 0:
-            break
-        original_shape = list(res)[0][0]
-    return original_shape
+    index = shape_parent_index(model.get_manifest().graph)
+    return resolve_original_shape(index, shape_uri)
 
-def generate_markdown_report(grouped_diffs: defaultdict, successful_rules: defaultdict, output_path: str):
-    def format_reason(reason):
-        url_pattern = re.compile(r'(http?://[^\s]+)')
-        namespace_pattern = re.compile(r'(\w+:\w+)')
-        formatted_reason = url_pattern.sub(r'\1', reason)
-        formatted_reason = namespace_pattern.sub(r'\1', formatted_reason)
-        return formatted_reason
-
-    def format_successful_rules(successful_rules):
-        formatted = ""
-        for rule, focus_nodes in successful_rules.items():
-            if len(focus_nodes) == 0:
-                continue
-            formatted += f"## {rule}\n\n"
-            formatted += "### Equipment and Point Names\n\n"
-            for focus_node, entries in focus_nodes.items():
-                if len(entries) == 0:
-                    continue
-                entry_dict = {str(k): str(v) for k, v in entries.items()}
-                formatted += f"- **Equipment**: {focus_node}\n"
-                for k, v in entry_dict.items():
-                    formatted += f"  - {k}: {v}\n"
-                #formatted += f"  - Points: {', '.join(entry_dict.values())}\n\n"
-        return formatted
-
-    def format_unsuccessful_rules(grouped_diffs):
-        formatted = ""
-        for focus_node, reasons in grouped_diffs.items():
-            formatted += f"## {focus_node}\n\n"
-            formatted += "### Reasons for Failure\n\n"
-            logger.debug(f"Focus Node: {json.dumps(reasons, indent=4)}")
-            for focus_node, entries in reasons.items():
-                formatted += f"- **Equipment**: {focus_node}\n"
-                for reason in entries:
-                    if 'missing point' in format_reason(reason) or 'BRICK attribute' in format_reason(reason):
-                        formatted += f"\t- **Reason**: {format_reason(reason)}\n\n"
-                    else:
-                        formatted += f"\t- **Reason**: {reason}\n\n"
-        return formatted
-
-    def generate_summary(successful_rules, grouped_diffs):
-        total_successful = len(successful_rules)
-        total_failed = len(grouped_diffs)
-        return f"# Summary\n\n- Total Successful Rules: {total_successful}\n- Total Failed Rules: {total_failed}\n\n"
-
-    summary = generate_summary(successful_rules, grouped_diffs)
-    successful_rules_section = format_successful_rules(successful_rules)
-    unsuccessful_rules_section = format_unsuccessful_rules(grouped_diffs)
-
-    markdown_content = f'''
-{summary}
-## Detailed Successful Rules
-{successful_rules_section}
-
-## Detailed Unsuccessful Rules
-{unsuccessful_rules_section}
-'''
-
-    if output_path != '':
-        with open(output_path, 'w') as file:
-            file.write(markdown_content)
-        return None
-    else:
-        return markdown_content
+# regexes used by the HTML report to highlight URLs and prefixed names in failure reasons
+URL_PATTERN = re.compile(r'(https?://[^\s]+)')
+NAMESPACE_PATTERN = re.compile(r'(\w+:\w+)')
 
-def generate_html_report(grouped_diffs: defaultdict, successful_rules: defaultdict, output_path: str):
-    html_template = """
+HTML_TEMPLATE = """
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -106,29 +33,29 @@ def generate_html_report(grouped_diffs: defaultdict, successful_rules: defaultdi
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Validation Report</title>
     <style>
-        body {{ font-family: Arial, sans-serif; background-color: #f4f4f4; }}
-        h2, h3 {{ color: #333; }}
-        .accordion {{
+        body { font-family: Arial, sans-serif; background-color: #f4f4f4; }
+        h2, h3 { color: #333; }
+        .accordion {
             cursor: pointer; padding: 10px; width: 100%; text-align: left;
             border: none; background-color: #e2e2e2; margin-bottom: 5px; border-radius: 5px;
             transition: background-color 0.2s ease;
-        }}
-        .active, .accordion:hover {{ background-color: #ccc; }}
-        .panel {{
+        }
+        .active, .accordion:hover { background-color: #ccc; }
+        .panel {
             padding: 0 15px; display: none; background-color: white;
             border: 1px solid #ccc; margin-top: 5px; border-radius: 5px;
-        }}
-        ul {{ list-style-type: none; padding: 0; }}
-        li {{ padding: 5px; border-bottom: 1px solid #ddd; }}
-        .success {{
+        }
+        ul { list-style-type: none; padding: 0; }
+        li { padding: 5px; border-bottom: 1px solid #ddd; }
+        .success {
             background-color: #d4edda;
-        }}
-        .failed  {{
+        }
+        .failed  {
             background-color: #f8d7da;
-        }}
-        .some-success {{
+        }
+        .some-success {
             background-color: #fff3cd;
-        }}
+        }
     </style>
 </head>
 <body>
@@ -142,113 +69,134 @@ def generate_html_report(grouped_diffs: defaultdict, successful_rules: defaultdi
 {grouped_by_focus_node}
 
 <script>
-    document.addEventListener("DOMContentLoaded", () => {{
-        document.querySelectorAll(".accordion").forEach(btn => {{
-            btn.addEventListener("click", () => {{
+    document.addEventListener("DOMContentLoaded", () => {
+        document.querySelectorAll(".accordion").forEach(btn => {
+            btn.addEventListener("click", () => {
                 btn.classList.toggle("active");
                 const panel = btn.nextElementSibling;
                 panel.style.display = panel.style.display === "block" ? "none" : "block";
-            }});
-        }});
-    }});
+            });
+        });
+    });
 </script>
 
 </body>
 </html>
     """
+# the template is written around the two generated sections
+HTML_HEAD, _rest = HTML_TEMPLATE.split("{grouped_by_top_level}")
+HTML_MIDDLE, HTML_TAIL = _rest.split("{grouped_by_focus_node}")
 
 
-    def format_reason(reason):
-        url_pattern = re.compile(r'(https?://[^\s]+)')
-        namespace_pattern = re.compile(r'(\w+:\w+)')
-        formatted_reason = url_pattern.sub(r'<b><code>\1</code></b>', reason)
-        formatted_reason = namespace_pattern.sub(r'<b><code>\1</code></b>', formatted_reason)
-        return formatted_reason
-
-    def format_diffs(grouped_diffs, successful_rules):
-        formatted = ""
-
-        # Format successful rules
-        for rule, focus_nodes in successful_rules.items():
-            formatted += f"<button class='accordion success'>{rule}</button><div class='panel'><ul>"
-            for focus_node, entries in focus_nodes.items():
-                formatted += f"<li><button class='accordion success'>{focus_node}</button><div class='panel'><ul>"
-                entry_dict = {str(k): str(v) for k, v in entries.items()}
-                formatted += f"<li class='success'>{entry_dict}</li>"
-                formatted += "</ul></div></li>"
-            formatted += "</ul></div>"
-
-        # Format failed rules
-        for original_shape, focus_nodes in grouped_diffs.items():
-            formatted += f"<button class='accordion'>{original_shape} (failed assets)</button><div class='panel'><ul>"
-            for focus_node, reasons in focus_nodes.items():
-                formatted += f"<li><button class='accordion'>{focus_node}</button><div class='panel'><ul>"
-                for reason in reasons:
-                    formatted += f"<li>{format_reason(reason)}</li>"
-                formatted += "</ul></div></li>"
-            formatted += "</ul></div>"
-        return formatted
-
-    def format_by_focus_node(grouped_diffs, successful_rules):
-        focus_node_dict = defaultdict(dict)
-
-        # Build a dict for successful rules
-        for rule, focus_nodes in successful_rules.items():
-            for focus_node, entries in focus_nodes.items():
-                focus_node_dict[focus_node][rule] = {"entries": entries, "success": True}
-
-        with open("focusnode1.json", "w") as f:
-            json.dump(focus_node_dict, f, indent=4)
-
-        # Build a dict for failed rules
-        #print(grouped_diffs)
-        # NOTE: for some reason it seems like this loop is using the wrong name for a rule when it produces the output
-        for rule, focus_nodes in grouped_diffs.items():
-            for focus_node, reasons in focus_nodes.items():
-                focus_node_dict[focus_node][rule] = {"entries": reasons, "success": False}
-
-        with open("focusnode2.json", "w") as f:
-            json.dump(focus_node_dict, f, indent=4)
-
-        formatted = ""
-        # save focus node dict to a json file
-        with open("focus_node_dict.json", "w") as f:
-            json.dump(focus_node_dict, f, indent=4)
-        for focus_node, original_shape_dict in focus_node_dict.items():
-            all_successful = all(data['success'] for data in original_shape_dict.values())
-            none_successful = all(not data['success'] for data in original_shape_dict.values())
-            focus_node_success_class = " success" if all_successful else " failed" if none_successful else " some-success"
-
-            #print(focus_node, len(original_shape_dict))
-            formatted += f"<button class='accordion{focus_node_success_class}'>{focus_node}</button><div class='panel'><ul>"
-            for rule, data in original_shape_dict.items():
-                success_class = " success" if data['success'] else ""
-                formatted += f"<li><button class='accordion{success_class}'>{rule}</button><div class='panel'><ul>"
-                #print(f"focus_node: {focus_node} rule: {rule}")
-                reason_text = ""
-                # If the rule failed, the data['entries'] is a list of reasons. make it an unordered list
-                if not data['success']:
-                    reason_text += "<ul>"
-                    for reason in data['entries']:
-                        reason_text += f"<li>{format_reason(reason)}</li>"
-                    reason_text += "</ul>"
-                entry_dict = {str(k): str(v) for k, v in data['entries'].items()} if data['success'] else reason_text
-                entry_class = 'success' if data['success'] else 'failed'
-                formatted += f"<li class='{entry_class}'>{entry_dict}</li>"
-                formatted += "</ul></div></li>"
-            formatted += "</ul></div>"
-        return formatted
-
-    grouped_by_top_level = format_diffs(grouped_diffs, successful_rules)
-    grouped_by_focus_node = format_by_focus_node(grouped_diffs, successful_rules)
-
-    html_content = html_template.format(
-        grouped_by_top_level=grouped_by_top_level,
-        grouped_by_focus_node=grouped_by_focus_node
+def _write_report(chunks, output_path: str):
+    """Writes the chunks to output_path, or joins them into a string if output_path is ''"""
+    if output_path == '':
+        return "".join(chunks)
+    with open(output_path, 'w') as file:
+        file.writelines(chunks)
+    return None
+
+
+def markdown_report_chunks(grouped_diffs: defaultdict, successful_rules: defaultdict):
+    """Yields the markdown report piece by piece, so it can be written out without building it in memory"""
+    yield (
+        f"\n# Summary\n\n- Total Successful Rules: {len(successful_rules)}\n"
+        f"- Total Failed Rules: {len(grouped_diffs)}\n\n\n## Detailed Successful Rules\n"
     )
+    for rule, focus_nodes in successful_rules.items():
+        if len(focus_nodes) == 0:
+            continue
+        yield f"## {rule}\n\n### Equipment and Point Names\n\n"
+        for focus_node, entries in focus_nodes.items():
+            if len(entries) == 0:
+                continue
+            yield f"- **Equipment**: {focus_node}\n"
+            for k, v in entries.items():
+                yield f"  - {k}: {v}\n"
 
-    with open(output_path, 'w') as file:
-        file.write(html_content)
+    yield "\n\n## Detailed Unsuccessful Rules\n"
+    for original_shape, reasons in grouped_diffs.items():
+        yield f"## {original_shape}\n\n### Reasons for Failure\n\n"
+        for focus_node, entries in reasons.items():
+            yield f"- **Equipment**: {focus_node}\n"
+            for reason in entries:
+                yield f"\t- **Reason**: {reason}\n\n"
+    yield "\n"
+
+
+def generate_markdown_report(grouped_diffs: defaultdict, successful_rules: defaultdict, output_path: str):
+    return _write_report(markdown_report_chunks(grouped_diffs, successful_rules), output_path)
+
+
+def _format_reason_html(reason: str) -> str:
+    formatted_reason = URL_PATTERN.sub(r'<b><code>\1</code></b>', reason)
+    return NAMESPACE_PATTERN.sub(r'<b><code>\1</code></b>', formatted_reason)
+
+
+def _html_by_rule(grouped_diffs, successful_rules):
+    # successful rules
+    for rule, focus_nodes in successful_rules.items():
+        yield f"<button class='accordion success'>{rule}</button><div class='panel'><ul>"
+        for focus_node, entries in focus_nodes.items():
+            entry_dict = {str(k): str(v) for k, v in entries.items()}
+            yield (
+                f"<li><button class='accordion success'>{focus_node}</button><div class='panel'><ul>"
+                f"<li class='success'>{entry_dict}</li></ul></div></li>"
+            )
+        yield "</ul></div>"
+
+    # failed rules
+    for original_shape, focus_nodes in grouped_diffs.items():
+        yield f"<button class='accordion'>{original_shape} (failed assets)</button><div class='panel'><ul>"
+        for focus_node, reasons in focus_nodes.items():
+            yield f"<li><button class='accordion'>{focus_node}</button><div class='panel'><ul>"
+            for reason in reasons:
+                yield f"<li>{_format_reason_html(reason)}</li>"
+            yield "</ul></div></li>"
+        yield "</ul></div>"
+
+
+def _html_by_focus_node(grouped_diffs, successful_rules):
+    # focus node -> rule -> (entries, success); holds references only, the text is generated below
+    focus_node_dict = defaultdict(dict)
+    for rule, focus_nodes in successful_rules.items():
+        for focus_node, entries in focus_nodes.items():
+            focus_node_dict[focus_node][rule] = (entries, True)
+    # NOTE: for some reason it seems like this loop is using the wrong name for a rule when it produces the output
+    for rule, focus_nodes in grouped_diffs.items():
+        for focus_node, reasons in focus_nodes.items():
+            focus_node_dict[focus_node][rule] = (reasons, False)
+
+    for focus_node, rules in focus_node_dict.items():
+        all_successful = all(success for _, success in rules.values())
+        none_successful = not any(success for _, success in rules.values())
+        focus_node_success_class = " success" if all_successful else " failed" if none_successful else " some-success"
+        yield f"<button class='accordion{focus_node_success_class}'>{focus_node}</button><div class='panel'><ul>"
+        for rule, (entries, success) in rules.items():
+            if success:
+                yield (
+                    f"<li><button class='accordion success'>{rule}</button><div class='panel'><ul>"
+                    f"<li class='success'>{ {str(k): str(v) for k, v in entries.items()} }</li></ul></div></li>"
+                )
+            else:
+                yield f"<li><button class='accordion'>{rule}</button><div class='panel'><ul><li class='failed'><ul>"
+                for reason in entries:
+                    yield f"<li>{_format_reason_html(reason)}</li>"
+                yield "</ul></li></ul></div></li>"
+        yield "</ul></div>"
+
+
+def html_report_chunks(grouped_diffs: defaultdict, successful_rules: defaultdict):
+    """Yields the HTML report piece by piece, so it can be written out without building it in memory"""
+    yield HTML_HEAD
+    yield from _html_by_rule(grouped_diffs, successful_rules)
+    yield HTML_MIDDLE
+    yield from _html_by_focus_node(grouped_diffs, successful_rules)
+    yield HTML_TAIL
+
+
+def generate_html_report(grouped_diffs: defaultdict, successful_rules: defaultdict, output_path: str):
+    return _write_report(html_report_chunks(grouped_diffs, successful_rules), output_path)
 
 def main(manifest_ttl, model_ttl, rule_json, output_path, format):
     bm = BuildingMOTIF("sqlite://", shacl_engine="topquadrant")
@@ -271,32 +219,23 @@ def main(manifest_ttl, model_ttl, rule_json, output_path, format):
     model.update_manifest(manifest)
 
     successful_rules = defaultdict(lambda: defaultdict(dict))
-    # get the SPARQL query for each rule
+    # one SPARQL query per rule
     with open(rule_json, "r") as f:
         rules = json.load(f)
         for rule, defn in rules.items():
             rule = f"http://example.org/building#{rule}"
-            for classname in defn["applicability"]:
-                class_ = BRICK[classname]
-                for variable in defn["definitions"]:
-                    # this only queries for 1 variable
-                    query = definition_to_sparql(class_, defn["definitions"][variable], variable)
-                    results = model.graph.query(query)
-                    for row in results.bindings:
-                        inst = row['root']
-                        successful_rules[rule][inst].update(row)
-            # loop through all 'inst' for this rule. If the length of its dictionary == len(defn["definitions"]), then it's successful
-            for inst in deepcopy(successful_rules[rule]):
-                if len(successful_rules[rule][inst]) != len(defn["definitions"]) + 1: # +1 for the 'root' variable
-                    del successful_rules[rule][inst]
+            instances = successful_rules[rule]
+            for inst, row in rule_bindings(model.graph, defn).items():
+                instances[inst].update(row)
 
     res = model.validate(error_on_missing_imports=False)
     res.report.serialize("output.ttl", format="ttl")
 
+    shape_index = shape_parent_index(model.get_manifest().graph)
     grouped_diffs = defaultdict(lambda: defaultdict(list))
     for focus_node, diffs in res.diffset.items():
         for diff in diffs:
-            original_shape = find_original_shape(model, diff.failed_shape)
+            original_shape = resolve_original_shape(shape_index, diff.failed_shape)
             ## remove focus_node from the successful rules
             #if original_shape in successful_rules:
             #    if focus_node in successful_rules[original_shape]:
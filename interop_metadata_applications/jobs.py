@@ -0,0 +1,291 @@
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+import traceback
+import uuid
+from contextlib import closing, contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from interop_metadata_applications.progress import Progress
+
+logger = logging.getLogger(__name__)
+
+JOBS_DB = os.getenv("JOBS_DB", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+POLL_INTERVAL = 0.5
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = "queued", "running", "succeeded", "failed", "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    result BLOB,
+    content_type TEXT,
+    filename TEXT,
+    error TEXT,
+    worker INTEGER,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created);
+CREATE TABLE IF NOT EXISTS job_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, seq);
+CREATE TABLE IF NOT EXISTS job_files (
+    job_id TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    field TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (job_id, field)
+);
+"""
+
+# kind -> handler(job, params, files) returning (result bytes, content type, filename or None)
+JOB_HANDLERS: Dict[str, Callable[["JobContext", Dict[str, Any], Dict[str, bytes]], Tuple[bytes, str, Optional[str]]]] = {}
+
+
+def register_job(kind: str):
+    """Decorator that registers a handler for jobs of the given kind"""
+    def decorator(handler):
+        JOB_HANDLERS[kind] = handler
+        return handler
+    return decorator
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler when its job was cancelled while running"""
+
+
+class JobQueue:
+    """
+    Job queue in a SQLite database shared by the API process and the workers.
+    A job is 'queued' until a worker claims it, then 'running' and finally
+    'succeeded', 'failed' or 'cancelled'. Results stay in the database so
+    clients can fetch them whenever they poll.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or JOBS_DB
+        with self._transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        with closing(self._connect()) as conn, conn:
+            yield conn
+
+    def submit(self, kind: str, params: Dict[str, Any], files: Dict[str, bytes] = None) -> str:
+        if kind not in JOB_HANDLERS:
+            raise ValueError(f"Unknown job kind: {kind}. Please use one of {sorted(JOB_HANDLERS)}")
+        job_id = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, status, params, created) VALUES (?, ?, ?, ?, ?)",
+                (job_id, kind, QUEUED, json.dumps(params), time.time()),
+            )
+            conn.executemany(
+                "INSERT INTO job_files (job_id, field, data) VALUES (?, ?, ?)",
+                [(job_id, field, data) for field, data in (files or {}).items()],
+            )
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id, kind, status, cancel_requested, content_type, error, created, started, finished"
+                " FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def result(self, job_id: str) -> Optional[sqlite3.Row]:
+        with self._transaction() as conn:
+            return conn.execute(
+                "SELECT status, result, content_type, filename, error FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+
+    def cancel(self, job_id: str) -> Optional[str]:
+        """
+        Cancels a job. Queued jobs are cancelled right away; running jobs are flagged
+        and stop at their next checkpoint. Returns the job status afterwards.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED),
+            )
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, RUNNING),
+            )
+            row = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["status"] if row else None
+
+    def cancel_requested(self, job_id: str) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def add_event(self, job_id: str, event: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO job_events (job_id, event) VALUES (?, ?)", (job_id, json.dumps(event)))
+
+    def events(self, job_id: str, after: int = 0) -> List[Tuple[int, Dict[str, Any]]]:
+        """Progress events of the job newer than sequence number 'after', as (seq, event)"""
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT seq, event FROM job_events WHERE job_id = ? AND seq > ? ORDER BY seq",
+                (job_id, after),
+            ).fetchall()
+        return [(row["seq"], json.loads(row["event"])) for row in rows]
+
+    def claim(self, worker: int) -> Optional[Tuple[str, str, Dict[str, Any], Dict[str, bytes]]]:
+        """Marks the oldest queued job as running and returns (id, kind, params, files)"""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, kind, params FROM jobs WHERE status = ? ORDER BY created LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, started = ? WHERE id = ?",
+                (RUNNING, worker, time.time(), row["id"]),
+            )
+            files = {
+                f["field"]: f["data"]
+                for f in conn.execute("SELECT field, data FROM job_files WHERE job_id = ?", (row["id"],))
+            }
+            conn.execute("COMMIT")
+            return row["id"], row["kind"], json.loads(row["params"]), files
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def finish(self, job_id: str, status: str, result: bytes = None, content_type: str = None,
+               filename: str = None, error: str = None) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, content_type = ?, filename = ?, error = ?, finished = ?"
+                " WHERE id = ?",
+                (status, result, content_type, filename, error, time.time(), job_id),
+            )
+            # uploads are only needed while the job runs
+            conn.execute("DELETE FROM job_files WHERE job_id = ?", (job_id,))
+
+    def fail_running(self, reason: str) -> int:
+        """Fails jobs left 'running' by workers that are gone (e.g. after a restart)"""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE status = ?",
+                (FAILED, reason, time.time(), RUNNING),
+            ).rowcount
+
+
+class JobContext:
+    """
+    Handed to job handlers so they can stop early when their job is cancelled and
+    report progress, which is stored as the job's events
+    """
+
+    def __init__(self, queue: JobQueue, job_id: str):
+        self.queue = queue
+        self.id = job_id
+        self.progress = Progress(lambda event: queue.add_event(job_id, event))
+
+    def check_cancelled(self) -> None:
+        if self.queue.cancel_requested(self.id):
+            raise JobCancelled(self.id)
+
+
+def run_job(queue: JobQueue, job_id: str, kind: str, params: Dict[str, Any], files: Dict[str, bytes]) -> None:
+    job = JobContext(queue, job_id)
+    try:
+        result, content_type, filename = JOB_HANDLERS[kind](job, params, files)
+    except JobCancelled:
+        logger.info(f"Job {job_id} cancelled")
+        queue.finish(job_id, CANCELLED)
+    except Exception as e:
+        logger.exception(f"Job {job_id} ({kind}) failed")
+        queue.finish(job_id, FAILED, error="".join(traceback.format_exception(type(e), e, e.__traceback__)))
+    else:
+        queue.finish(job_id, SUCCEEDED, result, content_type, filename)
+
+
+def worker_main(worker: int, db_path: str, db_uri: str) -> None:
+    """
+    Entry point of a worker process: claims and runs jobs from the queue at db_path
+    until the process is stopped, with a BuildingMOTIF instance on the API's
+    database (db_uri).
+    """
+    # imported here so the API process does not need a second BuildingMOTIF instance
+    from buildingmotif.building_motif.building_motif import BuildingMOTIF
+    from sqlalchemy.exc import SQLAlchemyError
+    import interop_metadata_applications.api.views.jobs  # noqa: F401 registers the handlers
+
+    logging.basicConfig(level=logging.INFO)
+    bm = BuildingMOTIF(db_uri, shacl_engine="topquadrant", log_level=logging.INFO)
+    queue = JobQueue(db_path)
+    logger.info(f"Job worker {worker} started (pid {os.getpid()})")
+    while True:
+        claimed = queue.claim(worker)
+        if claimed is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+        job_id, kind, params, files = claimed
+        logger.info(f"Worker {worker} running job {job_id} ({kind})")
+        run_job(queue, job_id, kind, params, files)
+        # same as the API does after every request
+        try:
+            bm.session.commit()
+        except SQLAlchemyError:
+            bm.session.rollback()
+        bm.Session.remove()
+
+
+def start_workers(db_uri: str, count: int = None, db_path: str = None):
+    """
+    Starts the job worker processes, on the BuildingMOTIF database db_uri. Jobs that were running when the previous
+    workers stopped are marked as failed first.
+    """
+    count = JOB_WORKERS if count is None else count
+    db_path = db_path or JOBS_DB
+    failed = JobQueue(db_path).fail_running("worker stopped before the job finished")
+    if failed:
+        logger.warning(f"Marked {failed} interrupted jobs as failed")
+    # spawn, so workers don't inherit the API's database connections
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for worker in range(count):
+        process = context.Process(target=worker_main, args=(worker, db_path, db_uri), daemon=True, name=f"job-worker-{worker}")
+        process.start()
+        workers.append(process)
+    return workers
@@ -0,0 +1,159 @@
+import fcntl
+import gzip
+import logging
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List
+
+from rdflib import Graph
+from buildingmotif.dataclasses import Model
+from buildingmotif.dataclasses.compiled_model import CompiledModel
+
+from interop_metadata_applications.validation_cache import validation_fingerprint
+
+logger = logging.getLogger(__name__)
+
+COMPILED_MODEL_CACHE_DIR = os.getenv("COMPILED_MODEL_CACHE_DIR", ".compiled-model-cache")
+# number of compiled graphs kept on disk; the least recently used ones are deleted
+DISK_CACHE_SIZE = int(os.getenv("COMPILED_MODEL_CACHE_SIZE", "32"))
+MEMORY_CACHE_SIZE = 4
+# fingerprint -> compiled model for the most recently compiled models
+_memory_cache: "OrderedDict[str, CompiledModel]" = OrderedDict()
+# fingerprint -> [lock held while that model is compiled (or read back from disk), number of callers using it]
+_inflight: Dict[str, List] = {}
+_inflight_lock = threading.Lock()
+
+
+def _cache_path(fingerprint: str, cache_dir: str) -> str:
+    # '.compiled' sets these apart from older entries, which held .graph (with the shapes)
+    return os.path.join(cache_dir, f"{fingerprint}.compiled.nt.gz")
+
+
+def _evict(cache_dir: str) -> None:
+    """
+    Deletes the least recently used compiled graphs (by mtime, which disk hits
+    update) and their lock files beyond DISK_CACHE_SIZE. A caller still waiting on
+    a deleted lock file may compile the model a second time, which is harmless:
+    entries are replaced atomically.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".nt.gz"):
+            path = os.path.join(cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+    entries.sort(reverse=True)
+    for _, path in entries[DISK_CACHE_SIZE:]:
+        fingerprint = os.path.basename(path).split(".")[0]
+        for stale in (path, os.path.join(cache_dir, f"{fingerprint}.lock")):
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+        logger.info(f"Evicted compiled model cache entry {path}")
+
+
+@contextmanager
+def _single_flight(fingerprint: str, cache_dir: str):
+    """
+    Lets one caller at a time build the entry for a fingerprint: a lock per
+    fingerprint for threads of this process and a lock file for other processes
+    sharing the cache directory.
+    """
+    with _inflight_lock:
+        entry = _inflight.setdefault(fingerprint, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(os.path.join(cache_dir, f"{fingerprint}.lock"), "w") as lockfile:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lockfile, fcntl.LOCK_UN)
+    finally:
+        # the lock is only kept while someone builds or waits for this fingerprint
+        with _inflight_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _inflight[fingerprint]
+
+
+def _shape_collections(model: Model):
+    """The shape collections Model.compile() compiles against by default: the manifest only"""
+    return [model.get_manifest()]
+
+
+def _restore(model: Model, compiled_graph: Graph) -> CompiledModel:
+    """
+    CompiledModel around a graph that was compiled already. CompiledModel() would
+    run SHACL inference on it again, so the object is filled in directly.
+    """
+    compiled = CompiledModel.__new__(CompiledModel)
+    compiled.model = model
+    compiled.shape_collections = _shape_collections(model)
+    compiled._compiled_graph = compiled_graph
+    return compiled
+
+
+def _remember(fingerprint: str, compiled: CompiledModel) -> CompiledModel:
+    _memory_cache[fingerprint] = compiled
+    _memory_cache.move_to_end(fingerprint)
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return compiled
+
+
+def compiled_model(model: Model, cache_dir: str = None) -> CompiledModel:
+    """
+    Returns model.compile(), reusing an earlier compilation while neither the model
+    graph nor the manifest and the libraries it imports changed. The most recent
+    compiled models are kept in memory and every compiled graph is spilled to disk
+    as gzipped N-Triples under cache_dir (COMPILED_MODEL_CACHE_DIR, default
+    .compiled-model-cache), where the DISK_CACHE_SIZE most recently used are kept
+    (COMPILED_MODEL_CACHE_SIZE, default 32). Concurrent callers for the same model wait for the first
+    one instead of compiling it again.
+    """
+    cache_dir = cache_dir or COMPILED_MODEL_CACHE_DIR
+    fingerprint = validation_fingerprint(model)
+
+    compiled = _memory_cache.get(fingerprint)
+    if compiled is not None:
+        logger.info(f"Compiled model cache hit (memory) for {fingerprint}")
+        _memory_cache.move_to_end(fingerprint)
+        return compiled
+
+    with _single_flight(fingerprint, cache_dir):
+        # another caller may have finished while we waited
+        compiled = _memory_cache.get(fingerprint)
+        if compiled is not None:
+            logger.info(f"Compiled model cache hit (memory) for {fingerprint}")
+            return compiled
+
+        path = _cache_path(fingerprint, cache_dir)
+        if os.path.exists(path):
+            try:
+                graph = Graph()
+                with gzip.open(path, "rt", encoding="utf-8") as f:
+                    graph.parse(data=f.read(), format="nt")
+                compiled = _restore(model, graph)
+                os.utime(path)
+                logger.info(f"Compiled model cache hit (disk) for {fingerprint}")
+                return _remember(fingerprint, compiled)
+            except Exception:
+                logger.exception(f"Ignoring unreadable compiled model cache entry {path}")
+
+        logger.info(f"Compiling model {model.name}")
+        compiled = model.compile()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            # the inferred model graph only; .graph adds the shape collections to it
+            f.write(compiled._compiled_graph.serialize(format="nt"))
+        os.replace(tmp_path, path)
+        _evict(cache_dir)
+        return _remember(fingerprint, compiled)
@@ -0,0 +1,95 @@
+import glob
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+OUTCOMES_DIR = os.getenv("OUTCOMES_DIR", "outcomes")
+OUTCOME_COLUMNS = ["run", "model", "rule", "focus_node", "status", "reason"]
+SCHEMA = {
+    "run": pl.Utf8,
+    "model": pl.Int64,
+    "created": pl.Datetime("us", "UTC"),
+    "rule": pl.Utf8,
+    "focus_node": pl.Utf8,
+    "status": pl.Utf8,
+    "reason": pl.Utf8,
+}
+
+
+def write_outcomes(run_id: str, model_id: int, successful_rules, grouped_diffs,
+                   created: datetime = None, outcomes_dir: str = None) -> str:
+    """
+    Appends the outcomes of a /transform run to the Parquet dataset under outcomes_dir
+    (OUTCOMES_DIR, default 'outcomes'), one file per run. There is one row per
+    successful (rule, focus node) with status 'success' and no reason, and one row
+    per failure reason with status 'failure'. Returns the path of the file.
+    """
+    outcomes_dir = outcomes_dir or OUTCOMES_DIR
+    columns = {name: [] for name in ("rule", "focus_node", "status", "reason")}
+    for rule, focus_nodes in successful_rules.items():
+        for focus_node in focus_nodes:
+            columns["rule"].append(str(rule))
+            columns["focus_node"].append(str(focus_node))
+            columns["status"].append("success")
+            columns["reason"].append(None)
+    for rule, focus_nodes in grouped_diffs.items():
+        for focus_node, reasons in focus_nodes.items():
+            for reason in reasons:
+                columns["rule"].append(str(rule))
+                columns["focus_node"].append(str(focus_node))
+                columns["status"].append("failure")
+                columns["reason"].append(reason)
+
+    n = len(columns["rule"])
+    created = created or datetime.now(timezone.utc)
+    frame = pl.DataFrame(
+        {"run": [run_id] * n, "model": [model_id] * n, "created": [created] * n, **columns},
+        schema=SCHEMA,
+    )
+    os.makedirs(outcomes_dir, exist_ok=True)
+    path = os.path.join(outcomes_dir, f"run-{run_id}.parquet")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    frame.write_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(f"Wrote {n} outcomes of run {run_id} to {path}")
+    return path
+
+
+def query_outcomes(group_by: List[str], filters: Dict[str, Any] = None, latest: bool = False,
+                   limit: Optional[int] = None, outcomes_dir: str = None) -> List[Dict[str, Any]]:
+    """
+    Aggregates the outcomes of all stored runs with one scan of the Parquet dataset.
+    With latest=True only the most recent run of every model is counted; filters
+    maps outcome columns to the value to keep, and is applied within those runs. Each group reports the number of rows, of
+    distinct focus nodes and of runs.
+    """
+    outcomes_dir = outcomes_dir or OUTCOMES_DIR
+    unknown = [column for column in list(group_by) + list(filters or {}) if column not in OUTCOME_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown outcome columns: {unknown}. Please use some of {OUTCOME_COLUMNS}")
+    if not glob.glob(os.path.join(outcomes_dir, "*.parquet")):
+        return []
+
+    outcomes = pl.scan_parquet(os.path.join(outcomes_dir, "*.parquet"))
+    # the latest run of a model is picked before filtering, so that filters never fall back to an older run
+    if latest:
+        outcomes = outcomes.filter(pl.col("created") == pl.col("created").max().over("model"))
+    for column, value in (filters or {}).items():
+        outcomes = outcomes.filter(pl.col(column) == pl.lit(value, dtype=SCHEMA[column]))
+    aggregates = [
+        pl.len().alias("rows"),
+        pl.col("focus_node").n_unique().alias("focus_nodes"),
+        pl.col("run").n_unique().alias("runs"),
+    ]
+    if group_by:
+        result = outcomes.group_by(group_by).agg(aggregates).sort(group_by)
+    else:
+        result = outcomes.select(aggregates)
+    if limit is not None:
+        result = result.limit(limit)
+    return result.collect().to_dicts()
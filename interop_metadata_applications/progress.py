@@ -0,0 +1,64 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# minimum number of seconds between two 'progress' events of the same stage
+PROGRESS_INTERVAL = 0.5
+
+
+class Stage:
+    """One stage of a pipeline run; call advance() once per item processed"""
+
+    def __init__(self, progress: "Progress", name: str, total: Optional[int]):
+        self.progress = progress
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.started = time.monotonic()
+        self._last_emit = self.started
+
+    def advance(self, n: int = 1) -> None:
+        self.done += n
+        now = time.monotonic()
+        if now - self._last_emit >= PROGRESS_INTERVAL:
+            self._last_emit = now
+            self.emit("progress")
+
+    def emit(self, event: str, **extra) -> None:
+        now = time.monotonic()
+        self.progress.sink({
+            "stage": self.name,
+            "event": event,
+            "done": self.done,
+            "total": self.total,
+            "elapsed": round(now - self.started, 3),
+            "total_elapsed": round(now - self.progress.started, 3),
+            **extra,
+        })
+
+
+class Progress:
+    """
+    Reports the stages of a pipeline (compile, rule binding, validation, ...) with
+    item counts and elapsed times. Every event is a dict passed to sink; stage
+    timings are also logged so synchronous runs show where the time goes.
+    """
+
+    def __init__(self, sink: Callable[[Dict[str, Any]], None] = None):
+        self.sink = sink or (lambda event: None)
+        self.started = time.monotonic()
+
+    @contextmanager
+    def stage(self, name: str, total: Optional[int] = None):
+        stage = Stage(self, name, total)
+        stage.emit("start")
+        try:
+            yield stage
+        except Exception as e:
+            stage.emit("error", error=str(e))
+            raise
+        stage.emit("end")
+        logger.info(f"{name}: {stage.done} items in {time.monotonic() - stage.started:.2f}s")
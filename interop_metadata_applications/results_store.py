@@ -0,0 +1,158 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing, contextmanager
+from typing import Any, Dict, Optional
+
+RESULTS_DB = os.getenv("RESULTS_DB", "results.db")
+# number of runs kept; older runs are deleted when a new one is saved
+RESULTS_RETENTION = int(os.getenv("RESULTS_RETENTION", "50"))
+MAX_PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    model_id INTEGER,
+    created REAL NOT NULL,
+    rules_evaluated INTEGER,
+    rules_skipped INTEGER,
+    total INTEGER NOT NULL,
+    succeeded INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    report TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    run_id TEXT NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    rule TEXT NOT NULL,
+    focus_node TEXT NOT NULL,
+    success INTEGER NOT NULL,
+    details TEXT NOT NULL,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE INDEX IF NOT EXISTS results_rule ON results (run_id, rule, success);
+CREATE INDEX IF NOT EXISTS results_focus_node ON results (run_id, focus_node);
+CREATE INDEX IF NOT EXISTS results_success ON results (run_id, success);
+"""
+
+
+class ResultStore:
+    """
+    Per-run storage of /transform results in SQLite, one row per (rule, focus node)
+    with its success flag and details (bindings or failure reasons), so clients
+    can page through large runs instead of receiving them in one response.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or RESULTS_DB
+        with self._transaction() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        with closing(conn), conn:
+            yield conn
+
+    def save_run(self, model_id: int, successful_rules, grouped_diffs, report: str = None,
+                 rules_evaluated: int = None, rules_skipped: int = None) -> str:
+        """Stores the bindings of successful rules and the grouped failures of a run. Returns the run id"""
+        run_id = uuid.uuid4().hex
+        counts = {True: 0, False: 0}
+
+        def rows():
+            seq = 0
+            for success, grouped in ((True, successful_rules), (False, grouped_diffs)):
+                for rule, focus_nodes in grouped.items():
+                    for focus_node, details in focus_nodes.items():
+                        counts[success] += 1
+                        seq += 1
+                        yield run_id, seq, str(rule), str(focus_node), int(success), json.dumps(details, default=str)
+
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO runs (id, model_id, created, rules_evaluated, rules_skipped, total, succeeded, failed, report)"
+                " VALUES (?, ?, ?, ?, ?, 0, 0, 0, ?)",
+                (run_id, model_id, time.time(), rules_evaluated, rules_skipped, report),
+            )
+            conn.executemany(
+                "INSERT INTO results (run_id, seq, rule, focus_node, success, details) VALUES (?, ?, ?, ?, ?, ?)",
+                rows(),
+            )
+            conn.execute(
+                "UPDATE runs SET total = ?, succeeded = ?, failed = ? WHERE id = ?",
+                (counts[True] + counts[False], counts[True], counts[False], run_id),
+            )
+            conn.execute(
+                "DELETE FROM runs WHERE id NOT IN (SELECT id FROM runs ORDER BY created DESC LIMIT ?)",
+                (RESULTS_RETENTION,),
+            )
+        return run_id
+
+    def run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """Totals of a run, with succeeded/failed counts per rule"""
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT id AS run_id, model_id, created, rules_evaluated, rules_skipped, total, succeeded, failed"
+                " FROM runs WHERE id = ?",
+                (run_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            by_rule = {}
+            for r in conn.execute(
+                "SELECT rule, success, COUNT(*) AS n FROM results WHERE run_id = ? GROUP BY rule, success",
+                (run_id,),
+            ):
+                counts = by_rule.setdefault(r["rule"], {"succeeded": 0, "failed": 0})
+                counts["succeeded" if r["success"] else "failed"] = r["n"]
+        run = dict(row)
+        run["by_rule"] = by_rule
+        return run
+
+    def report(self, run_id: str) -> Optional[str]:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT report FROM runs WHERE id = ?", (run_id,)).fetchone()
+        return row["report"] if row else None
+
+    def results(self, run_id: str, rule: str = None, focus_node: str = None, success: bool = None,
+                offset: int = 0, limit: int = 100) -> Dict[str, Any]:
+        """One page of a run's results, filtered by rule (or shape), focus node and success"""
+        where, params = ["run_id = ?"], [run_id]
+        for column, value in (("rule", rule), ("focus_node", focus_node)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        if success is not None:
+            where.append("success = ?")
+            params.append(int(success))
+        clause = " AND ".join(where)
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        offset = max(0, offset)
+
+        with self._transaction() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM results WHERE {clause}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT rule, focus_node, success, details FROM results WHERE {clause} ORDER BY seq LIMIT ? OFFSET ?",
+                params + [limit, offset],
+            ).fetchall()
+        return {
+            "run_id": run_id,
+            "total": total,
+            "offset": offset,
+            "limit": limit,
+            "results": [
+                {
+                    "rule": row["rule"],
+                    "focus_node": row["focus_node"],
+                    "details": json.loads(row["details"]),
+                    "success": bool(row["success"]),
+                }
+                for row in rows
+            ],
+        }
@@ -0,0 +1,73 @@
+import hashlib
+import json
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, Optional, Tuple
+
+from interop_metadata_applications.a import apply_rules_to_model
+from interop_metadata_applications.utils import graph_fingerprint
+from interop_metadata_applications.progress import Progress
+
+logger = logging.getLogger(__name__)
+
+RULE_CACHE_SIZE = 16
+# (model fingerprint, rules hash, engine, closures) -> (bindings, stats)
+_rule_cache: "OrderedDict[Tuple[str, str, str, bool], Tuple[Dict, Dict[str, int]]]" = OrderedDict()
+
+
+def rules_hash(rules: Dict[str, Any]) -> str:
+    """Hash of the rules JSON that does not depend on key order or whitespace"""
+    return hashlib.sha256(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _copy_bindings(bindings) -> defaultdict:
+    # callers get their own rule -> instance maps, so they can't change the cached entry
+    copy = defaultdict(lambda: defaultdict(dict))
+    for rule, instances in bindings.items():
+        copy[rule].update(instances)
+    return copy
+
+
+def cached_apply_rules(
+    model, rules, engine="sparql", closures=False, stats=None, use_cache=True, progress=None, fingerprint=None
+) -> Tuple[defaultdict, Optional[bool]]:
+    """
+    apply_rules_to_model with the result kept for the RULE_CACHE_SIZE most recent
+    (compiled model graph, rules) pairs. Returns (successful_rules, hit) where hit is
+    True/False for a cache hit/miss and None when use_cache is False. fingerprint is
+    graph_fingerprint(model.graph), if the caller has it already.
+    """
+    if not use_cache:
+        return apply_rules_to_model(
+            model, rules, engine=engine, closures=closures, stats=stats, progress=progress, fingerprint=fingerprint
+        ), None
+
+    key = (fingerprint or graph_fingerprint(model.graph), rules_hash(rules), engine, bool(closures))
+    cached = _rule_cache.get(key)
+    hit = cached is not None
+    if hit:
+        logger.info(f"Rule binding cache hit for rules {key[1]}")
+        _rule_cache.move_to_end(key)
+        with (progress or Progress()).stage("rule binding", total=len(rules)) as stage:
+            stage.advance(len(rules))
+    else:
+        rule_stats = {}
+        bindings = apply_rules_to_model(
+            model, rules, engine=engine, closures=closures, stats=rule_stats, progress=progress, fingerprint=key[0]
+        )
+        cached = (_copy_bindings(bindings), rule_stats)
+        _rule_cache[key] = cached
+        while len(_rule_cache) > RULE_CACHE_SIZE:
+            _rule_cache.popitem(last=False)
+
+    bindings, rule_stats = cached
+    if stats is not None:
+        stats.update(rule_stats)
+    return _copy_bindings(bindings), hit
+
+
+def cache_header(hit: Optional[bool]) -> str:
+    """Value of the X-Rule-Cache response header"""
+    if hit is None:
+        return "bypass"
+    return "hit" if hit else "miss"
@@ -0,0 +1,192 @@
+import logging
+from collections import defaultdict
+from typing import Dict, Any, List, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+from rdflib import Graph, URIRef
+from buildingmotif.namespaces import RDF, BRICK
+
+logger = logging.getLogger(__name__)
+
+BASE_RELATIONSHIPS = ["hasPoint", "hasPart", "isPointOf", "isPartOf", "feeds"]
+
+
+class SparseModel:
+    """
+    Integer-indexed view of a (compiled) model for evaluating rules JSON
+    without SPARQL. Every node in the graph gets an index, every relationship
+    in BASE_RELATIONSHIPS becomes an n x n sparse adjacency matrix and every
+    class becomes a membership vector. A rule definition is then evaluated
+    as a sparse boolean matrix F where F[h, v] is set when the definition
+    holds with hook node h and variable value v; this follows the same
+    semantics as transform.sparql_recurse:
+
+        "Point_Class"          -> A[hasPoint] @ D[Point_Class]
+        {"hasPart+": ...}      -> closure(A[hasPart]) @ F(...)
+        {"Equip_Class": {...}} -> D[Equip_Class] @ F({...})
+        {"choice": [a, b]}     -> F(a) OR F(b)
+        {k1: .., k2: ..}       -> F(k1) AND F(k2)
+
+    where D[c] is the diagonal matrix of the membership vector of class c.
+    """
+
+    def __init__(self, graph: Graph, relationships: List[str] = BASE_RELATIONSHIPS):
+        self.nodes: List[URIRef] = []
+        self.index: Dict[URIRef, int] = {}
+        edges = {rel: ([], []) for rel in relationships}
+        predicates = {BRICK[rel]: rel for rel in relationships}
+        members = defaultdict(list)
+
+        # one pass over the graph to index nodes, edges and class memberships
+        for s, p, o in graph.triples((None, None, None)):
+            if p == RDF.type:
+                members[o].append(self._node(s))
+            elif p in predicates:
+                rows, cols = edges[predicates[p]]
+                rows.append(self._node(s))
+                cols.append(self._node(o))
+
+        n = len(self.nodes)
+        self.size = n
+        self.adjacency: Dict[str, sp.csr_matrix] = {
+            rel: _binarize(sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n)))
+            for rel, (rows, cols) in edges.items()
+        }
+        self.classes: Dict[URIRef, np.ndarray] = {}
+        for class_, idxs in members.items():
+            vector = np.zeros(n, dtype=bool)
+            vector[idxs] = True
+            self.classes[class_] = vector
+        self._paths: Dict[str, sp.csr_matrix] = {}
+        logger.info(f"Indexed {n} nodes and {sum(m.nnz for m in self.adjacency.values())} edges")
+
+    def _node(self, node) -> int:
+        idx = self.index.get(node)
+        if idx is None:
+            idx = len(self.nodes)
+            self.index[node] = idx
+            self.nodes.append(node)
+        return idx
+
+    def class_vector(self, classname: str) -> np.ndarray:
+        """Membership vector for BRICK[classname] (exact rdf:type, like the SPARQL queries)"""
+        vector = self.classes.get(BRICK[classname])
+        if vector is None:
+            return np.zeros(self.size, dtype=bool)
+        return vector
+
+    def class_diagonal(self, classname: str) -> sp.csr_matrix:
+        return sp.diags(self.class_vector(classname).astype(np.float64), format="csr")
+
+    def path(self, key: str) -> sp.csr_matrix:
+        """
+        Adjacency matrix for a rule key such as 'hasPart', 'hasPart+', 'feeds*' or 'hasPoint?'
+        """
+        if key in self._paths:
+            return self._paths[key]
+        suffix = key[-1] if key[-1] in ["+", "?", "*"] else ""
+        relname = key.rstrip("+?*")
+        adjacency = self.adjacency[relname]
+        identity = sp.identity(self.size, format="csr")
+        if suffix == "":
+            matrix = adjacency
+        elif suffix == "?":
+            matrix = _binarize(adjacency + identity)
+        elif suffix == "+":
+            matrix = self.closure(relname)
+        else:
+            matrix = _binarize(self.closure(relname) + identity)
+        self._paths[key] = matrix
+        return matrix
+
+    def closure(self, relname: str) -> sp.csr_matrix:
+        """Transitive closure of a relationship by frontier expansion"""
+        key = f"{relname}+"
+        if key in self._paths:
+            return self._paths[key]
+        adjacency = self.adjacency[relname]
+        reach = adjacency.copy()
+        frontier = adjacency
+        while frontier.nnz > 0:
+            frontier = _binarize(frontier @ adjacency)
+            # keep only pairs we have not reached yet
+            frontier = _binarize(frontier - frontier.multiply(reach))
+            reach = _binarize(reach + frontier)
+        self._paths[key] = reach
+        return reach
+
+    def definition_matrix(self, defn, hook_is_var: bool = False) -> sp.csr_matrix:
+        """
+        Evaluates one variable definition to an n x n matrix F with F[hook, value] set
+        when the definition holds. hook_is_var is set when the hook *is* the variable,
+        which happens for the object of a relationship whose value is a class name.
+        """
+        if isinstance(defn, str):
+            if hook_is_var:
+                return self.class_diagonal(defn)
+            return _binarize(self.adjacency["hasPoint"] @ self.class_diagonal(defn))
+
+        result = None
+        for key, value in defn.items():
+            if key == "choice":
+                matrix = None
+                for option in value:
+                    option_matrix = self.definition_matrix(option, hook_is_var=hook_is_var)
+                    matrix = option_matrix if matrix is None else _binarize(matrix + option_matrix)
+                if matrix is None:
+                    matrix = sp.csr_matrix((self.size, self.size))
+            elif key.rstrip("+?*") in self.adjacency:
+                matrix = _binarize(self.path(key) @ self.definition_matrix(value, hook_is_var=isinstance(value, str)))
+            else:  # key represents a type
+                matrix = _binarize(self.class_diagonal(key) @ self.definition_matrix(value, hook_is_var=hook_is_var))
+            # every key constrains the same (hook, value) pair
+            result = matrix if result is None else _binarize(result.multiply(matrix))
+        if result is None:
+            return sp.csr_matrix((self.size, self.size))
+        return result
+
+    def rule_matrices(self, defn: Dict[str, Any]) -> Tuple[np.ndarray, Dict[str, sp.csr_matrix]]:
+        """
+        Returns the indices of the instances the rule applies to and, for each variable,
+        a (len(roots) x n) matrix of every value that variable can take for each of them.
+        """
+        mask = np.zeros(self.size, dtype=bool)
+        for classname in defn["applicability"]:
+            mask |= self.class_vector(classname)
+        roots = np.flatnonzero(mask)
+        variables = {
+            variable: self.definition_matrix(vardef)[roots]
+            for variable, vardef in defn["definitions"].items()
+        }
+        return roots, variables
+
+    def rule_bindings(self, defn: Dict[str, Any]) -> Dict[URIRef, Dict[str, Any]]:
+        """
+        Same result shape as transform.rule_bindings: {instance: {"root": instance, <variable>: <binding>}}
+        for every instance with a binding for all variables. Like there, the smallest value is
+        reported when a variable has more than one.
+        """
+        instances: Dict[URIRef, Dict[str, Any]] = {}
+        if not defn["applicability"] or not defn["definitions"]:
+            return instances
+        roots, variables = self.rule_matrices(defn)
+        complete = np.ones(len(roots), dtype=bool)
+        for matrix in variables.values():
+            complete &= np.diff(matrix.indptr) > 0
+        for row in np.flatnonzero(complete):
+            inst = self.nodes[roots[row]]
+            binding = {"root": inst}
+            for variable, matrix in variables.items():
+                cols = matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]
+                binding[variable] = min(self.nodes[col] for col in cols)
+            instances[inst] = binding
+        return instances
+
+
+def _binarize(matrix) -> sp.csr_matrix:
+    """Turns a sparse matrix into a 0/1 csr matrix with no explicit zeros"""
+    matrix = sp.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    matrix.data[:] = 1.0
+    return matrix
@@ -1,21 +1,104 @@
-from rdflib import Namespace, Graph, Literal, URIRef, BNode
+from rdflib import Namespace, Graph, Literal, URIRef, BNode, Variable
 import logging
 import sys
 import json
 from functools import reduce
-import random
-import string
+import hashlib
+from collections import OrderedDict, defaultdict
 from rdflib.collection import Collection
+from rdflib.graph import ReadOnlyGraphAggregate
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.sparql import Query
 from buildingmotif.namespaces import RDF, SH, BRICK, OWL
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple, FrozenSet, Iterable
+from interop_metadata_applications.sparse_rules import SparseModel
+from interop_metadata_applications.utils import graph_fingerprint
 
 logger = logging.getLogger(__name__)
 
-def gensym():
-    """generates random sparql variable name"""
-    return 'shape' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
+# build relationship
+RELATIONSHIPS = ["hasPoint", "hasPart", "isPointOf", "isPartOf", "feeds"]
+RELATIONSHIPS += [f"{r}+" for r in RELATIONSHIPS]
+RELATIONSHIPS += [f"{r}?" for r in RELATIONSHIPS]
+RELATIONSHIPS += [f"{r}*" for r in RELATIONSHIPS]
 
-def definition_to_sparql(self, classname, defn, variable):
+SPARQL_PREFIXES = {"rdf": RDF, "brick": BRICK}
+ROOT = Variable("root")
+
+# materialized transitive closures of these relationships replace '+' and '*' paths
+CLOSURE = Namespace("urn:interop_metadata_applications/closure#")
+CLOSURE_RELATIONSHIPS = frozenset(["hasPart", "feeds", "isPartOf"])
+CLOSURE_CACHE_SIZE = 8
+# (graph identifier, relationships) -> (graph fingerprint, closure graph)
+_closure_cache: "OrderedDict[Tuple[Any, FrozenSet[str]], Tuple[str, Graph]]" = OrderedDict()
+
+# shape -> parent shape indexes for shapes graphs, keyed by graph fingerprint
+SHAPE_OPERATORS = (SH['or'], SH['and'], SH['xone'])
+SHAPE_INDEX_CACHE_SIZE = 8
+_shape_parent_cache: "OrderedDict[str, Dict[Any, Any]]" = OrderedDict()
+
+def gensym(varname: str, path: str) -> str:
+    """
+    Generates the sparql variable name for the node at 'path' inside the
+    definition of 'varname'. Names are derived from the structure of the
+    definition, so the same rule always compiles to the same query text.
+    """
+    return f"{varname}__p{path}"
+
+def sparql_recurse(defn, varname, hook=None, path="0", closures=frozenset()):
+    query = ""
+
+    if isinstance(defn, str):
+        if hook is not None and hook != varname:
+            # then varname is hasPoint from hook
+            query += f"?{hook} brick:hasPoint ?{varname} .\n"
+        query += f"?{varname} rdf:type {BRICK[defn].n3()} .\n"
+        return query
+
+    for idx, (key, value) in enumerate(defn.items()):
+        keypath = f"{path}_{idx}"
+        if key == "choice":
+            # UNION of the list of descriptions in 'value'
+            query += "{\n"
+            query += " UNION ".join([f"{{ {sparql_recurse(v, varname, hook=hook, path=f'{keypath}c{opt}', closures=closures)} }}\n" for opt, v in enumerate(value)])
+            query += "}\n"
+
+        elif key in RELATIONSHIPS:
+            # start with the hook, or a var named after this position
+            subject_var = hook or gensym(varname, keypath)
+
+            # get the relationship name
+            suffix = key[-1] if key[-1] in ["+", "?", "*"] else ""
+            relname = key.replace("+", "").replace("?", "").replace("*", "")
+            # get the relationship type
+            reltype = BRICK[relname]
+            # use the materialized closure instead of a graph walk (p* == (p+)?)
+            if suffix in ["+", "*"] and relname in closures:
+                reltype = CLOSURE[relname]
+                suffix = "" if suffix == "+" else "?"
+
+            # the object of the relationship is one of two things:
+            # - varname, if 'value' is a type
+            # - a new variable, if 'value' is a dict
+            if isinstance(value, str):
+                object_var = varname
+            else:
+                object_var = gensym(varname, f"{keypath}o")
+
+            # add the relationship to the query
+            query += f"?{subject_var} {reltype.n3()}{suffix} ?{object_var} .\n"
+            # add the object to the query
+            query += sparql_recurse(value, varname, hook=object_var, path=keypath, closures=closures)
+
+        else: # key represents a type
+            subject_var = hook or gensym(varname, keypath)
+            query += f"?{subject_var} rdf:type {BRICK[key].n3()} .\n"
+            # value should be a dictionary
+            query += sparql_recurse(value, varname, hook=subject_var, path=keypath, closures=closures)
+
+    return query
+
+def definition_to_sparql(classname, defn, variable):
     """
     defn is a JSON structure like this:
         "Chilled_Water_Valve_Command": {
@@ -29,10 +112,193 @@ def definition_to_sparql(self, classname, defn, variable):
     """
     query = f"""SELECT ?root ?{variable} WHERE {{ 
         ?root rdf:type {classname.n3()} .
-        {self.sparql_recurse(defn, variable, hook="root")} 
+        {sparql_recurse(defn, variable, hook="root")} 
     }}"""
     return query
 
+def rule_to_sparql(defn: Dict[str, Any], variable: str, closures: FrozenSet[str] = frozenset()) -> str:
+    """
+    Compiles one variable of a rule into a SPARQL query over all the rule's
+    applicability classes at once, which go into a VALUES clause:
+
+        SELECT DISTINCT ?root ?Chilled_Water_Valve_Command WHERE {
+            VALUES ?rootclass { brick:AHU brick:RTU brick:RVAV }
+            ?root rdf:type ?rootclass .
+            ...Chilled_Water_Valve_Command pattern...
+        }
+
+    rule_bindings runs one such query per variable and joins them on ?root, so the
+    rows it reads grow with the sum of the matches of the variables rather than
+    with their product, as they would in a single query joining all of them.
+
+    Relationships named in 'closures' are looked up through their materialized
+    transitive closure (see with_closures) instead of a '+' or '*' property path.
+    """
+    classes = " ".join(BRICK[classname].n3() for classname in defn["applicability"])
+    query = f"""SELECT DISTINCT ?root ?{variable} WHERE {{
+        VALUES ?rootclass {{ {classes} }}
+        ?root rdf:type ?rootclass .
+        {sparql_recurse(defn["definitions"][variable], variable, hook="root", closures=closures)}
+    }}"""
+    return query
+
+# prepared queries keyed by (rule hash, class, variable, closures); a query over all classes uses (rule hash, None, variable, closures)
+_prepared_queries: Dict[Tuple[str, Optional[str], Optional[str], FrozenSet[str]], Query] = {}
+
+def rule_hash(defn: Dict[str, Any]) -> str:
+    """
+    Hash of the canonical JSON form of a rule definition
+    """
+    return hashlib.sha256(json.dumps(defn, sort_keys=True).encode("utf-8")).hexdigest()
+
+def prepared_rule_query(defn: Dict[str, Any], variable: str, classname: Optional[str] = None, closures: FrozenSet[str] = frozenset()) -> Query:
+    """
+    Returns the parsed and planned query for a variable of the rule, preparing it on
+    first use. With no classname this is the rule_to_sparql query over all the
+    applicability classes; otherwise it is the definition_to_sparql query for that class. The cache lives
+    at module level so /transform, /transform/afxml and the CLI all share it.
+    """
+    key = (rule_hash(defn), classname, variable, closures)
+    query = _prepared_queries.get(key)
+    if query is None:
+        if classname is None:
+            text = rule_to_sparql(defn, variable, closures=closures)
+        else:
+            text = definition_to_sparql(BRICK[classname], defn["definitions"][variable], variable)
+        query = prepareQuery(text, initNs={**SPARQL_PREFIXES, "closure": CLOSURE})
+        _prepared_queries[key] = query
+    return query
+
+def rule_bindings(graph: Graph, defn: Dict[str, Any], closures: FrozenSet[str] = frozenset()) -> Dict[URIRef, Dict[str, Any]]:
+    """
+    Runs the compiled query of every variable of the rule against the graph and
+    returns {instance: {"root": instance, <variable>: <binding>, ...}} for the
+    instances with a binding for every variable. When a variable has several
+    matches the smallest is reported.
+    Every query runs over all the applicability classes; the rows of instances
+    that an earlier variable had no binding for are dropped as they are read,
+    and the remaining variables are not queried once no instance is left.
+    Pass the graph from with_closures together with its relationships to
+    use materialized closures.
+    """
+    instances: Dict[URIRef, Dict[str, Any]] = {}
+    if not defn["applicability"] or not defn["definitions"]:
+        return instances
+    for index, variable in enumerate(defn["definitions"]):
+        values: Dict[URIRef, Any] = {}
+        for row in graph.query(prepared_rule_query(defn, variable, closures=closures)).bindings:
+            root, value = row[ROOT], row[Variable(variable)]
+            if index and root not in instances:
+                continue
+            if root not in values or value < values[root]:
+                values[root] = value
+        if index == 0:
+            instances = {root: {"root": root} for root in values}
+        else:
+            instances = {root: binding for root, binding in instances.items() if root in values}
+        for root, binding in instances.items():
+            binding[variable] = values[root]
+        if not instances:
+            break
+    return instances
+
+def materialize_closures(graph: Graph, relationships: Iterable[str] = CLOSURE_RELATIONSHIPS) -> Graph:
+    """
+    Computes the transitive closure of each relationship once and returns it as
+    a graph of (s, closure:<relationship>, o) triples
+    """
+    relationships = list(relationships)
+    index = SparseModel(graph, relationships=relationships)
+    closures = Graph()
+    for relname in relationships:
+        matrix = index.closure(relname).tocoo()
+        predicate = CLOSURE[relname]
+        for row, col in zip(matrix.row, matrix.col):
+            closures.add((index.nodes[row], predicate, index.nodes[col]))
+        logger.info(f"Materialized {matrix.nnz} {relname}+ pairs")
+    return closures
+
+def with_closures(
+    graph: Graph, relationships: FrozenSet[str] = CLOSURE_RELATIONSHIPS, fingerprint: Optional[str] = None
+) -> Graph:
+    """
+    Returns a read-only view of the graph together with the materialized closures
+    of the relationships. The closures are cached per graph and recomputed when
+    the graph's fingerprint changes (pass it as fingerprint if the caller has it already).
+    """
+    relationships = frozenset(relationships)
+    key = (graph.identifier, relationships)
+    fingerprint = fingerprint or graph_fingerprint(graph)
+    cached = _closure_cache.get(key)
+    if cached is None or cached[0] != fingerprint:
+        cached = (fingerprint, materialize_closures(graph, relationships))
+        _closure_cache[key] = cached
+        while len(_closure_cache) > CLOSURE_CACHE_SIZE:
+            _closure_cache.popitem(last=False)
+    _closure_cache.move_to_end(key)
+    return ReadOnlyGraphAggregate([graph, cached[1]])
+
+def shape_parent_index(graph: Graph) -> Dict[Any, Any]:
+    """
+    Reverse index of a shapes graph: child shape -> parent shape, where the parent
+    uses the child through sh:property, sh:node or sh:qualifiedValueShape, through a
+    member of an sh:or/sh:and/sh:xone list, or through sh:property on an
+    sh:or/sh:and/sh:xone object. Built in one pass over the graph and cached by the
+    graph's fingerprint, so the same manifest is indexed once and an edited manifest,
+    even one of the same size, is indexed again.
+    """
+    key = graph_fingerprint(graph)
+    index = _shape_parent_cache.get(key)
+    if index is not None:
+        _shape_parent_cache.move_to_end(key)
+        return index
+
+    index = {}
+    users = defaultdict(list)  # object -> (subject, predicate) for the logical operators
+    property_users = defaultdict(list)  # object of sh:property -> subject
+    first, rest = {}, {}
+    for s, p, o in graph.triples((None, None, None)):
+        if p == SH['property'] or p == SH['node'] or p == SH['qualifiedValueShape']:
+            index.setdefault(o, s)
+            if p == SH['property']:
+                property_users[s].append(o)
+        elif p in SHAPE_OPERATORS:
+            users[o].append(s)
+        elif p == RDF['first']:
+            first[s] = o
+        elif p == RDF['rest']:
+            rest[s] = o
+
+    for head, parents in users.items():
+        parent = parents[0]
+        # (sh:or|sh:and|sh:xone)/sh:property
+        for child in property_users.get(head, []):
+            index.setdefault(child, parent)
+        # members of the sh:or/sh:and/sh:xone list
+        node, seen = head, set()
+        while node in first and node not in seen:
+            seen.add(node)
+            index.setdefault(first[node], parent)
+            node = rest.get(node)
+
+    _shape_parent_cache[key] = index
+    while len(_shape_parent_cache) > SHAPE_INDEX_CACHE_SIZE:
+        _shape_parent_cache.popitem(last=False)
+    return index
+
+def resolve_original_shape(index: Dict[Any, Any], shape_uri: URIRef) -> URIRef:
+    """
+    Follows the parent index up from shape_uri to the shape that is not used by any other
+    """
+    original_shape = shape_uri
+    seen = {original_shape}
+    while original_shape in index:
+        original_shape = index[original_shape]
+        if original_shape in seen:
+            break
+        seen.add(original_shape)
+    return original_shape
+
 def definition_to_shape(rulename: str, defn: Dict[str, Any], ns: Namespace) -> Graph:
     """
     Here's an example JSON rule:
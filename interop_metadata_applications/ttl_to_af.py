@@ -1,8 +1,8 @@
-import sys, os, json, re, uuid, random, string
+import sys, os, json, re, uuid, random, string, logging
 
-from interop_metadata_applications.transform import definition_to_shape, definition_to_sparql
+from interop_metadata_applications.transform import definition_to_shape, definition_to_sparql, sparql_recurse, rule_bindings
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from copy import deepcopy
 
 
@@ -16,9 +16,16 @@ from buildingmotif.namespaces import SH, BRICK
 
 import pandas as pd
 
-from interop_metadata_applications.utils import xml_dump
+from interop_metadata_applications.utils import xml_dump, graph_fingerprint
+from interop_metadata_applications.rule_cache import rules_hash
+from interop_metadata_applications import af_delta, af_reader
 import interop_metadata_applications.afxml as af
 
+logger = logging.getLogger(__name__)
+
+# what an export of a graph contains, see Translator.export_plan
+ExportPlan = namedtuple('ExportPlan', ['types', 'labels', 'points', 'nodes', 'children', 'nested', 'roots'])
+
 class Translator():
     
     def __init__(self) -> None:
@@ -37,8 +44,38 @@ class Translator():
         self.bmmodel = None
         self.validation = True
         self.templates = {'Analysis': {}, 'Element': {}, 'Attribute': {}}
+        self._element_templates = {}
+        # (graph, parents, paths) as computed by hierarchy()
+        self._hierarchy = None
         self.piexportpath = 'C:\Program Files\PIPC\AF\AFExport.exe'
         self.piimportpath = 'C:\Program Files\PIPC\AF\AFImport.exe'
+        self.units = dict(self.DEFAULT_UNITS)
+        self.read_config_file()
+
+    # Brick unit (local name) -> AF unit of measure, attribute type and default value;
+    # the "units" of pi_config.json are added to these. An entry may also be just
+    # the unit of measure, for an Int32 attribute without a default value.
+    DEFAULT_UNITS = {
+        'DEG_F': {'uom': '°F', 'type': 'Int32', 'value': ''},
+        'OnOff': {'uom': '', 'type': 'Boolean', 'value': 'False'},
+        'Percent': {'uom': '%', 'type': 'Int32', 'value': ''},
+        'HR': {'uom': '%', 'type': 'Int32', 'value': ''},
+        'PPM': {'uom': 'ppm', 'type': 'Int32', 'value': ''},
+        'GAL_UK-PER-MIN': {'uom': 'US gal/min', 'type': 'Int32', 'value': ''},
+    }
+
+    def read_config_file(self, path='pi_config.json'):
+        """Reads the PI AF server, database, tool paths and units from the config file, if there is one"""
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        self.defaultserver = config.get('server', self.defaultserver)
+        self.defaultdatabase = config.get('database', self.defaultdatabase)
+        self.defaulturi = f"\\\\{self.defaultserver}\\{self.defaultdatabase}"
+        self.piexportpath = config.get('piexportpath', self.piexportpath)
+        self.piimportpath = config.get('piimportpath', self.piimportpath)
+        self.units.update(config.get('units', {}))
 
 
     def export_pi_database(self, database, outpath):
@@ -50,6 +87,17 @@ class Translator():
         command.extend(args)
         print(command)#subprocess.run(command)
 
+    def read_pi_database(self, inpath, graph=None):
+        """
+        Lifts an AFXML export of a PI AF database (export_pi_database) into a Brick
+        graph named in self.EX, with the units of self.units, to compare it with
+        the models the exports are generated from. Elements exported from the loaded
+        graph (see elementId) are lifted to their IRIs. The export is streamed, see
+        af_reader.iter_elements.
+        """
+        ids = {self.elementId(node): node for node in set(self.graph.subjects()) | set(self.graph.objects()) if isinstance(node, URIRef)}
+        return af_reader.read_graph(inpath, namespace=self.EX, units=self.units, graph=graph, ids=ids)
+
     def import_pi_database(self, database, inpath):
         args = [
             "/A", #Auto check-in. Disable to avoid overriding data by accident.
@@ -65,6 +113,7 @@ class Translator():
 
     def load(self, ttlpath, merge=None):
 
+        self.forget_hierarchy()
         self.graph.parse(ttlpath)
         if merge is not None:
             if isinstance(merge, str):
@@ -113,67 +162,10 @@ class Translator():
         This method turns this into a SPARQL query which retrieves values into a variable
         named whatever the top-level key is
         """
-        query = f"""SELECT ?root ?{variable} WHERE {{ 
-            ?root rdf:type {classname.n3()} .
-            {self.sparql_recurse(defn, variable, hook="root")} 
-        }}"""
-        return query
-
-    def _gensym(self):
-        """generates random sparql variable name"""
-        return 'var' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=4))
+        return definition_to_sparql(classname, defn, variable)
 
     def sparql_recurse(self, defn, varname, hook=None):
-        relationships = ["hasPoint", "hasPart", "isPointOf", "isPartOf", "feeds"]
-        # add '+' versions to relationships
-        relationships += [f"{r}+" for r in relationships]
-        # add '?' versions to relationships
-        relationships += [f"{r}?" for r in relationships]
-        # add '*' versions to relationships
-        relationships += [f"{r}*" for r in relationships]
-        query = ""
-        if isinstance(defn, str):
-            if hook is not None and hook != varname:
-                # then varname is hasPoint from hook
-                query += f"?{hook} brick:hasPoint ?{varname} .\n"
-            query += f"?{varname} rdf:type {self.BRICK[defn].n3()} .\n"
-            return query
-        for key, value in defn.items():
-            if key == "choice":
-                # UNION of the list of descriptions in 'value'
-                query += "{\n"
-                query += " UNION ".join([f"{{ {self.sparql_recurse(v, varname, hook=hook)} }}\n" for v in value])
-                query += "}\n"
-            elif key in relationships:
-                # start with a random var
-                subject_var = hook or self._gensym()
-                
-                # get the relationship name
-                suffix = key[-1] if key[-1] in ["+", "?", "*"] else ""
-                relname = key.replace("+", "").replace("?", "").replace("*", "")
-                # get the relationship type
-                reltype = self.BRICK[relname]
-                
-                # the object of the relationship is one of two things:
-                # - varname, if 'value' is a type
-                # - a new variable, if 'value' is a dict
-                if isinstance(value, str):
-                    object_var = varname
-                else:
-                    object_var = self._gensym()
-
-                # add the relationship to the query
-                query += f"?{subject_var} {reltype.n3()}{suffix} ?{object_var} .\n"
-                # add the object to the query
-                query += self.sparql_recurse(value, varname, hook=object_var)
-            else: # key represents a type
-                subject_var = hook or self._gensym()
-                query += f"?{subject_var} rdf:type {self.BRICK[key].n3()} .\n"
-                # value should be a dictionary
-                query += self.sparql_recurse(value, varname, hook=subject_var)
-
-        return query
-
+        return sparql_recurse(defn, varname, hook=hook)
 
     def get_rule_bindings(self, firstttl):
         model = Graph()
@@ -183,342 +175,565 @@ class Translator():
 
         rules = {}
 
-        # loop through all defns in self.afddrules
+        # loop through all defns in self.afddrules; each rule is a single query
+        # over its 'applicability' classes which only returns complete bindings
         for rule, defn in self.afddrules.items():
-            # get the 'applicability' field (list of Brick classes) and find all instances of those classes in the model
-            instances = defaultdict(dict)
-            for classname in defn["applicability"]:
-                class_ = self.BRICK[classname]
-                for variable in defn["definitions"]:
-                    query = self.definition_to_sparql(class_, defn["definitions"][variable], variable)
-                    results = model.query(query)
-                    for row in results.bindings:
-                        row = {str(k): v for k, v in row.items()}
-                        inst = row['root']
-                        instances[inst].update(row)
-            # find all instances which have less than len(defn["definitions"])+1 keys and remove them
-            instances = {k: v for k, v in instances.items() if len(v) == len(defn["definitions"])+1}
-            rules[rule] = dict(instances)
+            rules[rule] = rule_bindings(model, defn)
         return rules
 
     # you are exiting Gabe's kingdom at your own risk.
 
-    def createAFTree(self, firstttl, outpath, merge=None):
+    # predicates whose object is not exported as an element of its own
+    IGNORED_OBJECT_PREDICATES = ['hasTag', 'Max_Limit', 'Min_limit', 'hasUnit', 'lastKnownValue']
+
+    def index_graph(self):
+        """
+        One pass over the graph: the (last) Brick type and rdfs:label of every node,
+        and every other triple as an edge for createAFTree. The triples are sorted so
+        that exports of the same graph are identical, whatever order it was loaded in.
+        """
+        types, labels, edges = {}, {}, []
+        for subj, pred, obj in sorted(self.graph.triples((None, None, None))):
+            if pred == RDF['type']:
+                types[subj] = obj.split('#')[-1]
+            elif pred == RDFS['label']:
+                labels[subj] = obj
+            else:
+                edges.append((subj, pred, obj))
+        return types, labels, edges
+
+    def newElement(self, node, nodetype, labels):
+        name = labels.get(node, node.split('#')[-1])
+        newel = af.AFElement(af.Name(name))
+        newel += af.id(self.elementId(node))
+        newel += af.Description(nodetype if nodetype is not None else "No description")
+        template = self._element_templates.get(node)
+        if template is not None:
+            # the template carries the attribute and analysis definitions
+            newel += af.Template(template[0])
+            return newel
+        for a in self.addAnalysis(node):
+            newel += a
+        return newel
+
+    def elementId(self, iri):
+        """AF id of the element for an IRI; the same in every export of the IRI"""
+        return uuid.uuid5(uuid.NAMESPACE_URL, str(iri)).hex
+
+    def export_fingerprint(self, templates):
+        """Fingerprint of everything an export depends on: graph, rules, validated rules and options"""
+        options = [self.defaultserver, self.defaultdatabase, templates, self.units, self.afddrules, getattr(self, 'validrules', None)]
+        return f"{graph_fingerprint(self.graph)}-{rules_hash(options)[:32]}"
+
+    def createAFTree(self, firstttl, outpath, merge=None, templates=False, previous=None):
+        """
+        Writes the AF database of the graph (see build_af_tree) to outpath.
+
+        Element ids are derived from the IRIs, and the digest of every element is kept
+        next to the output (af_delta.state_path). Without previous the document is
+        streamed (see iter_af_xml), the digests are read back from the file and None is
+        returned. Given previous, the path of an earlier export or of its state file,
+        the whole tree is built to compare it, and only the elements that were added,
+        changed or removed since then are written; this is what is returned too.
+        """
         self.load(firstttl, merge)
+        fingerprint = self.export_fingerprint(templates)
+        previous_fingerprint, previous_state = af_delta.load_state(previous) if previous is not None else (None, None)
+        if merge is not None:
+            outpath = outpath.replace('.xml', '_updated.xml')
+            self.graph.serialize(outpath.replace('.xml', '.ttl'), format='turtle')
+
+        if previous_state is None:
+            with open(outpath, 'wb') as f:
+                for chunk in self.iter_af_xml(templates):
+                    f.write(chunk)
+            af_delta.save_state(af_delta.state_path(outpath), fingerprint, af_delta.export_state(outpath))
+            return None
+
+        newaf = self.build_af_tree(templates)
+        state = af_delta.tree_state(newaf)
+        if previous_fingerprint == fingerprint:
+            logger.info("Nothing changed since the previous export")
+            previous_state = state
+        newaf, _ = af_delta.delta_tree(newaf, previous_state, state)
+        xml_dump(newaf, file=outpath)
+        af_delta.save_state(af_delta.state_path(outpath), fingerprint, state)
+
+        return newaf
+
+    def add_rules_from_dict(self, rules, successful_rules):
+        """
+        The rules JSON and the bindings of its successful rules (as from
+        a.apply_rules_to_model: rule -> focus node -> bindings), instead of the files
+        add_rules reads
+        """
+        self.afddrules = rules
+        self.validrules = [
+            {
+                'rule': str(rule).removeprefix("urn:rules_manifest/"),
+                'focus_node': str(focus_node),
+                'success': True,
+                'details': {variable: str(value) for variable, value in bindings.items() if variable != 'root'},
+            }
+            for rule, instances in successful_rules.items()
+            for focus_node, bindings in instances.items()
+        ]
+
+    def create_af_tree_from_model(self, model, templates=False):
+        """The AF tree (see build_af_tree) of the graph of a BuildingMOTIF model, e.g. a compiled one"""
+        self.graph = model.graph
+        return self.build_af_tree(templates)
+
+    def build_af_tree(self, templates=False):
+        """
+        The AF database of self.graph with the analyses of self.validrules. Every point
+        is an attribute of its equipment named after the point (its local name).
+
+        With templates, equipment that shares its Brick class, points and analyses with
+        at least TEMPLATE_MIN_INSTANCES - 1 other elements is based on a shared element
+        template instead of carrying its attribute and analysis definitions inline. The
+        attributes of such an element are named after the Brick class of their point,
+        numbered from _2 when it repeats (see element_templates), so that they match
+        the template; each one only sets the ConfigString with its point's tag. An
+        element's attribute names therefore change when it joins or leaves a template
+        group, which is why templates are opt-in.
+        """
+        plan = self.export_plan(templates)
+        elements = {node: self.planned_element(node, plan) for node in plan.nodes}
+        for node, element in elements.items():
+            for _, child in plan.children.get(node, ()):
+                element += elements[child]
+        newaf, db = self.af_database()
+        for node in plan.roots:
+            db += elements[node]
+        return newaf
+
+    def iter_af_xml(self, templates=False, pretty_print=True):
+        """
+        The AFXML document of build_af_tree(templates), in chunks (see afxml.iter_xml).
+        Every element is built just before it is written and dropped once it is, so
+        only the elements from the database down to the one being written are held,
+        not the tree.
+        """
+        plan = self.export_plan(templates)
+        newaf, db = self.af_database()
+        # id of an element built but not written yet -> its node (None for the database)
+        pending = {id(db): None}
+
+        def build(nodes):
+            for node in nodes:
+                element = self.planned_element(node, plan)
+                pending[id(element)] = node
+                yield element
+
+        def nested(element):
+            if id(element) not in pending:
+                return None
+            node = pending.pop(id(element))
+            nodes = plan.roots if node is None else [child for _, child in plan.children.get(node, ())]
+            return {'AFElement': build(nodes)}
+
+        return af.iter_xml(newaf, pretty_print=pretty_print, nested=nested)
+
+    def export_plan(self, templates=False):
+        """
+        One pass over the edges of self.graph (see index_graph) that decides what an
+        export contains without building any element: the element templates (in
+        self.templates), every node in the order it first appears, the points and parts
+        nested under each node as ('point' or 'part', node) in edge order, and the nodes
+        written at the database level.
+        """
+        # the graph may have been edited since the last export
+        self.forget_hierarchy()
+        types, labels, edges = self.index_graph()
+        points = {row.Index: row for row in self.point_table(types, edges).itertuples()}
+        self.templates = {'Analysis': {}, 'Element': {}, 'Attribute': {}}
+        self._element_templates = self.element_templates(types, edges, points) if templates else {}
+        ignored_objects = {self.BRICK[p] for p in self.IGNORED_OBJECT_PREDICATES}
+        nodes = {}
+        children = defaultdict(list)
+        # nodes placed under another element
+        nested = set()
+        # nodes whose element is not added to the database directly
+        ignored = set()
+        for subj, pred, obj in edges:
+            nodes.setdefault(subj)
+            nodes.setdefault(obj)
+            if pred in ignored_objects:
+                ignored.add(obj)
+            if pred == self.BRICK['isTagOf']:
+                ignored.add(subj)
+
+            if pred in [self.BRICK['hasPoint'], self.BRICK['isPointOf']]:
+                parent, point = (subj, obj) if pred == self.BRICK['hasPoint'] else (obj, subj)
+                ignored.add(point)
+                nested.add(point)
+                children[parent].append(('point', point))
+
+            if pred == self.BRICK['hasPart'] or pred == self.BRICK['isLocationOf']:
+                nested.add(obj)
+                children[subj].append(('part', obj))
+            if pred == self.BRICK['isPartOf'] or pred == self.BRICK['hasLocation']:
+                nested.add(subj)
+                children[obj].append(('part', subj))
+            # if pred == self.BRICK["feeds"]:
+            #     afdict[subj] += af.AFAttribute(
+            #             af.Name("Feeds"),
+            #             af.Description("Downstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/feeds"),
+            #             af.Type("OSIsoft.AF.Asset.AFElement"),
+            #             af.Value(self.findFullPath(obj), type="AFElement")
+            #         )
+            #     afdict[obj] += af.AFAttribute(
+            #             af.Name("Is fed by"),
+            #             af.Description("Upstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/isFedBy"),
+            #             af.Type("OSIsoft.AF.Asset.AFElement"),
+            #             af.Value(self.findFullPath(subj), type="AFElement")
+            #         )
+            # if pred == self.BRICK["isFedBy"]:
+            #     #print(f"Element {subj} is fed by {obj}...")
+            #     afdict[subj] += af.AFAttribute(
+            #             af.Name("Is fed by"),
+            #             af.Description("Upstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/isFedBy"),
+            #             af.Type("OSIsoft.AF.Asset.AFElement"),
+            #             af.Value(self.findFullPath(obj), type="AFElement")
+            #         )
+            #     afdict[obj] += af.AFAttribute(
+            #             af.Name("Feeds"),
+            #             af.Description("Downstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/feeds"),
+            #             af.Type("OSIsoft.AF.Asset.AFElement"),
+            #             af.Value(self.findFullPath(subj), type="AFElement")
+            #         )
+
+        roots = [node for node in nodes if node not in ignored and node not in nested]
+        return ExportPlan(types, labels, points, list(nodes), children, nested, roots)
+
+    def af_database(self):
+        """(AF document root, its database) of an export, with the element templates of the last export_plan"""
         newaf = af.AF()
-        afdict = {}
-        ignored = []
-        for subj, pred, obj in self.graph.triples((None, None, None)):
-            if pred not in [RDF['type'], RDFS['label']]:
-                subjtype = None
-                objtype = None
-                for _, _, bricktype in self.graph.triples((subj, RDF['type'], None)):
-                        subjtype = bricktype.split('#')[-1]
-                for _, _, bricktype in self.graph.triples((obj, RDF['type'], None)):
-                        objtype = bricktype.split('#')[-1]
-                if subj not in afdict.keys():
-                    name = subj.split('#')[-1]
-                    for _, _, label in self.graph.triples((subj, RDFS['label'], None)):
-                        name = label
-                    newel = af.AFElement(af.Name(name))
-                    newel += af.id(uuid.uuid4().hex)
-                    try:
-                        newel += af.Description(subjtype)
-                    except:
-                        newel += af.Description("No description")
-                    analyses = self.addAnalysis(subj)
-                    if analyses != []:
-                        for a in analyses:
-                            newel += a
-                    afdict[subj] = newel
-                if obj not in afdict.keys():
-                    name = obj.split('#')[-1]
-                    for _, _, label in self.graph.triples((obj, RDFS['label'], None)):
-                        name = label
-                    newel = af.AFElement(af.Name(name))
-                    newel += af.id(uuid.uuid4().hex)
-                    try:
-                        newel += af.Description(objtype)
-                    except:
-                        newel += af.Description("No description")
-                    analyses = self.addAnalysis(obj)
-                    if analyses != []:
-                        for a in analyses:
-                            newel += a
-                    afdict[obj] = newel
-                if pred in [self.BRICK['hasTag'], self.BRICK["Max_Limit"], self.BRICK["Min_limit"], self.BRICK['hasUnit'], self.BRICK['lastKnownValue']]:
-                    ignored.append(afdict[obj])
-                if pred == self.BRICK['isTagOf']:
-                    ignored.append(afdict[subj])
-
-
-                if pred in [self.BRICK['hasPoint'], self.BRICK['isPointOf']]:
-                    afdict, ignored = self.addpoint(subj, pred, obj, subjtype, objtype, ignored, afdict)
-
-                if pred == self.BRICK['hasPart'] or pred == self.BRICK['isLocationOf']:
-                    afdict[obj]['ReferenceType'] = "Parent-Child"
-                    afdict[subj] += afdict[obj]
-                if pred == self.BRICK['isPartOf'] or pred == self.BRICK['hasLocation']:
-                    afdict[subj]['ReferenceType'] = "Parent-Child"
-                    afdict[obj] += afdict[subj]
-                # if pred == self.BRICK["feeds"]:
-                #     afdict[subj] += af.AFAttribute(
-                #             af.Name("Feeds"),
-                #             af.Description("Downstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/feeds"),
-                #             af.Type("OSIsoft.AF.Asset.AFElement"),
-                #             af.Value(self.findFullPath(obj), type="AFElement")
-                #         )
-                #     afdict[obj] += af.AFAttribute(
-                #             af.Name("Is fed by"),
-                #             af.Description("Upstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/isFedBy"),
-                #             af.Type("OSIsoft.AF.Asset.AFElement"),
-                #             af.Value(self.findFullPath(subj), type="AFElement")
-                #         )
-                # if pred == self.BRICK["isFedBy"]:
-                #     #print(f"Element {subj} is fed by {obj}...")
-                #     afdict[subj] += af.AFAttribute(
-                #             af.Name("Is fed by"),
-                #             af.Description("Upstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/isFedBy"),
-                #             af.Type("OSIsoft.AF.Asset.AFElement"),
-                #             af.Value(self.findFullPath(obj), type="AFElement")
-                #         )
-                #     afdict[obj] += af.AFAttribute(
-                #             af.Name("Feeds"),
-                #             af.Description("Downstream element, as defined in the BRICK ontology. See https://brickschema.org/ontology/1.2/relationships/feeds"),
-                #             af.Type("OSIsoft.AF.Asset.AFElement"),
-                #             af.Value(self.findFullPath(subj), type="AFElement")
-                #         )
-                
         db = af.AFDatabase(af.Name(self.defaultdatabase))
-        for key in afdict.keys():
-            if afdict[key] not in ignored:
-                try:
-                    if afdict[key]['ReferenceType'] != "Parent-Child":
-                        db += afdict[key]
-                except:
-                    db += afdict[key]
+        for template in self.templates['Element'].values():
+            db += template
         newaf += db
         newaf['PISystem'] = self.defaultserver
         newaf['ExportedType'] = "AFDatabase"
         newaf['Identity'] = "Database"
         newaf['Database'] = self.defaultdatabase
-        if merge is not None:
-            xml_dump(newaf, file=outpath.replace('.xml', '_updated.xml'))
-            self.graph.serialize(outpath.replace('.xml', '_updated.ttl'), format='turtle')
-        else:
-            xml_dump(newaf, file=outpath)
-
-        return newaf
-    
-    def addpoint(self, s, p, o, stype, otype, ign, afd):
-        if p == self.BRICK['hasPoint']:
-            otype = otype if otype is not None else ""
-            attr = af.AFAttribute(
-                af.Name(o.split('#')[-1]),
-                af.Description(otype)
-            )
-            uom, aftype, val = self.getUOMs(o)
-            if uom is not None:
-                if uom != '':
-                    attr += af.DefaultUOM(uom)
-                attr += af.Type(aftype)
-                vattr = af.Value(val, type=aftype)
-            
-            ign.append(afd[o])
-
-            ### Adding an analysis starts here. 
-            
-            #We can add it to the parent directly #
-            # By accessing afd[s] and using add
-
-            # this should be deleted. Instead, the 
-            # analyses should be added at the end of the process, when
-            # all equipment and points are known
-            # if otype in events:
-            #     analysis, parent = self.addAnalysis(o)
-            #     for a in analysis:
-            #         afd[s] += a
-            #     if uom is not None:
-            #         attr += vattr
-            #     attr += af.DataReference("Analysis")
-
-            # ## Adding an analysis ends here
-                
-            # else:
-            #     nattr, ispt = self.addTag(s, o, attr)
-            #     if not ispt and uom is not None:
-            #         nattr += vattr
-            #     attr = nattr
-            nattr, ispt = self.addTag(s, o, attr)
-            if not ispt and uom is not None:
-                nattr += vattr
-            afd[o]['ReferenceType'] = "Parent-Child"
-            afd[s] += nattr
-            afd[s] += afd[o]
-
-        elif p == self.BRICK['isPointOf']:
-            stype = stype if stype is not None else ""
-            attr = af.AFAttribute(
-                af.Name(s.split('#')[-1]),
-                af.Description(stype)
-            )
-            uom, aftype, val = self.getUOMs(s)
-            if uom is not None:
-                if uom != '':
-                    attr += af.DefaultUOM(uom)
-                attr += af.Type(aftype)
-                vattr = af.Value(val, type=aftype)
-            ign.append(afd[s])
-            #analysis  = self.addAnalysis(s)
-            # if analysis != []:
-            #     for a in analysis:
-            #         afd[o] += a
-            #     if uom is not None:
-            #         attr += vattr
-                
-            #     attr += af.DataReference("Analysis")
-            # else:
-            nattr, ispt = self.addTag(o, s, attr)
-            if not ispt and uom is not None:
-                nattr += vattr
-            afd[s]['ReferenceType'] = "Parent-Child"
-            afd[o] += nattr
-            afd[o] += afd[s]
-
-        return afd, ign
-    
-    def addTag(self, parent, point, attr):
-        ispt = False
-        for tagname in self.graph.objects(subject=point, predicate=self.BRICK['hasTag']):
-            if not ispt:
-                attr += af.DataReference("PI Point")
-                attr += af.ConfigString(f"{self.findFullPath(tagname)};RelativeTime=-2y")
-                ispt = True
-        return attr, ispt
+        return newaf, db
+
+    def planned_element(self, node, plan):
+        """The element of a node in an export_plan, with its attributes but not the elements nested under it"""
+        element = self.newElement(node, plan.types.get(node), plan.labels)
+        if node in plan.nested:
+            element['ReferenceType'] = "Parent-Child"
+        for kind, child in plan.children.get(node, ()):
+            if kind == 'point':
+                self.addpoint(node, child, element, plan.points)
+        return element
+
+    def addpoint(self, parent, point, element, points):
+        """Adds the point of a hasPoint / isPointOf triple to the element of its equipment as an attribute"""
+        row = points[point]
+        template = self._element_templates.get(parent)
+        if template is not None:
+            # only the tag differs from the attribute template
+            if row.tagpath is not None:
+                element += af.AFAttribute(
+                    af.Name(template[1][point]),
+                    af.ConfigString(f"{row.tagpath};RelativeTime=-2y"),
+                )
+            return
+
+        attr = af.AFAttribute(
+            af.Name(row.name),
+            af.Description(row.type)
+        )
+        if row.uom is not None:
+            if row.uom != '':
+                attr += af.DefaultUOM(row.uom)
+            attr += af.Type(row.aftype)
+            vattr = af.Value(row.value, type=row.aftype)
+
+        ### Analyses are added to the equipment elements by newElement, once
+        ### all equipment and points are known (see addAnalysis)
+        nattr, ispt = self.addTag(attr, row.tagpath)
+        if not ispt and row.uom is not None:
+            nattr += vattr
+        element += nattr
+
+    def addTag(self, attr, tagpath):
+        """Makes the attribute a PI Point reference to the point's tag, if it has one"""
+        if tagpath is None:
+            return attr, False
+        attr += af.DataReference("PI Point")
+        attr += af.ConfigString(f"{tagpath};RelativeTime=-2y")
+        return attr, True
+
+    def unitAttributes(self, unit):
+        """(AF unit of measure, attribute type, default value) for a Brick unit, from self.units"""
+        entry = self.units.get(unit.split('#')[-1])
+        if entry is None:
+            return None, None, None
+        if isinstance(entry, str):
+            return entry, 'Int32', ''
+        return entry.get('uom', ''), entry.get('type', 'Int32'), entry.get('value', '')
 
     def getUOMs(self, obj):
-        uom = None
-        aftype = None
-        value = None
-        for __, __, unit in self.graph.triples((obj, self.BRICK['hasUnit'], None)):
-            unit = unit.split('#')[-1]
-            if unit == 'DEG_F':
-                uom = '°F'
-                aftype = 'Int32'
-                value = ""
-            elif unit == 'OnOff':
-                uom = ''
-                aftype = 'Boolean'
-                value = "False"
-            elif unit == 'Percent' or unit == 'HR':
-                uom = '%'
-                aftype = 'Int32'
-                value = ""
-            elif unit == 'PPM':
-                uom = 'ppm'
-                aftype = 'Int32'
-                value = ""
-            elif unit == 'GAL_UK-PER-MIN':
-                uom = 'US gal/min'
-                aftype = 'Int32'
-                value = ""
+        uom, aftype, value = None, None, None
+        for unit in self.graph.objects(obj, self.BRICK['hasUnit']):
+            attributes = self.unitAttributes(unit)
+            if attributes[0] is not None:
+                uom, aftype, value = attributes
         return uom, aftype, value
-    
+
+    POINT_COLUMNS = ['name', 'type', 'unit', 'uom', 'aftype', 'value', 'tag', 'tagpath']
+
+    def point_table(self, types, edges):
+        """
+        One row per point (object of hasPoint or subject of isPointOf), indexed by the
+        point, with what addpoint needs: its name and Brick type, the last unit with a
+        mapping in self.units and the AF unit of measure, type and default value it
+        maps to, and its first tag with that tag's full path. Built from the edges of
+        index_graph, so it takes no graph lookups per point.
+        """
+        has_point, is_point_of = self.BRICK['hasPoint'], self.BRICK['isPointOf']
+        has_unit, has_tag = self.BRICK['hasUnit'], self.BRICK['hasTag']
+        points, units, tags = {}, {}, {}
+        for subj, pred, obj in edges:
+            if pred == has_point:
+                points[obj] = None
+            elif pred == is_point_of:
+                points[subj] = None
+            elif pred == has_unit and self.unitAttributes(obj)[0] is not None:
+                units[subj] = obj
+            elif pred == has_tag:
+                tags.setdefault(subj, obj)
+
+        columns = {column: [] for column in self.POINT_COLUMNS}
+        for point in points:
+            unit = units.get(point)
+            uom, aftype, value = self.unitAttributes(unit) if unit is not None else (None, None, None)
+            tag = tags.get(point)
+            columns['name'].append(point.split('#')[-1])
+            columns['type'].append(types.get(point) or "")
+            columns['unit'].append(unit)
+            columns['uom'].append(uom)
+            columns['aftype'].append(aftype)
+            columns['value'].append(value)
+            columns['tag'].append(tag)
+            columns['tagpath'].append(None if tag is None else self.findFullPath(tag))
+        return pd.DataFrame(columns, index=pd.Index(list(points), name='point', dtype=object), dtype=object)
+
+    def validRulesFor(self, candidate):
+        """Successful entries of validrules for the focus node, grouped once per validrules list"""
+        if getattr(self, '_validrules_index', (None, None))[0] is not self.validrules:
+            index = defaultdict(list)
+            for res in self.validrules:
+                if res['success']:
+                    index[res['focus_node']].append(res)
+            self._validrules_index = (self.validrules, index)
+        return self._validrules_index[1].get(str(candidate), [])
+
     def addAnalysis(self, candidate):
         all_analyses = []
-        for res in self.validrules:
-            if res['success'] and res['focus_node'] == str(candidate):
-                rulename = res['rule'].split('#')[-1]
-                aname = f"{candidate.split('#')[-1]} {rulename}"
-                newanalysis = af.AFAnalysis(af.Name(aname))
-                newanalysis += af.Status("Enabled")
-                newanalysis += af.Target(af.AFElementRef(self.findFullPath(self.getParent(candidate))))
-                newanalysis += af.AFAnalysisCategoryRef('Analytics')
-                analysisrule = af.AFAnalysisRule()
-                analysisrule += af.AFPlugIn("PerformanceEquation")
-                perfstr = self.match_equation(res['details'], self.afddrules[rulename]['output'])
-                analysisrule += af.ConfigString(perfstr)
-                analysisrule += af.VariableMapping(f"Output||{aname};")
-                newanalysis += analysisrule
-                newanalysis += af.AFTimeRule(
-                    af.AFPlugIn(self.afddrules[rulename]["aftimerule"]),
-                    af.ConfigString(f"Frequency={self.afddrules[rulename]['frequency']}")
-                    )
-                all_analyses.append(newanalysis)
-        if all_analyses != []:
-            print(all_analyses)
+        for res in self.validRulesFor(candidate):
+            rulename = res['rule'].split('#')[-1]
+            aname = f"{candidate.split('#')[-1]} {rulename}"
+            newanalysis = af.AFAnalysis(af.Name(aname))
+            newanalysis += af.Status("Enabled")
+            newanalysis += af.Target(af.AFElementRef(self.findFullPath(self.getParent(candidate))))
+            newanalysis += af.AFAnalysisCategoryRef('Analytics')
+            analysisrule = af.AFAnalysisRule()
+            analysisrule += af.AFPlugIn("PerformanceEquation")
+            perfstr = self.match_equation(res['details'], self.afddrules[rulename]['output'])
+            analysisrule += af.ConfigString(perfstr)
+            analysisrule += af.VariableMapping(f"Output||{aname};")
+            newanalysis += analysisrule
+            newanalysis += af.AFTimeRule(
+                af.AFPlugIn(self.afddrules[rulename]["aftimerule"]),
+                af.ConfigString(f"Frequency={self.afddrules[rulename]['frequency']}")
+                )
+            all_analyses.append(newanalysis)
+        if all_analyses:
+            logger.debug(f"{len(all_analyses)} analyses for {candidate}")
         return all_analyses
     
+    # smallest number of structurally identical elements that share a template
+    TEMPLATE_MIN_INSTANCES = 2
+
+    def element_templates(self, types, edges, points):
+        """
+        Groups the equipment by Brick class, points (named after their Brick class,
+        numbered when it repeats, with their unit, type and default value) and analyses
+        (rule and the attributes its equation uses), and creates an element template
+        for every group of at least TEMPLATE_MIN_INSTANCES elements. Returns
+        element -> (template name, point -> attribute name) for the templated elements.
+        """
+        has_point, is_point_of = self.BRICK['hasPoint'], self.BRICK['isPointOf']
+        equipment_points = defaultdict(dict)
+        for subj, pred, obj in edges:
+            if pred == has_point:
+                equipment_points[subj][obj] = None
+            elif pred == is_point_of:
+                equipment_points[obj][subj] = None
+
+        groups = defaultdict(list)
+        for node, node_points in equipment_points.items():
+            rows = sorted((points[point] for point in node_points), key=lambda row: (row.type, row.name))
+            attribute_names, counts = {}, defaultdict(int)
+            for row in rows:
+                base = row.type or row.name
+                counts[base] += 1
+                attribute_names[row.Index] = base if counts[base] == 1 else f"{base}_{counts[base]}"
+            attributes = tuple(
+                (attribute_names[row.Index], row.type, row.uom, row.aftype, row.value, row.tagpath is not None)
+                for row in rows
+            )
+            by_name = {str(point): name for point, name in attribute_names.items()}
+            analyses = tuple(sorted(
+                (res['rule'].split('#')[-1], tuple(sorted(
+                    (metapoint, by_name.get(bound, bound.split('#')[-1])) for metapoint, bound in res['details'].items()
+                )))
+                for res in self.validRulesFor(node)
+            ))
+            groups[(types.get(node), attributes, analyses)].append((node, attribute_names))
+
+        element_templates = {}
+        for (nodetype, attributes, analyses), members in groups.items():
+            if len(members) < self.TEMPLATE_MIN_INSTANCES:
+                continue
+            base = nodetype or "Element"
+            name, suffix = base, 1
+            while name in self.templates['Element']:
+                suffix += 1
+                name = f"{base}_{suffix}"
+            self.check_for_template(name, (name, nodetype, attributes, analyses), 'Element')
+            for node, attribute_names in members:
+                element_templates[node] = (name, attribute_names)
+        return element_templates
+
     def check_for_template(self, name, args, ttype):
-        return self.templates[ttype][name] if name in self.templates[ttype].keys() else self.create_template(args, ttype)
-        
+        if name not in self.templates[ttype]:
+            self.templates[ttype][name] = self.create_template(args, ttype)
+        return self.templates[ttype][name]
+
     def create_template(self, args, ttype):
-        
         if ttype == 'Analysis':
-            return self.create_analysis_template()
+            return self.create_analysis_template(*args)
         elif ttype == 'Element':
-            return self.create_element_template()
+            return self.create_element_template(*args)
         elif ttype == 'Attribute':
-            return self.create_attribute_template()
+            return self.create_attribute_template(*args)
         else:
             raise ValueError(f"Cannot create template with type: {ttype}. Please ensure the template type is one of [Analysis, Element, Attribute]")
 
-    def create_attribute_template(self, attrs):
-        pass
-
-    def create_element_template(self, attrs):
-        pass
-
-    def create_analysis_template(self, name, rule):
-        nt = af.AFAnalysisTemplate(af.Name(rule[name]), id=name)
-        # may need to create new element template AFElementTemplate and link to it in CaseTemplate and use AFElelement in Target
-        #net = af.AFElementTemplate(af.Name(rule[name]+'_ElementTemplate'))
-        # may need to create new attribute templates for each element template?
-        #net += af.AFAttributeTemplate(af.Name(f"{rule[name]}_{attr}_AttributeTemplate"))
-        # 
-    
-
+    def create_attribute_template(self, name, pointtype, uom, aftype, value, ispt):
+        template = af.AFAttributeTemplate(af.Name(name), af.Description(pointtype))
+        if uom is not None:
+            if uom != '':
+                template += af.DefaultUOM(uom)
+            template += af.Type(aftype)
+            if not ispt:
+                template += af.Value(value, type=aftype)
+        if ispt:
+            # the ConfigString with the tag is set on every element
+            template += af.DataReference("PI Point")
+        return template
+
+    def create_element_template(self, name, nodetype, attributes, analyses):
+        template = af.AFElementTemplate(af.Name(name), af.id(self.elementId(f"urn:af:element-template:{name}")))
+        template += af.Description(nodetype if nodetype is not None else "No description")
+        for attribute in attributes:
+            template += self.check_for_template(f"{name}|{attribute[0]}", attribute, 'Attribute')
+        for rulename, details in analyses:
+            template += self.check_for_template(f"{name}|{rulename}", (rulename, dict(details)), 'Analysis')
+        return template
+
+    def create_analysis_template(self, rulename, details):
+        """Analysis template of a rule; details maps the rule's points to attribute names"""
+        rule = self.afddrules[rulename]
+        template = af.AFAnalysisTemplate(af.Name(rulename))
+        template += af.AFAnalysisCategoryRef('Analytics')
+        analysisrule = af.AFAnalysisRule()
+        analysisrule += af.AFPlugIn("PerformanceEquation")
+        analysisrule += af.ConfigString(self.match_equation(details, rule['output']))
+        analysisrule += af.VariableMapping(f"Output||{rulename};")
+        template += analysisrule
+        template += af.AFTimeRule(
+            af.AFPlugIn(rule["aftimerule"]),
+            af.ConfigString(f"Frequency={rule['frequency']}")
+        )
+        return template
 
     def match_equation(self, details, output):
         for metapoint in details.keys():
             output = output.replace(metapoint, details[metapoint].split('#')[-1])
         return output
 
-    def getParent(self, obj):
+    # child -> parent relationships, in both directions
+    PARENT_PREDICATES = ['isPartOf', 'hasLocation', 'isPointOf']
+    CHILD_PREDICATES = ['hasPart', 'isLocationOf', 'hasPoint']
+
+    def hierarchy(self):
+        """
+        The parent and AF path of every node, computed in one pass over the graph and
+        kept until self.graph is replaced, loaded into or exported again; call
+        forget_hierarchy after editing the graph in place otherwise. A node's parent is the subject of a hasPart /
+        isLocationOf / hasPoint triple pointing at it or, failing that, the object of
+        its isPartOf / hasLocation / isPointOf triple. Its path is the parent's path
+        followed by its own name (rdfs:label or local name), separated by a backslash.
+        A cycle in the hierarchy is logged and the climb stops at the repeated node.
+        """
+        if self._hierarchy is not None and self._hierarchy[0] is self.graph:
+            return self._hierarchy[1], self._hierarchy[2]
+
+        parent_preds = {self.BRICK[p] for p in self.PARENT_PREDICATES}
+        child_preds = {self.BRICK[p] for p in self.CHILD_PREDICATES}
+        labels, up, down = {}, {}, {}
         for s, p, o in self.graph.triples((None, None, None)):
-            if p in [self.BRICK["hasPart"], self.BRICK['hasPoint'], self.BRICK['isLocationOf']] and o == obj:
-                return s
-            if p in [self.BRICK["isPartOf"], self.BRICK['isPointOf'], self.BRICK['hasLocation']] and s == obj:
-                return o
+            if p == RDFS['label']:
+                labels[s] = o
+            elif p in parent_preds and s != o:
+                up[s] = o
+            elif p in child_preds and s != o:
+                down[o] = s
+        parents = {**up, **down}
+
+        paths = {}
+        for node in parents:
+            # climb until a node whose path is known (or a root), then fill in the chain
+            chain, seen = [], set()
+            current = node
+            while current not in paths and current not in seen:
+                seen.add(current)
+                chain.append(current)
+                if current not in parents:
+                    break
+                current = parents[current]
+            else:
+                if current in seen:
+                    logger.warning(f"Cycle in the AF hierarchy at {current}; cutting its path there")
+                    chain = chain[:chain.index(current)]
+                    paths[current] = str(labels.get(current, current.split('#')[-1]))
+            for member in reversed(chain):
+                name = str(labels.get(member, member.split('#')[-1]))
+                parent = parents.get(member)
+                paths[member] = f"{paths[parent]}\\{name}" if parent in paths else name
+        self._hierarchy = (self.graph, parents, paths)
+        return parents, paths
+
+    def forget_hierarchy(self):
+        self._hierarchy = None
 
-    def findFullPath(self, obj):
+    def getParent(self, obj):
+        return self.hierarchy()[0].get(obj)
 
+    def findFullPath(self, obj):
+        path = self.hierarchy()[1].get(obj)
+        if path is not None:
+            return path
         objpath = obj.split('#')[-1]
         for _, _, label in self.graph.triples((obj, RDFS['label'], None)):
             objpath = label
-        while True:
-            parent = ''
-            for s, p, o in self.graph.triples((obj, None, None)):
-                if p in [self.BRICK['isPartOf'], self.BRICK['hasLocation'], self.BRICK['isPointOf']]:
-                    if obj != o:
-                        obj = o
-                        name = o.split('#')[-1]
-                        for _, _, label in self.graph.triples((o, RDFS['label'], None)):
-                            name = label
-                        parent = name
-            for s, p, o in self.graph.triples((None, None, obj)):
-                if p in [self.BRICK['hasPart'], self.BRICK['isLocationOf'], self.BRICK['hasPoint']]:
-                    if obj != s:
-                        obj = s
-                        name = s.split('#')[-1]
-                        for _, _, label in self.graph.triples((s, RDFS['label'], None)):
-                            name = label
-                        parent = name
-            
-            if parent == '':
-                break
-            else:
-                objpath = parent + "\\" + objpath
         return objpath
     
     def add_template(self):
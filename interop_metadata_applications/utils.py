@@ -1,21 +1,37 @@
+import hashlib
 from lxml import etree
 from xmldiff import main, formatting
 
+from interop_metadata_applications.afxml import write_xml
+from interop_metadata_applications.af_delta import compare_exports, format_comparison
+
 def pretty_print(element):
     """Simple printing of an xml element from the bsync library"""
     print(etree.tostring(element.toxml(), pretty_print=True).decode('utf-8'))
     
 def xml_dump(root_element, file="example1.xml"):
     """Write the element to the specified file"""
-    doctype = '<?xml version="1.0" encoding="UTF-8"?>'
-    as_etree = root_element.toxml()
-    #as_etree.set("xmlns", "http://buildingsync.net/schemas/bedes-auc/2019")
-    output = etree.tostring(as_etree, doctype=doctype, pretty_print=True)
-    with open(file, 'wb+') as f:
-        f.write(output)
-        return True
+    write_xml(root_element, file)
+    return True
     
 def xml_compare(left, right):
     file_diff = main.diff_files(left, right, diff_options={'ratio_mode':'faster'},
                        formatter=formatting.XMLFormatter())
-    return file_diff
\ No newline at end of file
+    return file_diff
+
+def xml_compare_keyed(left, right):
+    """
+    Differences between two AFXML exports, with the elements matched by id (or Name
+    path) and compared by digest in one streaming pass over each file instead of
+    xml_compare's tree diff of the whole documents, which is much slower on large
+    databases. Returns the af_delta.compare_exports report rendered for review.
+    """
+    return format_comparison(compare_exports(left, right))
+
+def graph_fingerprint(graph) -> str:
+    """Order-independent fingerprint of the triples in an rdflib graph"""
+    acc = 0
+    for triple in graph.triples((None, None, None)):
+        digest = hashlib.blake2b(" ".join(term.n3() for term in triple).encode("utf-8"), digest_size=16).digest()
+        acc = (acc + int.from_bytes(digest, "big")) & ((1 << 128) - 1)
+    return f"{len(graph)}-{acc:032x}"
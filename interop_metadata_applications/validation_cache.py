@@ -0,0 +1,210 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from rdflib import Graph
+from rdflib.util import from_n3
+from buildingmotif.dataclasses import Library
+from buildingmotif.namespaces import OWL
+
+from interop_metadata_applications.utils import graph_fingerprint
+
+logger = logging.getLogger(__name__)
+
+VALIDATION_CACHE_DIR = os.getenv("VALIDATION_CACHE_DIR", ".validation-cache")
+MEMORY_CACHE_SIZE = 8
+# fingerprint -> CachedValidationResult for the most recent validations
+_memory_cache: "OrderedDict[str, CachedValidationResult]" = OrderedDict()
+# library uri -> (fingerprint or None if not loaded, uris it imports) inside a library_fingerprint_scope
+_library_fingerprints: ContextVar[Optional[Dict[str, Tuple[Optional[str], List]]]] = ContextVar(
+    "library_fingerprints", default=None
+)
+
+
+class CachedDiff:
+    """The parts of a validation diff that get_model_diffs uses"""
+
+    __slots__ = ("failed_shape", "_reason")
+
+    def __init__(self, failed_shape, reason: str) -> None:
+        self.failed_shape = failed_shape
+        self._reason = reason
+
+    def reason(self) -> str:
+        return self._reason
+
+
+class CachedValidationResult:
+    """
+    Stand-in for a buildingmotif ValidationContext restored from the cache:
+    'valid', 'diffset' ({focus_node: [diff]}) and 'report' (parsed on first use)
+    """
+
+    def __init__(self, valid: bool, diffset: Dict, report_nt: str) -> None:
+        self.valid = valid
+        self.diffset = diffset
+        self._report_nt = report_nt
+        self._report = None
+
+    @property
+    def report(self) -> Graph:
+        if self._report is None:
+            self._report = Graph()
+            self._report.parse(data=self._report_nt, format="nt")
+        return self._report
+
+    @classmethod
+    def from_context(cls, context) -> "CachedValidationResult":
+        diffset = {
+            focus_node: [CachedDiff(diff.failed_shape, diff.reason()) for diff in diffs]
+            for focus_node, diffs in context.diffset.items()
+        }
+        return cls(bool(context.valid), diffset, context.report.serialize(format="nt"))
+
+    def to_json(self) -> dict:
+        # reasons repeat a lot across focus nodes, so store each one once
+        reasons: Dict[str, int] = {}
+        diffset = {}
+        for focus_node, diffs in self.diffset.items():
+            diffset[focus_node.n3()] = [
+                [diff.failed_shape.n3(), reasons.setdefault(diff.reason(), len(reasons))]
+                for diff in diffs
+            ]
+        return {
+            "valid": self.valid,
+            "reasons": list(reasons),
+            "diffset": diffset,
+            "report": self._report_nt,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> "CachedValidationResult":
+        reasons: List[str] = data["reasons"]
+        diffset = {
+            from_n3(focus_node): [CachedDiff(from_n3(shape), reasons[idx]) for shape, idx in diffs]
+            for focus_node, diffs in data["diffset"].items()
+        }
+        return cls(data["valid"], diffset, data["report"])
+
+
+def library_fingerprint(uri) -> Tuple[Optional[str], List]:
+    """
+    (fingerprint of the shape collection, owl:imports) of the library loaded under uri,
+    or (None, []) if there is none. Inside a library_fingerprint_scope every library
+    is hashed once.
+    """
+    memo = _library_fingerprints.get()
+    if memo is not None and uri in memo:
+        return memo[uri]
+    try:
+        graph = Library.load(name=str(uri)).get_shape_collection().graph
+        result = graph_fingerprint(graph), list(graph.objects(None, OWL.imports))
+    except Exception:
+        result = None, []
+    if memo is not None:
+        memo[uri] = result
+    return result
+
+
+@contextmanager
+def library_fingerprint_scope():
+    """
+    Hashes each library at most once inside the block, e.g. one request or job that
+    fingerprints the same manifest for the compiled-model and the validation cache.
+    Nothing is kept across blocks: a library may be changed by any process, and the
+    next block hashes it again.
+    """
+    if _library_fingerprints.get() is not None:
+        yield
+        return
+    token = _library_fingerprints.set({})
+    try:
+        yield
+    finally:
+        _library_fingerprints.reset(token)
+
+
+def manifest_fingerprint(manifest_graph: Graph) -> str:
+    """
+    Fingerprint of the manifest together with the shape collections of every library
+    in its owl:imports closure (see library_fingerprint). Imports that are not loaded
+    as libraries are recorded by name only, like validation with
+    error_on_missing_imports=False.
+    """
+    parts = [graph_fingerprint(manifest_graph)]
+    pending = list(manifest_graph.objects(None, OWL.imports))
+    seen = set()
+    while pending:
+        uri = pending.pop()
+        if uri in seen:
+            continue
+        seen.add(uri)
+        fingerprint, imports = library_fingerprint(uri)
+        if fingerprint is None:
+            parts.append(f"missing:{uri}")
+            continue
+        parts.append(f"{uri}:{fingerprint}")
+        pending.extend(imports)
+    return hashlib.sha256("\n".join(sorted(parts)).encode("utf-8")).hexdigest()
+
+
+def validation_fingerprint(model, fingerprint: Optional[str] = None) -> str:
+    """
+    Key for a validation run: the model graph plus the manifest and its imports.
+    fingerprint is graph_fingerprint(model.graph), if the caller has it already.
+    """
+    model_part = fingerprint or graph_fingerprint(model.graph)
+    manifest_part = manifest_fingerprint(model.get_manifest().graph)
+    return hashlib.sha256(f"{model_part}\n{manifest_part}".encode("utf-8")).hexdigest()
+
+
+def _cache_path(fingerprint: str, cache_dir: str) -> str:
+    return os.path.join(cache_dir, f"{fingerprint}.json.gz")
+
+
+def cached_validate(model, cache_dir: Optional[str] = None, fingerprint: Optional[str] = None):
+    """
+    Returns the result of model.validate(error_on_missing_imports=False), reusing a
+    previous run when neither the model graph nor the manifest (or its imports)
+    changed. Results are kept in memory for the most recent models and on disk as
+    gzipped JSON under cache_dir (VALIDATION_CACHE_DIR, default .validation-cache).
+    fingerprint is graph_fingerprint(model.graph), if the caller has it already.
+    """
+    cache_dir = cache_dir or VALIDATION_CACHE_DIR
+    fingerprint = validation_fingerprint(model, fingerprint)
+
+    result = _memory_cache.get(fingerprint)
+    if result is not None:
+        logger.info(f"Validation cache hit (memory) for {fingerprint}")
+        _memory_cache.move_to_end(fingerprint)
+        return result
+
+    path = _cache_path(fingerprint, cache_dir)
+    if os.path.exists(path):
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                result = CachedValidationResult.from_json(json.load(f))
+            logger.info(f"Validation cache hit (disk) for {fingerprint}")
+        except (OSError, ValueError, KeyError):
+            logger.exception(f"Ignoring unreadable validation cache entry {path}")
+            result = None
+
+    if result is None:
+        context = model.validate(error_on_missing_imports=False)
+        result = CachedValidationResult.from_context(context)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(result.to_json(), f)
+        os.replace(tmp_path, path)
+
+    _memory_cache[fingerprint] = result
+    while len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return result
@@ -0,0 +1,11 @@
+import pytest
+from buildingmotif import BuildingMOTIF
+
+
+@pytest.fixture(scope="session")
+def building_motif():
+    """In-memory BuildingMOTIF instance (a singleton, so the one Translator() may have created already)"""
+    bm = BuildingMOTIF("sqlite://", shacl_engine="pyshacl")
+    bm.shacl_engine = "pyshacl"
+    bm.setup_tables()
+    return bm
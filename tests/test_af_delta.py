@@ -0,0 +1,103 @@
+from lxml import etree
+from rdflib import Graph, Literal, Namespace, RDF, RDFS
+
+from interop_metadata_applications.af_delta import compare_exports, delta_tree, export_state, format_comparison, tree_state
+from interop_metadata_applications.afxml import iter_xml, write_xml
+from interop_metadata_applications.ttl_to_af import Translator
+
+EX = Namespace("urn:example#")
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+
+
+def building(vavs=("vav1", "vav2")) -> Graph:
+    """A site with an AHU and its VAVs, each with a tagged supply and zone temperature sensor"""
+    graph = Graph()
+    graph.add((EX["site"], RDF.type, BRICK["Site"]))
+    graph.add((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    graph.add((EX["site"], BRICK["hasPart"], EX["ahu1"]))
+    for vav in vavs:
+        graph.add((EX[vav], RDF.type, BRICK["Variable_Air_Volume_Box"]))
+        graph.add((EX["ahu1"], BRICK["hasPart"], EX[vav]))
+        for point in ("Supply_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor"):
+            graph.add((EX[f"{vav}_{point}"], RDF.type, BRICK[point]))
+            graph.add((EX[vav], BRICK["hasPoint"], EX[f"{vav}_{point}"]))
+            graph.add((EX[f"{vav}_{point}"], BRICK["hasTag"], EX[f"{vav}_{point}_tag"]))
+    return graph
+
+
+def changed_building() -> Graph:
+    """building() with vav1 renamed and given a CO2 sensor, and vav2 gone"""
+    graph = building(vavs=("vav1",))
+    graph.add((EX["vav1"], RDFS.label, Literal("VAV-1")))
+    graph.add((EX["vav1_co2"], RDF.type, BRICK["CO2_Sensor"]))
+    graph.add((EX["vav1"], BRICK["hasPoint"], EX["vav1_co2"]))
+    return graph
+
+
+def export(graph, path=None, templates=False):
+    translator = Translator()
+    translator.add_rules_from_dict({}, {})
+    translator.graph = graph
+    tree = translator.build_af_tree(templates)
+    if path is not None:
+        write_xml(tree, str(path))
+    return tree
+
+
+def element_id(name):
+    return Translator().elementId(EX[name])
+
+
+def test_tree_state_matches_the_written_export(building_motif, tmp_path):
+    for templates in (False, True):
+        path = tmp_path / f"export_{templates}.xml"
+        tree = export(building(), path, templates)
+        state = tree_state(tree)
+        assert state == export_state(str(path))
+        assert state[element_id("vav1")][3] == element_id("ahu1")
+
+
+def test_delta_holds_the_changes_and_deletes_the_removed_elements(building_motif):
+    previous = tree_state(export(building()))
+    delta, counts = delta_tree(export(changed_building()), previous)
+    # vav1 changed, its CO2 sensor is new, and vav2 went with its two points
+    assert counts == {"added": 1, "changed": 1, "removed": 3}
+
+    document = etree.fromstring(b"".join(iter_xml(delta)))
+    [site] = document.findall("AFDatabase/AFElement")
+    assert [child.tag for child in site] == ["id", "Name", "AFElement"]
+    [ahu] = site.findall("AFElement")
+    assert [child.tag for child in ahu] == ["id", "Name", "AFElement", "AFElement"]
+    vav1, removed = ahu.findall("AFElement")
+    assert vav1.findtext("Name") == "VAV-1"
+    assert {a.findtext("Name") for a in vav1.findall("AFAttribute")} == {
+        "vav1_Supply_Air_Temperature_Sensor", "vav1_Zone_Air_Temperature_Sensor", "vav1_co2",
+    }
+    # only the new point is nested under vav1; the unchanged ones are left out
+    assert [e.findtext("id") for e in vav1.findall("AFElement")] == [element_id("vav1_co2")]
+    # the points of vav2 are deleted with it
+    assert removed.get("operation") == "delete"
+    assert removed.findtext("id") == element_id("vav2") and len(removed) == 2
+    assert len(document.xpath("//*[@operation='delete']")) == 1
+
+
+def test_unchanged_export_has_an_empty_delta(building_motif):
+    previous = tree_state(export(building()))
+    delta, counts = delta_tree(export(building()), previous)
+    assert counts == {"added": 0, "changed": 0, "removed": 0}
+    assert etree.fromstring(b"".join(iter_xml(delta))).findall("AFDatabase/AFElement") == []
+
+
+def test_compare_exports(building_motif, tmp_path):
+    export(building(), tmp_path / "left.xml")
+    export(changed_building(), tmp_path / "right.xml")
+    report = compare_exports(str(tmp_path / "left.xml"), str(tmp_path / "right.xml"))
+
+    assert [(c["key"], c["elements"]) for c in report["added"]] == [(element_id("vav1_co2"), 1)]
+    assert [(c["key"], c["parent"], c["elements"]) for c in report["removed"]] == [
+        (element_id("vav2"), element_id("ahu1"), 3),
+    ]
+    [vav1] = [c for c in report["modified"] if c["key"] == element_id("vav1")]
+    assert vav1["content"] and vav1["attributes"] == {"added": ["vav1_co2"], "removed": [], "changed": []}
+    assert report["summary"] == {"added": 1, "removed": 3, "modified": len(report["modified"])}
+    assert "- AFElement site\\ahu1\\vav2 (3 elements)" in format_comparison(report)
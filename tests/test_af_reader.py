@@ -0,0 +1,45 @@
+from rdflib import Graph, Literal, Namespace, RDF
+
+from interop_metadata_applications.af_reader import BRICK, REF
+from interop_metadata_applications.afxml import write_xml
+from interop_metadata_applications.ttl_to_af import Translator
+
+EX = Namespace("urn:example#")
+POINTS = ("Supply_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor")
+
+
+def building() -> Graph:
+    """An AHU with two VAVs that share their points, so a templated export bases them on one template"""
+    graph = Graph()
+    graph.add((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    for vav in ("vav1", "vav2"):
+        graph.add((EX[vav], RDF.type, BRICK["Variable_Air_Volume_Box"]))
+        graph.add((EX["ahu1"], BRICK["hasPart"], EX[vav]))
+        for point in POINTS:
+            graph.add((EX[f"{vav}_{point}"], RDF.type, BRICK[point]))
+            graph.add((EX[vav], BRICK["hasPoint"], EX[f"{vav}_{point}"]))
+            graph.add((EX[f"{vav}_{point}"], BRICK["hasTag"], EX[f"{vav}_{point}_tag"]))
+    return graph
+
+
+def test_lift_of_a_templated_export(building_motif, tmp_path):
+    translator = Translator()
+    translator.add_rules_from_dict({}, {})
+    translator.graph = building()
+    path = str(tmp_path / "templated.xml")
+    write_xml(translator.build_af_tree(templates=True), path)
+    assert b"<AFElementTemplate>" in open(path, "rb").read()
+
+    lifted = translator.read_pi_database(path)
+    assert set(lifted.objects(EX["ahu1"], BRICK["hasPart"])) == {EX["vav1"], EX["vav2"]}
+    for vav in ("vav1", "vav2"):
+        instance = EX[vav]
+        assert (instance, RDF.type, BRICK["Variable_Air_Volume_Box"]) in lifted
+        # the attributes named after the template are matched back to the point elements
+        assert set(lifted.objects(instance, BRICK["hasPoint"])) == {EX[f"{vav}_{point}"] for point in POINTS}
+        for point in POINTS:
+            node = EX[f"{vav}_{point}"]
+            assert (node, RDF.type, BRICK[point]) in lifted
+            # the PI Point reference comes from the template, the tag from the element
+            [reference] = lifted.objects(node, REF["hasExternalReference"])
+            assert (reference, REF["hasTimeseriesId"], Literal(f"{vav}_{point}_tag")) in lifted
@@ -0,0 +1,58 @@
+import buildingmotif.dataclasses.compiled_model
+import buildingmotif.dataclasses.model
+from buildingmotif.dataclasses import Model
+from rdflib import Namespace, RDF
+from rdflib.compare import isomorphic
+
+from interop_metadata_applications import model_cache
+from interop_metadata_applications.model_cache import compiled_model
+
+EX = Namespace("urn:example#")
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+# a manifest with an inference rule, so compiling adds a triple
+MANIFEST = """
+@prefix sh: <http://www.w3.org/ns/shacl#> .
+@prefix brick: <https://brickschema.org/schema/Brick#> .
+@prefix ex: <urn:example#> .
+ex:ahu_shape a sh:NodeShape ;
+    sh:targetClass brick:AHU ;
+    sh:rule [ a sh:TripleRule ; sh:subject sh:this ; sh:predicate brick:hasTag ; sh:object ex:equipment ] .
+"""
+
+
+def test_disk_hit_restores_the_compiled_graph_without_inference(building_motif, tmp_path, monkeypatch):
+    model = Model.create("urn:example/model_cache")
+    model.add_triples((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    model.get_manifest().graph.parse(data=MANIFEST, format="turtle")
+    fresh = model.compile()
+    assert (EX["ahu1"], BRICK["hasTag"], EX["equipment"]) in fresh.graph
+
+    compiled_model(model, cache_dir=str(tmp_path))
+    model_cache._memory_cache.clear()
+
+    def shacl_inference(*args, **kwargs):
+        raise AssertionError("SHACL inference ran on a disk hit")
+
+    monkeypatch.setattr(buildingmotif.dataclasses.compiled_model, "shacl_inference", shacl_inference)
+    monkeypatch.setattr(buildingmotif.dataclasses.model, "shacl_inference", shacl_inference)
+    restored = compiled_model(model, cache_dir=str(tmp_path))
+    assert [sc.id for sc in restored.shape_collections] == [sc.id for sc in fresh.shape_collections]
+    assert isomorphic(restored._compiled_graph, fresh._compiled_graph)
+    assert isomorphic(restored.graph, fresh.graph)
+
+
+def test_memory_hit_until_the_model_or_manifest_changes(building_motif, tmp_path):
+    model_cache._memory_cache.clear()
+    model = Model.create("urn:example/model_cache_invalidation")
+    model.add_triples((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    model.get_manifest().graph.parse(data=MANIFEST, format="turtle")
+    first = compiled_model(model, cache_dir=str(tmp_path))
+    assert compiled_model(model, cache_dir=str(tmp_path)) is first
+
+    model.add_triples((EX["ahu2"], RDF.type, BRICK["AHU"]))
+    second = compiled_model(model, cache_dir=str(tmp_path))
+    assert second is not first
+    assert (EX["ahu2"], BRICK["hasTag"], EX["equipment"]) in second.graph
+
+    model.get_manifest().graph.add((EX["other_shape"], RDF.type, BRICK["AHU"]))
+    assert compiled_model(model, cache_dir=str(tmp_path)) is not second
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+from interop_metadata_applications.outcomes_store import query_outcomes, write_outcomes
+
+
+def test_latest_is_applied_before_filters(tmp_path):
+    outcomes_dir = str(tmp_path)
+    write_outcomes(
+        "r1", 1, {}, {"urn:rule": {"urn:ahu1": ["missing point"]}},
+        created=datetime(2026, 1, 1, tzinfo=timezone.utc), outcomes_dir=outcomes_dir,
+    )
+    write_outcomes(
+        "r2", 1, {"urn:rule": {"urn:ahu1": {}}}, {},
+        created=datetime(2026, 1, 2, tzinfo=timezone.utc), outcomes_dir=outcomes_dir,
+    )
+
+    # the latest run of model 1 (r2) has no failures
+    assert query_outcomes(["run"], {"status": "failure"}, latest=True, outcomes_dir=outcomes_dir) == []
+    assert query_outcomes(["run"], {"status": "success"}, latest=True, outcomes_dir=outcomes_dir) == [
+        {"run": "r2", "rows": 1, "focus_nodes": 1, "runs": 1}
+    ]
+    assert query_outcomes(["run"], {"status": "failure"}, outcomes_dir=outcomes_dir) == [
+        {"run": "r1", "rows": 1, "focus_nodes": 1, "runs": 1}
+    ]
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+from rdflib import Graph, Namespace, RDF
+
+from interop_metadata_applications import rule_cache
+from interop_metadata_applications.rule_cache import cached_apply_rules
+
+EX = Namespace("urn:example#")
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+RULES = {
+    "SAT": {"applicability": ["AHU"], "definitions": {"sat": "Supply_Air_Temperature_Sensor"}},
+    "ZAT": {"applicability": ["Variable_Air_Volume_Box"], "definitions": {"zat": "Zone_Air_Temperature_Sensor"}},
+}
+
+
+def model() -> SimpleNamespace:
+    """Stand-in for a compiled model: the rule cache and engines only use its graph"""
+    graph = Graph()
+    graph.add((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    graph.add((EX["ahu1"], BRICK["hasPoint"], EX["sat1"]))
+    graph.add((EX["sat1"], RDF.type, BRICK["Supply_Air_Temperature_Sensor"]))
+    return SimpleNamespace(graph=graph)
+
+
+def test_rule_cache_hits_and_invalidation():
+    rule_cache._rule_cache.clear()
+    compiled = model()
+    stats = {}
+    bindings, hit = cached_apply_rules(compiled, RULES, stats=stats)
+    assert hit is False
+    assert bindings["urn:rules_manifest/SAT"][EX["ahu1"]]["sat"] == EX["sat1"]
+    assert stats == {"evaluated": 1, "skipped": 1}
+
+    # the same rules in another key order, and the stats of the cached run
+    stats = {}
+    reordered = dict(reversed(list(RULES.items())))
+    cached, hit = cached_apply_rules(compiled, reordered, stats=stats)
+    assert hit is True and cached == bindings and stats == {"evaluated": 1, "skipped": 1}
+    # callers get their own copy
+    cached["urn:rules_manifest/SAT"].clear()
+    assert cached_apply_rules(compiled, RULES)[0] == bindings
+
+    # an edit of the same size is a different model
+    compiled.graph.remove((EX["sat1"], RDF.type, BRICK["Supply_Air_Temperature_Sensor"]))
+    compiled.graph.add((EX["sat1"], RDF.type, BRICK["Return_Air_Temperature_Sensor"]))
+    changed, hit = cached_apply_rules(compiled, RULES)
+    assert hit is False and not changed["urn:rules_manifest/SAT"]
+
+    # other rules, another engine and closures are all separate entries
+    assert cached_apply_rules(compiled, {"SAT": RULES["SAT"]})[1] is False
+    assert cached_apply_rules(compiled, RULES, engine="sparse")[1] is False
+    assert cached_apply_rules(compiled, RULES, closures=True)[1] is False
+    assert cached_apply_rules(compiled, RULES, use_cache=False)[1] is None
+
+
+def test_rule_cache_evicts_the_least_recently_used(monkeypatch):
+    rule_cache._rule_cache.clear()
+    monkeypatch.setattr(rule_cache, "RULE_CACHE_SIZE", 1)
+    first, second = model(), model()
+    second.graph.add((EX["ahu2"], RDF.type, BRICK["AHU"]))
+    cached_apply_rules(first, RULES)
+    cached_apply_rules(second, RULES)
+    assert cached_apply_rules(second, RULES)[1] is True
+    assert cached_apply_rules(first, RULES)[1] is False
@@ -0,0 +1,85 @@
+import pytest
+from rdflib import Graph, Namespace, RDF
+
+from interop_metadata_applications.sparse_rules import SparseModel
+from interop_metadata_applications.transform import BRICK, CLOSURE_RELATIONSHIPS, rule_bindings, with_closures
+
+EX = Namespace("urn:example#")
+RULES = {
+    "points or damper points": {
+        "applicability": ["AHU"],
+        "definitions": {
+            "sat": {"choice": [{"hasPoint": "Supply_Air_Temperature_Sensor"}, {"hasPart": {"Damper": {"hasPoint": "Supply_Air_Temperature_Sensor"}}}]},
+            "oat": "Outside_Air_Temperature_Sensor",
+        },
+    },
+    "downstream zones": {
+        "applicability": ["AHU"],
+        "definitions": {
+            "zat": {"feeds+": {"Variable_Air_Volume_Box": {"hasPoint": "Zone_Air_Temperature_Sensor"}}},
+        },
+    },
+    "parts at any depth": {
+        "applicability": ["Building", "AHU"],
+        "definitions": {
+            "damper": {"hasPart*": "Damper"},
+            "site": {"isPartOf+": "Site"},
+        },
+    },
+}
+
+
+def building() -> Graph:
+    """
+    Site > building > AHUs > dampers, each AHU feeding a chain of VAVs. Points are
+    added in descending order, so the first one indexed is not the smallest.
+    """
+    graph = Graph()
+    graph.add((EX["site"], RDF.type, BRICK["Site"]))
+    graph.add((EX["bldg"], RDF.type, BRICK["Building"]))
+    graph.add((EX["bldg"], BRICK["isPartOf"], EX["site"]))
+    for a in range(4):
+        ahu = EX[f"ahu{a}"]
+        graph.add((ahu, RDF.type, BRICK["AHU"]))
+        graph.add((EX["bldg"], BRICK["hasPart"], ahu))
+        graph.add((ahu, BRICK["isPartOf"], EX["bldg"]))
+        for k in reversed(range(3)):
+            point = EX[f"ahu{a}_oat{k}"]
+            graph.add((point, RDF.type, BRICK["Outside_Air_Temperature_Sensor"]))
+            graph.add((ahu, BRICK["hasPoint"], point))
+        # the supply temperature is on the AHU for some and on its damper for others
+        damper = EX[f"ahu{a}_damper"]
+        graph.add((damper, RDF.type, BRICK["Damper"]))
+        graph.add((ahu, BRICK["hasPart"], damper))
+        sat = EX[f"ahu{a}_sat"]
+        graph.add((sat, RDF.type, BRICK["Supply_Air_Temperature_Sensor"]))
+        graph.add((ahu if a % 2 else damper, BRICK["hasPoint"], sat))
+        upstream = ahu
+        for v in range(a):
+            vav = EX[f"ahu{a}_vav{v}"]
+            graph.add((vav, RDF.type, BRICK["Variable_Air_Volume_Box"]))
+            graph.add((upstream, BRICK["feeds"], vav))
+            upstream = vav
+        if a:
+            zat = EX[f"ahu{a}_zat"]
+            graph.add((zat, RDF.type, BRICK["Zone_Air_Temperature_Sensor"]))
+            graph.add((upstream, BRICK["hasPoint"], zat))
+    return graph
+
+
+@pytest.mark.parametrize("rule", sorted(RULES))
+def test_engines_agree(rule):
+    graph = building()
+    defn = RULES[rule]
+    sparql = rule_bindings(graph, defn)
+    assert sparql
+    assert SparseModel(graph).rule_bindings(defn) == sparql
+    closures = rule_bindings(with_closures(graph, CLOSURE_RELATIONSHIPS), defn, closures=CLOSURE_RELATIONSHIPS)
+    assert closures == sparql
+
+
+def test_engines_agree_on_the_binding_of_several_matches():
+    bindings = SparseModel(building()).rule_bindings(RULES["points or damper points"])
+    assert bindings[EX["ahu0"]]["oat"] == EX["ahu0_oat0"]
+    # the AHU without a downstream zone has no binding
+    assert EX["ahu0"] not in SparseModel(building()).rule_bindings(RULES["downstream zones"])
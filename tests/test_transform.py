@@ -0,0 +1,58 @@
+from rdflib import Graph, Namespace, RDF
+
+from interop_metadata_applications.transform import BRICK, SH, resolve_original_shape, rule_bindings, shape_parent_index
+
+EX = Namespace("urn:example#")
+POINT_CLASSES = [
+    "Supply_Air_Temperature_Sensor",
+    "Return_Air_Temperature_Sensor",
+    "Mixed_Air_Temperature_Sensor",
+    "Outside_Air_Temperature_Sensor",
+]
+RULE = {
+    "applicability": ["AHU"],
+    "definitions": {
+        cls.lower(): {"choice": [{"hasPoint": cls}, {"hasPart": {"Damper": {"hasPoint": cls}}}]}
+        for cls in POINT_CLASSES
+    },
+}
+
+
+def ahu_graph(ahus, points_per_variable):
+    graph = Graph()
+    for a in range(ahus):
+        ahu = EX[f"ahu{a}"]
+        graph.add((ahu, RDF.type, BRICK["AHU"]))
+        for cls in POINT_CLASSES:
+            for k in range(points_per_variable):
+                point = EX[f"ahu{a}_{cls}_{k}"]
+                graph.add((ahu, BRICK["hasPoint"], point))
+                graph.add((point, RDF.type, BRICK[cls]))
+    return graph
+
+
+def test_rule_bindings_with_several_matches_per_variable():
+    graph = ahu_graph(5, 6)
+    instances = rule_bindings(graph, RULE)
+    assert set(instances) == {EX[f"ahu{a}"] for a in range(5)}
+    for instance, row in instances.items():
+        assert row["root"] == instance
+        for cls in POINT_CLASSES:
+            # one binding per variable, the smallest of its matches
+            assert row[cls.lower()] == EX[f"{instance.split('#')[-1]}_{cls}_0"]
+
+
+def test_rule_bindings_needs_every_variable():
+    graph = ahu_graph(2, 3)
+    graph.remove((None, RDF.type, BRICK["Outside_Air_Temperature_Sensor"]))
+    assert rule_bindings(graph, RULE) == {}
+
+
+def test_shape_parent_index_follows_edits_of_the_same_size():
+    shapes = Graph()
+    shapes.add((EX["rule"], SH["property"], EX["shape"]))
+    assert resolve_original_shape(shape_parent_index(shapes), EX["shape"]) == EX["rule"]
+
+    shapes.remove((EX["rule"], SH["property"], EX["shape"]))
+    shapes.add((EX["other_rule"], SH["property"], EX["shape"]))
+    assert resolve_original_shape(shape_parent_index(shapes), EX["shape"]) == EX["other_rule"]
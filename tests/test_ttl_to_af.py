@@ -0,0 +1,150 @@
+from lxml import etree
+from rdflib import Graph, Literal, Namespace, RDF, RDFS
+
+from interop_metadata_applications import af_delta
+from interop_metadata_applications.afxml import iter_xml
+from interop_metadata_applications.ttl_to_af import Translator
+
+EX = Namespace("urn:example#")
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+
+
+def building() -> Graph:
+    graph = Graph()
+    graph.add((EX["site"], RDF.type, BRICK["Site"]))
+    graph.add((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    graph.add((EX["site"], BRICK["hasPart"], EX["ahu1"]))
+    graph.add((EX["sat1"], BRICK["isPointOf"], EX["ahu1"]))
+    return graph
+
+
+def test_hierarchy_cuts_cycles(building_motif):
+    translator = Translator()
+    translator.graph = building()
+    translator.graph.add((EX["ahu1"], BRICK["hasPart"], EX["site"]))
+    parents, paths = translator.hierarchy()
+    assert parents[EX["sat1"]] == EX["ahu1"]
+    # every node gets a path, and the climb stops before visiting a node twice
+    assert set(paths) == {EX["site"], EX["ahu1"], EX["sat1"]}
+    assert paths[EX["sat1"]].endswith("ahu1\\sat1")
+    for path in paths.values():
+        names = path.split("\\")
+        assert len(names) == len(set(names))
+
+
+def test_hierarchy_follows_the_graph(building_motif, tmp_path):
+    translator = Translator()
+    translator.add_rules_from_dict({}, {})
+    translator.graph = building()
+    assert translator.findFullPath(EX["sat1"]) == "site\\ahu1\\sat1"
+
+    # a new graph of the same size
+    translator.graph = building()
+    translator.graph.remove((EX["site"], RDF.type, BRICK["Site"]))
+    translator.graph.add((EX["ahu1"], RDFS.label, Literal("AHU-1")))
+    assert translator.findFullPath(EX["sat1"]) == "site\\AHU-1\\sat1"
+
+    # loaded into the same graph
+    extra = tmp_path / "extra.ttl"
+    Graph().add((EX["sat1"], RDFS.label, Literal("SAT"))).serialize(extra, format="turtle")
+    translator.load(str(extra))
+    assert translator.findFullPath(EX["sat1"]) == "site\\AHU-1\\SAT"
+
+    # edited in place without changing its size, then exported
+    translator.graph.remove((EX["sat1"], RDFS.label, Literal("SAT")))
+    translator.graph.add((EX["sat1"], RDFS.label, Literal("SAT-1")))
+    translator.build_af_tree()
+    assert translator.findFullPath(EX["sat1"]) == "site\\AHU-1\\SAT-1"
+
+
+def equipment() -> Graph:
+    """Two VAVs with the same points, so they share an element template, under one AHU"""
+    graph = building()
+    for vav in ("vav1", "vav2"):
+        graph.add((EX[vav], RDF.type, BRICK["Variable_Air_Volume_Box"]))
+        graph.add((EX["ahu1"], BRICK["hasPart"], EX[vav]))
+        for point in ("Supply_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor"):
+            graph.add((EX[f"{vav}_{point}"], RDF.type, BRICK[point]))
+            graph.add((EX[vav], BRICK["hasPoint"], EX[f"{vav}_{point}"]))
+            graph.add((EX[f"{vav}_{point}"], BRICK["hasTag"], EX[f"{vav}_{point}_tag"]))
+    return graph
+
+
+def test_streamed_export_matches_the_built_tree(building_motif, tmp_path):
+    translator = Translator()
+    translator.add_rules_from_dict({}, {})
+    translator.graph = equipment()
+    for templates in (False, True):
+        built = b"".join(iter_xml(translator.build_af_tree(templates)))
+        assert (b"<AFElementTemplate>" in built) == templates
+        assert b"".join(translator.iter_af_xml(templates)) == built
+
+    # createAFTree streams a full export and reads the digests back from the file
+    source = tmp_path / "building.ttl"
+    equipment().serialize(source, format="turtle")
+    exporter = Translator()
+    exporter.add_rules_from_dict({}, {})
+    outpath = str(tmp_path / "building.xml")
+    assert exporter.createAFTree(str(source), outpath, templates=True) is None
+    with open(outpath, "rb") as f:
+        assert f.read() == b"".join(iter_xml(exporter.build_af_tree(True)))
+    _, state = af_delta.load_state(af_delta.state_path(outpath))
+    assert state == af_delta.tree_state(exporter.build_af_tree(True))
+
+
+def element(document, name):
+    return document.xpath(f"//AFElement[Name='{name}']")[0]
+
+
+def attributes(element):
+    """Name -> the child tags and ConfigString of each attribute of an element"""
+    return {
+        attribute.findtext("Name"): ([child.tag for child in attribute], attribute.findtext("ConfigString"))
+        for attribute in element.findall("AFAttribute")
+    }
+
+
+def test_templates_group_equipment_and_name_attributes_by_point_class(building_motif):
+    graph = equipment()
+    # a second zone temperature sensor, without a tag, on both VAVs ...
+    for vav in ("vav1", "vav2"):
+        graph.add((EX[f"{vav}_zat"], RDF.type, BRICK["Zone_Air_Temperature_Sensor"]))
+        graph.add((EX[vav], BRICK["hasPoint"], EX[f"{vav}_zat"]))
+    # ... and a VAV with other points
+    graph.add((EX["vav3"], RDF.type, BRICK["Variable_Air_Volume_Box"]))
+    graph.add((EX["vav3_sat"], RDF.type, BRICK["Supply_Air_Temperature_Sensor"]))
+    graph.add((EX["vav3"], BRICK["hasPoint"], EX["vav3_sat"]))
+    translator = Translator()
+    translator.add_rules_from_dict({}, {})
+    translator.graph = graph
+
+    # without templates (the default) every attribute is named after its point
+    document = etree.fromstring(b"".join(translator.iter_af_xml()))
+    assert not document.xpath("//AFElementTemplate")
+    assert set(attributes(element(document, "vav1"))) == {
+        "vav1_Supply_Air_Temperature_Sensor", "vav1_Zone_Air_Temperature_Sensor", "vav1_zat",
+    }
+
+    document = etree.fromstring(b"".join(translator.iter_af_xml(templates=True)))
+    [template] = document.xpath("//AFDatabase/AFElementTemplate")
+    assert template.findtext("Name") == "Variable_Air_Volume_Box"
+    assert [t.findtext("Name") for t in template.findall("AFAttributeTemplate")] == [
+        "Supply_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor_2",
+    ]
+    # the template refers to PI Points; the tag is set on every element
+    sat = template.findall("AFAttributeTemplate")[0]
+    assert sat.findtext("DataReference") == "PI Point" and sat.find("ConfigString") is None
+
+    for vav in ("vav1", "vav2"):
+        instance = element(document, vav)
+        assert instance.findtext("Template") == "Variable_Air_Volume_Box"
+        assert not instance.findall("AFAnalysis")
+        # only the tagged points override the template, with nothing but their ConfigString
+        assert attributes(instance) == {
+            point: (["Name", "ConfigString"], f"{vav}_{point}_tag;RelativeTime=-2y")
+            for point in ("Supply_Air_Temperature_Sensor", "Zone_Air_Temperature_Sensor")
+        }
+    # equipment without a twin keeps its point-named attributes
+    vav3 = element(document, "vav3")
+    assert vav3.find("Template") is None
+    assert set(attributes(vav3)) == {"vav3_sat"}
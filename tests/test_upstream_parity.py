@@ -0,0 +1,128 @@
+"""
+/transform and /transform/afxml used to call buildingmotif.exports.brick2af (the
+gtf-demo-branch of buildingmotif) and now use this package's rule binding,
+validation grouping, report and Translator. These tests run both on the same
+compiled model; they are skipped where that buildingmotif is not installed.
+"""
+import json
+import os
+
+import pytest
+from lxml import etree
+from rdflib import Graph, Namespace, RDF
+from rdflib.compare import isomorphic
+
+pytest.importorskip("buildingmotif.exports.brick2af")
+from buildingmotif.dataclasses import Model
+from buildingmotif.exports.brick2af import validation as upstream
+from buildingmotif.exports.brick2af.ttl_to_af import Translator as UpstreamTranslator
+from buildingmotif.exports.brick2af.utils import generate_manifest
+
+from interop_metadata_applications import af_reader
+from interop_metadata_applications.a import apply_rules_to_model, get_model_diffs, get_report
+from interop_metadata_applications.afxml import write_xml
+from interop_metadata_applications.api.views.transform import _TranslatorWithConfig, pi_af_config
+
+EX = Namespace("urn:example#")
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+UNIT = Namespace("http://qudt.org/vocab/unit/")
+RULES_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "demo-files", "GL36_VAV.json")
+PI_CONFIG = pi_af_config("SERVER", "DATABASE")
+
+
+def building() -> Graph:
+    """An AHU feeding three VAVs; the last one lacks its zone temperature, so some rules fail"""
+    graph = Graph()
+    graph.add((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    # a unit both translators map, if the sample PI config has any
+    unit = next(iter(PI_CONFIG["units"]), None)
+    for n in range(3):
+        vav = EX[f"vav{n}"]
+        graph.add((vav, RDF.type, BRICK["Variable_Air_Volume_Box"]))
+        graph.add((EX["ahu1"], BRICK["hasPart"], vav))
+        graph.add((EX["ahu1"], BRICK["feeds"], vav))
+        points = ["Supply_Air_Temperature_Sensor", "Supply_Air_Temperature_Setpoint", "Zone_Air_Temperature_Sensor"]
+        for point_class in points[: 2 if n == 2 else 3]:
+            point = EX[f"vav{n}_{point_class}"]
+            graph.add((point, RDF.type, BRICK[point_class]))
+            graph.add((vav, BRICK["hasPoint"], point))
+            graph.add((point, BRICK["hasTag"], EX[f"vav{n}_{point_class}_tag"]))
+            if unit is not None:
+                graph.add((point, BRICK["hasUnit"], UNIT[unit]))
+    return graph
+
+
+def plain(value):
+    """Nested dicts of rdflib terms as dicts of strings, with lists sorted"""
+    if isinstance(value, dict):
+        return {str(key): plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return sorted(plain(item) for item in value)
+    return str(value)
+
+
+def analyses(path):
+    """(name, target, equation) of every analysis of an AFXML file"""
+    return sorted(
+        (analysis.findtext("Name"), analysis.findtext("Target/AFElementRef"), analysis.findtext("AFAnalysisRule/ConfigString"))
+        for analysis in etree.parse(str(path)).iter("AFAnalysis")
+    )
+
+
+class _UpstreamTranslatorWithConfig(UpstreamTranslator):
+    """The upstream Translator with the PI config the API gave it before the swap"""
+
+    def __init__(self, config: dict):
+        self._dynamic_config = config
+        super().__init__()
+
+    def read_config_file(self):
+        self.defaultserver = self._dynamic_config["server"]
+        self.defaultdatabase = self._dynamic_config["database"]
+        self.defaulturi = f"\\\\{self.defaultserver}\\{self.defaultdatabase}"
+        self.units = self._dynamic_config.get("units", {})
+
+
+@pytest.fixture(scope="module")
+def rules():
+    with open(RULES_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def compiled(building_motif, rules):
+    model = Model.create("urn:example/upstream_parity")
+    model.add_graph(building())
+    model.get_manifest().add_graph(generate_manifest(rules))
+    return model.compile()
+
+
+def test_rule_bindings_diffs_and_report_match_upstream(compiled, rules):
+    bindings = apply_rules_to_model(compiled, rules)
+    assert plain(bindings) == plain(upstream.apply_rules_to_model(compiled, rules))
+
+    grouped_diffs, _ = get_model_diffs(compiled, use_cache=False)
+    upstream_diffs, _ = upstream.get_model_diffs(compiled)
+    assert plain(grouped_diffs) == plain(upstream_diffs)
+
+    assert get_report(grouped_diffs, bindings) == upstream.get_report(grouped_diffs, bindings)
+
+
+def test_afxml_export_matches_upstream(compiled, rules, tmp_path):
+    bindings = apply_rules_to_model(compiled, rules)
+
+    upstream_translator = _UpstreamTranslatorWithConfig(PI_CONFIG)
+    upstream_translator.add_rules_from_dict(rules, bindings)
+    upstream_path = tmp_path / "upstream.xml"
+    upstream_path.write_bytes(str(upstream_translator.create_af_tree_from_model(compiled)).encode("utf-8"))
+
+    translator = _TranslatorWithConfig(PI_CONFIG)
+    translator.add_rules_from_dict(rules, bindings)
+    local_path = tmp_path / "local.xml"
+    write_xml(translator.create_af_tree_from_model(compiled, templates=False), str(local_path))
+
+    # the local export adds element ids, which the lift leaves out
+    upstream_graph = af_reader.read_graph(str(upstream_path), units=translator.units)
+    local_graph = af_reader.read_graph(str(local_path), units=translator.units)
+    assert isomorphic(local_graph, upstream_graph)
+    assert analyses(local_path) == analyses(upstream_path)
@@ -0,0 +1,63 @@
+from buildingmotif.dataclasses import Library, Model
+from rdflib import Graph, Namespace, OWL, RDF, URIRef
+
+from interop_metadata_applications import validation_cache
+from interop_metadata_applications.validation_cache import cached_validate, library_fingerprint_scope, manifest_fingerprint
+
+EX = Namespace("urn:example#")
+BRICK = Namespace("https://brickschema.org/schema/Brick#")
+LIBRARY = "urn:example/validation_cache_library"
+
+
+def manifest() -> Graph:
+    graph = Graph()
+    graph.add((URIRef("urn:example/manifest"), OWL.imports, URIRef(LIBRARY)))
+    return graph
+
+
+def test_changed_library_changes_the_manifest_fingerprint(building_motif):
+    library = Library.create(LIBRARY)
+    before = manifest_fingerprint(manifest())
+    library.get_shape_collection().graph.add((EX["shape"], RDF.type, OWL.Class))
+    # nothing is remembered between calls, whichever process changed the library
+    assert manifest_fingerprint(manifest()) != before
+
+
+def test_scope_hashes_each_library_once(building_motif):
+    library = Library.create(LIBRARY)
+    with library_fingerprint_scope():
+        first = manifest_fingerprint(manifest())
+        # the library is not hashed again inside the scope ...
+        library.get_shape_collection().graph.add((EX["other"], RDF.type, OWL.Class))
+        assert manifest_fingerprint(manifest()) == first
+    # ... and nothing of it is kept after the scope
+    assert validation_cache._library_fingerprints.get() is None
+    assert manifest_fingerprint(manifest()) != first
+
+
+def test_cached_validate_reruns_after_a_model_or_manifest_change(building_motif, tmp_path):
+    validation_cache._memory_cache.clear()
+    model = Model.create("urn:example/validation_cache")
+    model.add_triples((EX["ahu1"], RDF.type, BRICK["AHU"]))
+    runs = []
+    validate = model.validate
+
+    def counted_validate(*args, **kwargs):
+        runs.append(1)
+        return validate(*args, **kwargs)
+
+    model.validate = counted_validate
+    first = cached_validate(model, cache_dir=str(tmp_path))
+    assert cached_validate(model, cache_dir=str(tmp_path)) is first
+    assert len(runs) == 1
+    # a fresh process finds the run on disk
+    validation_cache._memory_cache.clear()
+    assert cached_validate(model, cache_dir=str(tmp_path)).valid == first.valid
+    assert len(runs) == 1
+
+    model.add_triples((EX["ahu2"], RDF.type, BRICK["AHU"]))
+    cached_validate(model, cache_dir=str(tmp_path))
+    assert len(runs) == 2
+    model.get_manifest().graph.add((EX["shape"], RDF.type, OWL.Class))
+    cached_validate(model, cache_dir=str(tmp_path))
+    assert len(runs) == 3